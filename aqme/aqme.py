@@ -31,6 +31,7 @@ from aqme.cmin import cmin
 from aqme.qprep import qprep
 from aqme.utils import command_line_args
 from aqme.qcorr import qcorr
+from aqme.pipeline import pipeline
 
 
 def main():
@@ -56,9 +57,6 @@ def main():
             max_workers=args.max_workers,
             metal_complex=args.metal_complex,
             metal_atoms=args.metal_atoms,
-            metal_idx=args.metal_idx,
-            complex_coord=args.complex_coord,
-            metal_sym=args.metal_sym,
             complex_type=args.complex_type,
             opt_steps_rdkit=args.opt_steps_rdkit,
             heavyonly=args.heavyonly,
@@ -71,6 +69,8 @@ def main():
             auto_sample=args.auto_sample,
             ff=args.ff,
             degree=args.degree,
+            clash_summ=args.clash_summ,
+            ebound_summ=args.ebound_summ,
             verbose=args.verbose,
             output=args.output,
             seed=args.seed,
@@ -87,6 +87,8 @@ def main():
             nsteps_fullmonte=args.nsteps_fullmonte,
             nrot_fullmonte=args.nrot_fullmonte,
             ang_fullmonte=args.ang_fullmonte,
+            nwalkers_fullmonte=args.nwalkers_fullmonte,
+            merge_fullmonte=args.merge_fullmonte,
             crest_keywords=args.crest_keywords,
             angle_off=args.angle_off,
             nprocs=args.nprocs,
@@ -111,6 +113,9 @@ def main():
             metal_oxi=args.metal_oxi,
             complex_type=args.complex_type,
             ewin_cmin=args.ewin_cmin,
+            funnel_cmin=args.funnel_cmin,
+            ewin_funnel_cmin=args.ewin_funnel_cmin,
+            steps_funnel_cmin=args.steps_funnel_cmin,
             initial_energy_threshold=args.initial_energy_threshold,
             energy_threshold=args.energy_threshold,
             rms_threshold=args.rms_threshold,
@@ -120,6 +125,11 @@ def main():
             opt_steps=args.opt_steps,
             opt_fmax=args.opt_fmax,
             ani_method=args.ani_method,
+            ani_batch_size=args.ani_batch_size,
+            max_workers=args.max_workers,
+            cores_cmin=args.cores_cmin,
+            cache_cmin=args.cache_cmin,
+            cache_size_cmin=args.cache_size_cmin,
             stacksize=args.stacksize,
         )
 
@@ -147,6 +157,79 @@ def main():
             bs_nogen=args.bs_nogen,
 			verbose=args.verbose)
 
+    # PIPELINE (CSEARCH + CMIN + QPREP without intermediate SDF files)
+    if args.pipeline:
+        pipeline(
+            input=args.input,
+            command_line=args.command_line,
+            smi=args.smi,
+            name=args.name,
+            w_dir_main=args.w_dir_main,
+            destination=args.destination,
+            varfile=args.varfile,
+            program=args.program,
+            cmin_pipeline=args.cmin_pipeline,
+            qprep_pipeline=args.qprep_pipeline,
+            checkpoints_pipeline=args.checkpoints_pipeline,
+            charge=args.charge,
+            mult=args.mult,
+            sample=args.sample,
+            max_workers=args.max_workers,
+            metal_complex=args.metal_complex,
+            metal_atoms=args.metal_atoms,
+            metal_oxi=args.metal_oxi,
+            complex_type=args.complex_type,
+            opt_steps_rdkit=args.opt_steps_rdkit,
+            heavyonly=args.heavyonly,
+            max_matches_rmsd=args.max_matches_rmsd,
+            max_mol_wt=args.max_mol_wt,
+            ewin_csearch=args.ewin_csearch,
+            initial_energy_threshold=args.initial_energy_threshold,
+            energy_threshold=args.energy_threshold,
+            rms_threshold=args.rms_threshold,
+            ff=args.ff,
+            degree=args.degree,
+            clash_summ=args.clash_summ,
+            ebound_summ=args.ebound_summ,
+            verbose=args.verbose,
+            output=args.output,
+            seed=args.seed,
+            max_torsions=args.max_torsions,
+            stacksize=args.stacksize,
+            ewin_fullmonte=args.ewin_fullmonte,
+            ewin_sample_fullmonte=args.ewin_sample_fullmonte,
+            nsteps_fullmonte=args.nsteps_fullmonte,
+            nrot_fullmonte=args.nrot_fullmonte,
+            ang_fullmonte=args.ang_fullmonte,
+            nwalkers_fullmonte=args.nwalkers_fullmonte,
+            merge_fullmonte=args.merge_fullmonte,
+            xtb_method=args.xtb_method,
+            xtb_solvent=args.xtb_solvent,
+            xtb_accuracy=args.xtb_accuracy,
+            xtb_electronic_temperature=args.xtb_electronic_temperature,
+            xtb_max_iterations=args.xtb_max_iterations,
+            ewin_cmin=args.ewin_cmin,
+            funnel_cmin=args.funnel_cmin,
+            ewin_funnel_cmin=args.ewin_funnel_cmin,
+            steps_funnel_cmin=args.steps_funnel_cmin,
+            opt_steps=args.opt_steps,
+            opt_fmax=args.opt_fmax,
+            ani_method=args.ani_method,
+            ani_batch_size=args.ani_batch_size,
+            cores_cmin=args.cores_cmin,
+            cache_cmin=args.cache_cmin,
+            cache_size_cmin=args.cache_size_cmin,
+            qm_input=args.qm_input,
+            qm_end=args.qm_end,
+            suffix=args.suffix,
+            chk=args.chk,
+            mem=args.mem,
+            nprocs=args.nprocs,
+            gen_atoms=args.gen_atoms,
+            bs_gen=args.bs_gen,
+            bs_nogen=args.bs_nogen,
+        )
+
     # QCORR
     if args.qcorr:
         qcorr(
@@ -162,6 +245,7 @@ def main():
             dup_threshold=args.dup_threshold,
             isom_type=args.isom_type,
             isom_inputs=args.isom_inputs,
+            workers_qcorr=args.workers_qcorr,
             vdwfrac=args.vdwfrac,
             covfrac=args.covfrac,
             program=args.program,
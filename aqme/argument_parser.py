@@ -18,28 +18,34 @@ var_dict = {
 		"qprep": False,
 		"qcorr": False,
 		"qstat": False,
+		"pipeline": False,
+		"cmin_pipeline": [],
+		"qprep_pipeline": None,
+		"checkpoints_pipeline": [],
 		"qpred": False,
 		"smi": None,
 		"metal_complex": False,
 		"metal_atoms": [],
 		"charge": None,
 		"mult": None,
-		"complex_coord": [],
 		"complex_type": "",
 		"metal_oxi": [],
-		"metal_idx": [],
-		"metal_sym": [],
 		'constraints_atoms': [],
 		'constraints_dist': [],
     	'constraints_angle': [],
     	'constraints_dihedral': [],
 		"ewin_cmin": 5.0,
+		"funnel_cmin": False,
+		"ewin_funnel_cmin": 15.0,
+		"steps_funnel_cmin": 50,
 		"ewin_csearch": 5.0,
 		"opt_fmax": 0.05,
 		"opt_steps": 1000,
 		"opt_steps_rdkit": 1000,
 		"heavyonly": True,
 		"degree": 120.0,
+		"clash_summ": 0.5,
+		"ebound_summ": 0.0,
 		"max_torsions": 0,
 		"sample": "auto",
 		"auto_sample": 20,
@@ -51,6 +57,7 @@ var_dict = {
 		"initial_energy_threshold": 0.0001,
 		"max_mol_wt": 0,
 		"ani_method": "ANI2x",
+		"ani_batch_size": 0,
 		"stacksize": "1G",
 		"xtb_method": "GFN2-xTB",
 		"xtb_solvent": "none",
@@ -58,11 +65,16 @@ var_dict = {
 		"xtb_electronic_temperature": 300.0,
 		"xtb_max_iterations": 250,
 		"max_workers": 4,
+		"cores_cmin": 0,
+		"cache_cmin": None,
+		"cache_size_cmin": 1000,
 		"ewin_sample_fullmonte": 2.0,
 		"ewin_fullmonte": 5.0,
 		"nsteps_fullmonte": 100,
 		"nrot_fullmonte": 3,
 		"ang_fullmonte": 30,
+		"nwalkers_fullmonte": 1,
+		"merge_fullmonte": 10,
 		"cregen": False,
 		"cregen_keywords": None,
 		"program": None,
@@ -92,6 +104,7 @@ var_dict = {
 		"s2_threshold": 10.0,
 		"isom_type": None,
 		"isom_inputs": os.getcwd(),
+		"workers_qcorr": 1,
 		"vdwfrac": 0.5,
 		"covfrac": 1.1,
 		"fullcheck": True,
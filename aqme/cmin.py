@@ -5,14 +5,17 @@
 
 import os
 import sys
+import copy
+import hashlib
 import numpy as np
 from pathlib import Path
 from rdkit.Chem import AllChem as Chem
-from rdkit.Chem.PropertyMol import PropertyMol
 from progress.bar import IncrementalBar
-from rdkit.Geometry import Point3D
 import pandas as pd
 import time
+import concurrent.futures as futures
+import multiprocessing as mp
+from contextlib import contextmanager
 import ase
 import ase.optimize
 from ase.units import Hartree
@@ -25,10 +28,469 @@ from aqme.utils import (
     rules_get_charge,
     load_variables,
     substituted_mol,
-    creation_of_dup_csv_cmin)
-from aqme.filter import ewin_filter, pre_E_filter, RMSD_and_E_filter
+    creation_of_dup_csv_cmin,
+    ConformerEnsemble,
+    EnsembleWriter)
+from aqme.filter import ewin_filter, pre_E_filter, RMSD_and_E_filter, ewin_filter_batch
 
 hartree_to_kcal = 627.509
+# maximum fraction of padding atoms added to the smallest molecule of a batch
+ANI_MAX_PADDING = 0.25
+# decimals of the coordinates (in A) used to identify conformers in the CMIN cache
+CACHE_DECIMALS = 3
+
+# ANI models loaded in this process, see get_ani_model
+ANI_MODELS = {}
+# elements supported by the ANI models (in the order of their species indices)
+ANI_SPECIES = {
+    "ANI1x": ["H", "C", "N", "O"],
+    "ANI1ccx": ["H", "C", "N", "O"],
+    "ANI2x": ["H", "C", "N", "O", "S", "F", "Cl"],
+}
+
+
+def get_ani_model(ani_method):
+    """
+    Returns the torchani model of ani_method. Loading the model is only done
+    the first time that the method is used in each process.
+
+    Parameters
+    ----------
+    ani_method : str
+        ANI model used (i.e. ANI2x)
+
+    Returns
+    -------
+    torchani model
+    """
+
+    if ani_method not in ANI_MODELS:
+        if ani_method == "ANI1x":
+            model = torchani.models.ANI1x()
+        if ani_method == "ANI1ccx":
+            model = torchani.models.ANI1ccx()
+        if ani_method == "ANI2x":
+            model = torchani.models.ANI2x()
+        if ani_method == "ANI2ccx":
+            model = torchani.models.ANI2ccx()
+        if ani_method == "ANI3x":
+            model = torchani.models.ANI3x()
+        if ani_method == "ANI3ccx":
+            model = torchani.models.ANI3ccx()
+        # A bit Fancier
+        # model = getattr(torchani.models,ANI_method)()
+        model = model.to(DEVICE)
+        ANI_MODELS[ani_method] = model
+    return ANI_MODELS[ani_method]
+
+
+def ani_species_to_tensor(ani_method, symbols):
+    """
+    Species indices of the atoms for ani_method (same as species_to_tensor()
+    of the model). The network is not loaded for the models in ANI_SPECIES.
+    Raises KeyError if an atom is not supported by the model.
+    """
+
+    if ani_method in ANI_SPECIES:
+        species_model = ANI_SPECIES[ani_method]
+    else:
+        species_model = list(get_ani_model(ani_method).species)
+    species_idx = {symbol: idx for idx, symbol in enumerate(species_model)}
+    return torch.tensor([species_idx[symbol] for symbol in symbols], dtype=torch.long)
+
+
+def ani_energies_forces(model, species, coordinates):
+    """
+    Energies (in Hartree) and forces (in eV/A) of a batch of conformers
+    """
+
+    coordinates = coordinates.detach().to(torch.float32).requires_grad_(True)
+    energies = model((species, coordinates)).energies
+    forces = -torch.autograd.grad(energies.sum(), coordinates)[0]
+    return energies.detach().double(), forces.double() * Hartree
+
+
+def ani_batch_optimization(model, species, coordinates, fmax, steps, partial=False):
+    """
+    Optimizes a batch of conformers with a vectorized version of the FIRE
+    algorithm from ASE (same default parameters). Each conformer keeps its own
+    FIRE state, and the conformers stop moving once their maximum force is
+    lower than fmax. As in xtb_opt, the conformers that reach steps without
+    converging keep their initial coordinates (and energies), unless partial
+    is used.
+
+    Parameters
+    ----------
+    model : torchani model
+        ANI model used
+    species : torch.tensor
+        Species of the conformers, shape (n_confs, n_atoms)
+    coordinates : torch.tensor
+        Coordinates of the conformers, shape (n_confs, n_atoms, 3)
+    fmax : float
+        Convergence criterion of the forces (in eV/A), as in opt_fmax
+    steps : int
+        Maximum number of optimization steps, as in opt_steps
+    partial : bool
+        If True, the coordinates are updated even if the optimization stops
+        at steps (short optimizations of the CMIN funnel)
+
+    Returns
+    -------
+    tuple
+        energies (in Hartree), optimized coordinates and converged mask
+    """
+
+    dt_start, maxstep, dtmax, n_min = 0.1, 0.2, 1.0, 5
+    finc, fdec, a_start, fa = 1.1, 0.5, 0.1, 0.99
+
+    positions = coordinates.detach().double().clone()
+    n_confs = len(positions)
+    velocities = torch.zeros_like(positions)
+    dt = torch.full((n_confs,), dt_start, dtype=torch.float64)
+    a = torch.full((n_confs,), a_start, dtype=torch.float64)
+    n_pos = torch.zeros(n_confs, dtype=torch.long)
+    active = torch.ones(n_confs, dtype=torch.bool)
+    moved = torch.zeros(n_confs, dtype=torch.bool)
+    converged_confs = torch.zeros(n_confs, dtype=torch.bool)
+
+    for step in range(steps + 1):
+        idx = torch.nonzero(active).flatten()
+        _, forces = ani_energies_forces(model, species[idx], positions[idx])
+        converged = forces.norm(dim=-1).max(dim=-1).values < fmax
+        active[idx[converged]] = False
+        converged_confs[idx[converged]] = True
+        if step == steps or not active.any():
+            break
+        # only the conformers that are not converged are moved
+        idx, forces = idx[~converged], forces[~converged]
+        v = velocities[idx]
+
+        # FIRE step (ase.optimize.FIRE), the velocities are only mixed or
+        # reset after the first step of each conformer
+        vf = (forces * v).sum(dim=(1, 2))
+        downhill = vf > 0
+        uphill = ~downhill & moved[idx]
+        f_norm = forces.norm(dim=(1, 2)).clamp(min=1e-12)
+        v_norm = v.norm(dim=(1, 2))
+        a_idx = a[idx][:, None, None]
+        v_mixed = (1.0 - a_idx) * v + a_idx * forces / f_norm[:, None, None] * v_norm[:, None, None]
+        v = torch.where(downhill[:, None, None], v_mixed, v)
+        v = torch.where(uphill[:, None, None], torch.zeros_like(v), v)
+        accelerate = downhill & (n_pos[idx] > n_min)
+        dt[idx] = torch.where(
+            uphill,
+            dt[idx] * fdec,
+            torch.where(accelerate, torch.clamp(dt[idx] * finc, max=dtmax), dt[idx]),
+        )
+        a[idx] = torch.where(
+            uphill,
+            torch.full_like(a[idx], a_start),
+            torch.where(accelerate, a[idx] * fa, a[idx]),
+        )
+        n_pos[idx] = torch.where(
+            uphill,
+            torch.zeros_like(n_pos[idx]),
+            torch.where(downhill, n_pos[idx] + 1, n_pos[idx]),
+        )
+        moved[idx] = True
+
+        v = v + dt[idx][:, None, None] * forces
+        dr = dt[idx][:, None, None] * v
+        dr_norm = dr.norm(dim=(1, 2))
+        scale = torch.where(dr_norm > maxstep, maxstep / dr_norm.clamp(min=1e-12), torch.ones_like(dr_norm))
+        positions[idx] += dr * scale[:, None, None]
+        velocities[idx] = v
+
+    if not partial:
+        positions = torch.where(
+            converged_confs[:, None, None], positions, coordinates.detach().double()
+        )
+
+    energies, _ = ani_energies_forces(model, species, positions)
+    return energies, positions, converged_confs
+
+
+def ani_batch_worker(ani_method, species, coordinates, fmax, steps, partial=False):
+    """
+    Batched ANI optimization run by the CMIN workers (the model is loaded
+    once per worker, see get_ani_model)
+    """
+
+    model = get_ani_model(ani_method)
+    return ani_batch_optimization(model, species, coordinates, fmax, steps, partial)
+
+
+# xTB calculators created in this process, see get_xtb_calculator
+XTB_CALCULATORS = {}
+
+
+def get_xtb_settings(args):
+    """
+    xTB options of args (method, accuracy, electronic_temperature,
+    max_iterations and solvent), used to create the ASE calculator
+    """
+
+    return (
+        args.xtb_method,
+        args.xtb_accuracy,
+        args.xtb_electronic_temperature,
+        args.xtb_max_iterations,
+        args.xtb_solvent,
+    )
+
+
+def get_xtb_calculator(xtb_settings):
+    """
+    Returns the ASE calculator of xTB for the options from get_xtb_settings().
+    The calculator is only created the first time that the options are used
+    in each process.
+    """
+
+    from xtb.ase.calculator import XTB
+
+    if xtb_settings not in XTB_CALCULATORS:
+        method, accuracy, electronic_temperature, max_iterations, solvent = xtb_settings
+        XTB_CALCULATORS[xtb_settings] = XTB(
+            method=method,
+            accuracy=accuracy,
+            electronic_temperature=electronic_temperature,
+            max_iterations=max_iterations,
+            solvent=solvent,
+        )
+    return XTB_CALCULATORS[xtb_settings]
+
+
+def xtb_opt(elements, coordinates, charge, mult, opt_fmax, opt_steps, xtb_settings, partial=False):
+    """
+    Run an xtb optimization of one conformer and return the energy and the
+    optimized coordinates. Only the options needed are passed, so the tasks
+    sent to the CMIN workers are small.
+
+    Parameters
+    ----------
+    elements : str
+        Atomic symbols of the molecule
+    coordinates : numpy.array
+        Coordinates of the conformer, shape (n_atoms, 3)
+    charge : list
+        Charges of the atoms
+    mult : list
+        Unpaired electrons of the atoms
+    opt_fmax : float
+        Convergence criterion of the forces, as in opt_fmax
+    opt_steps : int
+        Maximum number of optimization steps, as in opt_steps
+    xtb_settings : tuple
+        xTB options from get_xtb_settings()
+    partial : bool
+        If True, the coordinates are updated even if the optimization stops
+        at opt_steps (short optimizations of the CMIN funnel)
+
+    Returns
+    -------
+    tuple
+        sqm_energy, coordinates
+    """
+
+    # define ase molecule using GFN2 Calculator
+    ase_molecule = ase.Atoms(
+        elements, positions=coordinates.tolist(), calculator=get_xtb_calculator(xtb_settings)
+    )
+
+    # Adjust the charge of the metal atoms
+    for i, atom in enumerate(ase_molecule):
+        # will update only for cdx, smi, and csv formats.
+        atom.charge = charge[i]
+        atom.magmom = mult[i]
+
+    # the number of steps is tracked by the optimizer, so no trajectory or
+    # log files are written
+    optimizer = ase.optimize.BFGS(ase_molecule, logfile=None)
+
+    optimizer.run(fmax=opt_fmax, steps=opt_steps)
+
+    if partial or optimizer.nsteps != opt_steps:
+        coordinates = ase_molecule.get_positions()
+
+    # Now let's compute energy:
+    xtb_energy = ase_molecule.get_potential_energy()
+    sqm_energy = (xtb_energy / Hartree) * hartree_to_kcal
+
+    return sqm_energy, np.array(coordinates)
+
+
+def get_cmin_budget(args):
+    """
+    Number of cores used by CMIN (cores_cmin, all the cores if 0). In the
+    pipeline, the CSEARCH workers run at the same time as CMIN, so they are
+    not included in the default budget.
+    """
+
+    n_cores = int(args.cores_cmin)
+    if n_cores <= 0:
+        n_cores = os.cpu_count() or 1
+        if args.pipeline:
+            n_cores = max(1, n_cores - int(args.max_workers))
+    return n_cores
+
+
+def get_cmin_cores(args):
+    """
+    Splits the core budget of CMIN (see get_cmin_budget) between the worker
+    processes (up to max_workers) and the OMP/torch threads of each worker.
+
+    Returns
+    -------
+    tuple
+        n_workers, n_threads
+    """
+
+    n_cores = get_cmin_budget(args)
+    n_workers = max(1, min(int(args.max_workers), n_cores))
+    n_threads = max(1, n_cores // n_workers)
+    return n_workers, n_threads
+
+
+def set_cmin_threads(n_threads, stacksize):
+    """
+    Sets the OMP and torch threads of a CMIN process (used as initializer of
+    the workers)
+    """
+
+    os.environ["OMP_NUM_THREADS"] = str(n_threads)
+    # if large system increase stack size
+    if stacksize != "1G":
+        os.environ["OMP_STACKSIZE"] = stacksize
+    torch.set_num_threads(n_threads)
+
+
+@contextmanager
+def cmin_threads(n_threads, stacksize):
+    """
+    Uses the OMP and torch threads of CMIN in this process (when CMIN runs
+    without workers) and restores the previous values afterwards
+    """
+
+    previous_env = {var: os.environ.get(var) for var in ["OMP_NUM_THREADS", "OMP_STACKSIZE"]}
+    previous_threads = torch.get_num_threads()
+    set_cmin_threads(n_threads, stacksize)
+    try:
+        yield
+    finally:
+        for var, value in previous_env.items():
+            if value is None:
+                os.environ.pop(var, None)
+            else:
+                os.environ[var] = value
+        torch.set_num_threads(previous_threads)
+
+
+def get_cmin_executor(n_workers, n_threads, stacksize):
+    """
+    Process pool of CMIN, with n_threads OMP/torch threads in each worker
+    """
+
+    return futures.ProcessPoolExecutor(
+        max_workers=n_workers,
+        mp_context=mp.get_context("spawn"),
+        initializer=set_cmin_threads,
+        initargs=(n_threads, stacksize),
+    )
+
+
+def cmin_cache_key(elements, coordinates, args, charge=None, mult=None, partial=False):
+    """
+    Hash used to store the optimization of a conformer in the CMIN cache.
+    It contains the elements (in order), the coordinates rounded to
+    CACHE_DECIMALS, the method and its settings, and the optimization
+    options.
+
+    Returns
+    -------
+    str
+        Hexadecimal SHA-1 hash
+    """
+
+    # + 0.0 avoids different hashes for -0.0 and 0.0
+    coords = np.round(np.asarray(coordinates, dtype=np.float64), CACHE_DECIMALS) + 0.0
+    if args.program == "xtb":
+        settings = [
+            args.xtb_method,
+            args.xtb_solvent,
+            args.xtb_accuracy,
+            args.xtb_electronic_temperature,
+            args.xtb_max_iterations,
+            np.asarray(charge).tolist(),
+            np.asarray(mult).tolist(),
+        ]
+    else:
+        settings = [args.ani_method]
+    settings += [args.program, int(args.opt_steps), float(args.opt_fmax), partial]
+
+    sha = hashlib.sha1()
+    sha.update(elements.encode())
+    sha.update(repr(settings).encode())
+    sha.update(np.ascontiguousarray(coords).tobytes())
+    return sha.hexdigest()
+
+
+def load_cmin_cache(args, key):
+    """
+    Returns the energy (kcal/mol) and optimized coordinates of a conformer
+    stored in the CMIN cache (None if the conformer is not stored)
+    """
+
+    cache_file = Path(args.cache_cmin).joinpath(key[:2], f"{key}.npz")
+    try:
+        with np.load(cache_file) as cache_data:
+            energy, coordinates = float(cache_data["energy"]), cache_data["coords"]
+    except (OSError, KeyError, ValueError):
+        return None
+    # the access time is updated, so the least recently used files are evicted first
+    os.utime(cache_file)
+    return energy, coordinates
+
+
+def save_cmin_cache(args, key, energy, coordinates):
+    """
+    Stores the energy (kcal/mol) and optimized coordinates of a conformer in
+    the CMIN cache
+    """
+
+    cache_file = Path(args.cache_cmin).joinpath(key[:2], f"{key}.npz")
+    cache_file.parent.mkdir(exist_ok=True, parents=True)
+    # written to a temporary file first, so other runs never read partial files
+    tmp_file = cache_file.with_suffix(f".{os.getpid()}.tmp")
+    with open(tmp_file, "wb") as f:
+        np.savez(f, energy=energy, coords=np.asarray(coordinates, dtype=np.float64))
+    os.replace(tmp_file, cache_file)
+
+
+def evict_cmin_cache(args):
+    """
+    Removes the least recently used files of the CMIN cache until its size
+    is below cache_size_cmin (in MB)
+    """
+
+    cache_files = []
+    for cache_file in Path(args.cache_cmin).glob("*/*.npz"):
+        try:
+            stat = cache_file.stat()
+        except OSError:
+            continue
+        cache_files.append((stat.st_mtime, stat.st_size, cache_file))
+
+    total_size = sum(size for _, size, _ in cache_files)
+    max_size = float(args.cache_size_cmin) * 1024 ** 2
+    for _, size, cache_file in sorted(cache_files):
+        if total_size <= max_size:
+            break
+        try:
+            cache_file.unlink()
+        except OSError:
+            pass
+        total_size -= size
 
 
 class cmin:
@@ -54,36 +516,52 @@ class cmin:
         os.chdir(self.args.w_dir_main)
         # create the dataframe to store the data
         self.final_dup_data = creation_of_dup_csv_cmin(self.args.program)
+        # the process pool is shared by all the molecules of the run
+        self.executor = None
 
-        bar = IncrementalBar(
-            "o  Number of finished jobs from CMIN", max=len(self.args.files)
-        )
-        for file in self.args.files:
-            # load jobs for cmin minimization
-            self.mols, self.name = self.load_jobs(file)
-
-            cmin_folder = Path(self.args.w_dir_main).joinpath(
-                f"CMIN/{self.args.program}"
+        try:
+            bar = IncrementalBar(
+                "o  Number of finished jobs from CMIN", max=len(self.args.files)
             )
-            cmin_folder.mkdir(exist_ok=True, parents=True)
+            if self.args.program == "ani" and int(self.args.ani_batch_size) > 0:
+                # the conformers of all the files are optimized together in
+                # padded ANI batches, and then each file is filtered and written
+                cmin_jobs = []
+                for file in self.args.files:
+                    self.mols, self.name = self.load_jobs(file)
+                    cmin_jobs.append(self.prepare_cmin())
+                if self.args.funnel_cmin:
+                    self.funnel_cmin(cmin_jobs)
+                self.optimize_cmin(cmin_jobs, self.args)
+
+                for cmin_data in cmin_jobs:
+                    self.name = cmin_data["name"]
+                    self.set_cmin_writers()
+                    total_data = self.filter_cmin(cmin_data)
+
+                    frames = [self.final_dup_data, total_data]
+                    self.final_dup_data = pd.concat(frames, ignore_index=True, sort=True)
+                    bar.next()
 
-            self.cmin_all_file = cmin_folder.joinpath(
-                f"{self.name}_{self.args.program}_all_confs{self.args.output}"
-            )
-            self.sdwriterall = Chem.SDWriter(str(self.cmin_all_file))
+            else:
+                for file in self.args.files:
+                    # load jobs for cmin minimization
+                    self.mols, self.name = self.load_jobs(file)
+                    self.set_cmin_writers()
 
-            self.cmin_file = cmin_folder.joinpath(
-                self.name + "_" + self.args.program + self.args.output
-            )
-            self.sdwriter = Chem.SDWriter(str(self.cmin_file))
+                    # runs the conformer sampling with multiprocessors
+                    total_data = self.compute_cmin()
 
-            # runs the conformer sampling with multiprocessors
-            total_data = self.compute_cmin()
+                    frames = [self.final_dup_data, total_data]
+                    self.final_dup_data = pd.concat(frames, ignore_index=True, sort=True)
+                    bar.next()
+            bar.finish()
+        finally:
+            self.shutdown_cmin_executor()
 
-            frames = [self.final_dup_data, total_data]
-            self.final_dup_data = pd.concat(frames, ignore_index=True, sort=True)
-            bar.next()
-        bar.finish()
+        # the size of the cache is only checked once per run
+        if self.args.cache_cmin is not None:
+            evict_cmin_cache(self.args)
 
         # store all the information into a CSV file
         cmin_csv_file = self.args.w_dir_main.joinpath(f"CMIN-Data.csv")
@@ -96,6 +574,82 @@ class cmin:
         # this is added to avoid path problems in jupyter notebooks
         os.chdir(self.args.initial_dir)
 
+    @classmethod
+    def from_args(cls, args):
+        """
+        Creates a CMIN object from loaded options without running the
+        minimizations (used by the pipeline module)
+        """
+
+        obj = cls.__new__(cls)
+        obj.args = args
+        obj.executor = None
+        return obj
+
+    def map_cmin(self, function, *tasks):
+        """
+        Runs the CMIN tasks. By default (cores_cmin = 0), they run in this
+        process with the usual OMP/torch threads, so the xTB calculators and
+        ANI models are loaded only once. If cores_cmin is set and there is
+        more than one task, they run in the process pool of the run, which is
+        created the first time it's needed and reused for all the molecules.
+        """
+
+        n_tasks = len(tasks[0])
+        if int(self.args.cores_cmin) <= 0 and not self.args.pipeline:
+            # if large system increase stack size
+            if self.args.stacksize != "1G":
+                os.environ["OMP_STACKSIZE"] = self.args.stacksize
+            return list(map(function, *tasks))
+
+        n_workers, n_threads = get_cmin_cores(self.args)
+        if int(self.args.cores_cmin) <= 0 or n_workers == 1 or n_tasks <= 1:
+            # in this process, using the whole core budget
+            with cmin_threads(get_cmin_budget(self.args), self.args.stacksize):
+                return list(map(function, *tasks))
+        if self.executor is None:
+            self.executor = get_cmin_executor(n_workers, n_threads, self.args.stacksize)
+        return list(self.executor.map(function, *tasks))
+
+    def shutdown_cmin_executor(self):
+        """
+        Closes the process pool of the run (if it was created)
+        """
+
+        if self.executor is not None:
+            self.executor.shutdown()
+            self.executor = None
+
+    def set_cmin_writers(self, in_memory=False):
+        """
+        Sets the writers of all the optimized conformers and the filtered
+        conformers. With in_memory (pipeline runs), the conformers are kept
+        in EnsembleWriter objects and the SDF files are only written if the
+        CMIN program is included in checkpoints_pipeline.
+        """
+
+        cmin_folder = Path(self.args.w_dir_main).joinpath(
+            f"CMIN/{self.args.program}"
+        )
+        self.cmin_all_file = cmin_folder.joinpath(
+            f"{self.name}_{self.args.program}_all_confs{self.args.output}"
+        )
+        self.cmin_file = cmin_folder.joinpath(
+            self.name + "_" + self.args.program + self.args.output
+        )
+
+        if in_memory:
+            if self.args.program in self.args.checkpoints_pipeline:
+                self.sdwriterall = EnsembleWriter(self.cmin_all_file)
+                self.sdwriter = EnsembleWriter(self.cmin_file)
+            else:
+                self.sdwriterall = EnsembleWriter()
+                self.sdwriter = EnsembleWriter()
+        else:
+            cmin_folder.mkdir(exist_ok=True, parents=True)
+            self.sdwriterall = Chem.SDWriter(str(self.cmin_all_file))
+            self.sdwriter = Chem.SDWriter(str(self.cmin_file))
+
     def load_jobs(self, file):
         if self.args.verbose:
             if self.args.program == "xtb":
@@ -117,15 +671,75 @@ class cmin:
         return inmols, name_mol
 
     def compute_cmin(self):
+        cmin_data = self.prepare_cmin()
+        if self.args.funnel_cmin:
+            self.funnel_cmin([cmin_data])
+        self.optimize_cmin([cmin_data], self.args)
+        return self.filter_cmin(cmin_data)
+
+    def optimize_cmin(self, cmin_jobs, args, partial=False):
+        """
+        Optimizes the conformers of the molecules with ANI or xTB (using
+        args.opt_steps)
+        """
+
+        if args.program == "ani":
+            self.ani_padded_calc(cmin_jobs, args, partial)
+        elif args.program == "xtb":
+            for cmin_data in cmin_jobs:
+                if len(cmin_data["coords"]) > 0:
+                    self.xtb_parallel_calc(cmin_data, args, partial)
+
+    def funnel_cmin(self, cmin_jobs):
+        """
+        Removes conformers before the full optimization in two stages:
+        single-point energies and short optimizations (steps_funnel_cmin).
+        After each stage, the conformers with energies higher than
+        ewin_funnel_cmin with respect to the most stable conformer of the
+        molecule are discarded.
+        """
+
+        for stage, steps in [("single-point", 0), ("short optimization", int(self.args.steps_funnel_cmin))]:
+            args_stage = copy.copy(self.args)
+            args_stage.opt_steps = steps
+            self.optimize_cmin(cmin_jobs, args_stage, partial=True)
+
+            # the energy windows of all the molecules are applied at once
+            kept_idx = ewin_filter_batch(
+                [cmin_data["cenergy"] for cmin_data in cmin_jobs], float(self.args.ewin_funnel_cmin)
+            )
+            for cmin_data, idx_mol in zip(cmin_jobs, kept_idx):
+                if len(cmin_data["coords"]) == 0:
+                    continue
+                # the conformers keep their input order
+                keep = np.sort(idx_mol)
+                if self.args.verbose:
+                    self.args.log.write(
+                        f"o  {len(cmin_data['coords']) - len(keep)} conformers of {cmin_data['name']} rejected after the {stage} "
+                        f"funnel stage (E > {self.args.ewin_funnel_cmin} kcal/mol)"
+                    )
+                for key in ["coords", "names", "props", "cenergy"]:
+                    cmin_data[key] = [cmin_data[key][j] for j in keep]
+
+    def prepare_cmin(self):
+        """
+        Reads the conformers of the molecule. They are optimized afterwards
+        with xtb_parallel_calc or ani_padded_calc.
+        """
 
         dup_data = creation_of_dup_csv_cmin(self.args.program)
         dup_data_idx = 0
         dup_data.at[dup_data_idx, "Molecule"] = self.name
-        cenergy, outmols = [], []
+        cenergy, coords, names, props = [], [], [], []
         start_time = time.time()
 
 
-        charge = rules_get_charge(self.mols[0], self.args, "cmin")
+        # the conformers share the topology, so the metal atoms are detected
+        # only once per molecule
+        metal_context = None
+        if self.args.metal_complex:
+            metal_context = substituted_mol(self.mols[0], self.args, "noI")
+        charge = rules_get_charge(self.mols[0], metal_context, "cmin")
         mult = []
         for Atom in self.mols[0].GetAtoms():
             mult.append(Atom.GetNumRadicalElectrons())
@@ -138,35 +752,44 @@ class cmin:
 
         for _, mol in enumerate(self.mols):
             if mol is not None:
-                # optimize this structure and record the energy
-                if self.args.metal_complex:
-                    # fill the lists with None for every metal in the option
-                    for _ in self.args.metal_atoms:
-                        self.args.metal_idx.append(None)
-                        self.args.complex_coord.append(None)
-                        self.args.metal_sym.append(None)
-
-                    (
-                        self.args.metal_idx,
-                        self.args.complex_coord,
-                        self.args.metal_sym,
-                    ) = substituted_mol(self, mol, "noI")
-
-                self.mol, energy, ani_incompatible = self.optimize(
-                    mol,
-                    self.args,
-                    self.args.program,
-                    self.args.log,
-                    dup_data,
-                    dup_data_idx,
-                    charge,
-                    mult
-                )
+                # the conformers are optimized together after the loop
+                coords.append(mol.GetConformer().GetPositions())
+                names.append(mol.GetProp("_Name"))
+                props.append({prop: mol.GetProp(prop) for prop in mol.GetPropNames()})
+
+        return {
+            "name": self.name,
+            "mol": self.mols[0],
+            "n_mols": len(self.mols),
+            "dup_data": dup_data,
+            "start_time": start_time,
+            "charge": charge,
+            "mult": mult,
+            "cenergy": cenergy,
+            "coords": coords,
+            "names": names,
+            "props": props,
+        }
+
+    def filter_cmin(self, cmin_data):
+        """
+        Writes all the optimized conformers and the conformers that pass the
+        energy and RMSD filters
+        """
 
-                if not ani_incompatible:
-                    pmol = PropertyMol(mol)
-                    outmols.append(pmol)
-                    cenergy.append(energy)
+        dup_data, dup_data_idx = cmin_data["dup_data"], 0
+        start_time = cmin_data["start_time"]
+        charge, mult = cmin_data["charge"], cmin_data["mult"]
+        cenergy = cmin_data["cenergy"]
+
+        # the optimized conformers are stored in a single ensemble
+        outmols = ConformerEnsemble(
+            cmin_data["mol"],
+            cmin_data["coords"],
+            cenergy,
+            cmin_data["names"],
+            cmin_data["props"],
+        )
 
         # if SQM energy exists, overwrite RDKit energies and geometries
         cids = list(range(len(outmols)))
@@ -175,22 +798,20 @@ class cmin:
         name_mol = self.name
 
         for cid in sorted_all_cids:
-            outmols[cid].SetProp(
-                "_Name", outmols[cid].GetProp("_Name") + " " + self.args.program
-            )
-            outmols[cid].SetProp("Energy", cenergy[cid])
+            outmols.names[cid] = outmols.names[cid] + " " + self.args.program
+            outmols.set_prop(cid, "Energy", cenergy[cid])
             if self.args.charge is None:
-                outmols[cid].SetProp("Real charge", str(np.sum(charge)))
+                outmols.set_prop(cid, "Real charge", np.sum(charge))
             else:
-                outmols[cid].SetProp("Real charge", str(self.args.charge))
+                outmols.set_prop(cid, "Real charge", self.args.charge)
             if self.args.mult is None:
-                outmols[cid].SetProp("Mult", str(mult))
+                outmols.set_prop(cid, "Mult", mult)
             else:
-                outmols[cid].SetProp("Mult", str(self.args.mult))
+                outmols.set_prop(cid, "Mult", self.args.mult)
 
         write_all_confs = 0
         for cid in sorted_all_cids:
-            self.sdwriterall.write(outmols[cid])
+            self.sdwriterall.write(outmols.to_mol(cid))
             write_all_confs += 1
         self.sdwriterall.close()
 
@@ -238,9 +859,9 @@ class cmin:
         )
 
         if self.args.program == "xtb":
-            dup_data.at[dup_data_idx, "xTB-Initial-samples"] = len(self.mols)
+            dup_data.at[dup_data_idx, "xTB-Initial-samples"] = cmin_data["n_mols"]
         elif self.args.program == "ani":
-            dup_data.at[dup_data_idx, "ANI-Initial-samples"] = len(self.mols)
+            dup_data.at[dup_data_idx, "ANI-Initial-samples"] = cmin_data["n_mols"]
 
         # write the filtered, ordered conformers to external file
         self.write_confs(
@@ -251,193 +872,159 @@ class cmin:
         )
         return dup_data
 
-    def xtb_calc(self, elements, coordinates, args, log, charge, mult):
+    def xtb_parallel_calc(self, cmin_data, args, partial=False):
         """
-        Run an xtb optimization and return the optimized coordinates and the energy
-        of the molecule.
-
-        Parameters
-        ----------
-        elements : [type]
-                                                                                                                                                                                                   [description]
-        coordinates : [type]
-                                                                                                                                                                                                   [description]
-        args : argparse.args
-                                                                                                                                                                                                   [description]
-        log : Logger
-                                                                                                                                                                                                   [description]
-
-        Returns
-        -------
-        tuple
-                                                                                                                                                                                                   sqm_energy, coordinates
+        Run the xTB optimizations of the conformers of a molecule, spread
+        across the worker processes of the run (see map_cmin). The energies (kcal/mol)
+        and optimized coordinates are stored back in cmin_data.
         """
 
-        from xtb.ase.calculator import XTB
-
-        xtb_calculator = XTB(
-            method=args.xtb_method,
-            accuracy=args.xtb_accuracy,
-            electronic_temperature=args.xtb_electronic_temperature,
-            max_iterations=args.xtb_max_iterations,
-            solvent=args.xtb_solvent,
-        )
-
-        # define ase molecule using GFN2 Calculator
-        ase_molecule = ase.Atoms(
-            elements, positions=coordinates.tolist()[0], calculator=xtb_calculator
-        )
-
-        # Adjust the charge of the metal atoms
-        for i, atom in enumerate(ase_molecule):
-            # will update only for cdx, smi, and csv formats.
-            atom.charge = charge[i]
-            atom.magmom = mult[i]
+        try:
+            from xtb.ase.calculator import XTB
+        except (ModuleNotFoundError, AttributeError):
+            args.log.write("\nx  xTB is not installed correctly - xTB is not available")
+            args.log.finalize()
+            sys.exit()
 
-        optimizer = ase.optimize.BFGS(
-            ase_molecule, trajectory="xTB_opt.traj", logfile="xtb.opt"
+        elements = ""
+        for atom in cmin_data["mol"].GetAtoms():
+            elements += atom.GetSymbol()
+        n_confs = len(cmin_data["coords"])
+        results = [None] * n_confs
+
+        # conformers optimized in previous runs are taken from the CMIN cache
+        cache_keys = [None] * n_confs
+        if args.cache_cmin is not None:
+            for j, coordinates in enumerate(cmin_data["coords"]):
+                cache_keys[j] = cmin_cache_key(
+                    elements, coordinates, args, cmin_data["charge"], cmin_data["mult"], partial
+                )
+                results[j] = load_cmin_cache(args, cache_keys[j])
+        missing = [j for j in range(n_confs) if results[j] is None]
+
+        n_tasks = len(missing)
+        tasks = (
+            [elements] * n_tasks,
+            [cmin_data["coords"][j] for j in missing],
+            [cmin_data["charge"]] * n_tasks,
+            [cmin_data["mult"]] * n_tasks,
+            [float(args.opt_fmax)] * n_tasks,
+            [int(args.opt_steps)] * n_tasks,
+            [get_xtb_settings(args)] * n_tasks,
+            [partial] * n_tasks,
         )
 
-        optimizer.run(fmax=args.opt_fmax, steps=args.opt_steps)
-
-        if len(ase.io.Trajectory("xTB_opt.traj", mode="r")) != (args.opt_steps + 1):
-            species_coords = ase_molecule.get_positions().tolist()
-            coordinates = torch.tensor(
-                [species_coords], requires_grad=True, device=DEVICE
-            )
+        if n_tasks > 0:
+            new_results = self.map_cmin(xtb_opt, *tasks)
 
-        # Now let's compute energy:
-        xtb_energy = ase_molecule.get_potential_energy()
-        sqm_energy = (xtb_energy / Hartree) * hartree_to_kcal
+            for j, result in zip(missing, new_results):
+                results[j] = result
+                if args.cache_cmin is not None:
+                    save_cmin_cache(args, cache_keys[j], *result)
 
-        return sqm_energy, coordinates
+        cmin_data["cenergy"] = [energy for energy, _ in results]
+        cmin_data["coords"] = [coords for _, coords in results]
 
-    def ani_calc(self, elements, coordinates, args):
+    def ani_padded_calc(self, cmin_jobs, args, partial=False):
         """
-        Run an ANI optimization and return the energy and optimized coordinates.
+        Run batched ANI optimizations of the conformers of one or more
+        molecules. The conformers are sorted by number of atoms and packed in
+        batches of up to ani_batch_size conformers (all the conformers if
+        ani_batch_size is 0) with similar sizes, using the padding species of
+        torchani (-1). The energies (kcal/mol) and optimized coordinates are
+        stored back in the data of each molecule.
 
         Parameters
         ----------
-        ase : [type]
-                                                                                                                                                                                                   [description]
-        torch : [type]
-                                                                                                                                                                                                   [description]
-        model : [type]
-                                                                                                                                                                                                   [description]
-        device : [type]
-                                                                                                                                                                                                   [description]
-        elements : [type]
-                                                                                                                                                                                                   [description]
-        coordinates : [type]
-                                                                                                                                                                                                   [description]
-        args : [type]
-                                                                                                                                                                                                   [description]
-
-        Returns
-        -------
-        tuple
-                                                                                                                                                                                                   sqm_energy, coordinates
+        cmin_jobs : list
+            Data of the molecules returned by prepare_cmin()
+        args : argparse.args
+            Options of CMIN (ani_method, ani_batch_size, opt_fmax and opt_steps)
+        partial : bool
+            If True, the coordinates are updated even if the optimizations
+            stop at opt_steps (short optimizations of the CMIN funnel)
         """
 
-        # Select the model
-        ANI_method = args.ani_method
-        if ANI_method == "ANI1x":
-            model = torchani.models.ANI1x()
-        if ANI_method == "ANI1ccx":
-            model = torchani.models.ANI1ccx()
-        if ANI_method == "ANI2x":
-            model = torchani.models.ANI2x()
-        if ANI_method == "ANI2ccx":
-            model = torchani.models.ANI2ccx()
-        if ANI_method == "ANI3x":
-            model = torchani.models.ANI3x()
-        if ANI_method == "ANI3ccx":
-            model = torchani.models.ANI3ccx()
-        # A bit Fancier
-        # model = getattr(torchani.models,ANI_method)()
-
-        species = model.species_to_tensor(elements).to(DEVICE).unsqueeze(0)
-        _, ani_energy = model((species, coordinates))
-
-        ase_molecule = ase.Atoms(
-            elements, positions=coordinates.tolist()[0], calculator=model.ase()
-        )
-
-        optimizer = ase.optimize.BFGS(
-            ase_molecule, trajectory="ANI1_opt.traj", logfile="ase.opt"
-        )
-        optimizer.run(fmax=args.opt_fmax, steps=args.opt_steps)
-        if len(ase.io.Trajectory("ANI1_opt.traj", mode="r")) != (args.opt_steps + 1):
-            species_coords = ase_molecule.get_positions().tolist()
-            coordinates = torch.tensor(
-                [species_coords], requires_grad=True, device=DEVICE
-            )
-
-        # Now let's compute energy:
-        _, ani_energy = model((species, coordinates))
-        sqm_energy = ani_energy.item() * hartree_to_kcal  # Hartree to kcal/mol
-
-        return sqm_energy, coordinates
-
-    # xTB AND ANI MAIN OPTIMIZATION PROCESS
-    def optimize(self, mol, args, program, log, dup_data, dup_data_idx, charge, mult):
-
-        # Attempt an XTB import, if it fails log it and mock xtb_calc to delay the
-        # system exit until it is used.
-        try:
-            from xtb.ase.calculator import XTB
-        except (ModuleNotFoundError, AttributeError):
-            log.write("\nx  xTB is not installed correctly - xTB is not available")
-            log.finalize()
-            sys.exit()
-
-        # if large system increase stack size
-        if args.stacksize != "1G":
-            os.environ["OMP_STACKSIZE"] = args.stacksize
-
-        elements = ""
-        for i, atom in enumerate(mol.GetAtoms()):
-            elements += atom.GetSymbol()
-
-        cartesians = mol.GetConformers()[0].GetPositions()
-        coordinates = torch.tensor(
-            [cartesians.tolist()], requires_grad=True, device=DEVICE
-        )
-        ani_incompatible = False
-        if program == "ani":
+        # species of each molecule (ANI might not be compatible with some atoms)
+        entries, species_jobs, cache_keys_jobs = [], [], {}
+        for i, cmin_data in enumerate(cmin_jobs):
+            if len(cmin_data["coords"]) == 0:
+                species_jobs.append(None)
+                continue
+            symbols = [atom.GetSymbol() for atom in cmin_data["mol"].GetAtoms()]
+            elements = "".join(symbols)
             try:
-                energy, coordinates = self.ani_calc(elements, coordinates, args)
-
+                species_jobs.append(ani_species_to_tensor(args.ani_method, symbols).to(DEVICE))
             except KeyError:
-                log.write(
-                    f"\nx  {args.ani_method} could not optimize this molecule (i.e. check of atoms that are not compatible)"
+                args.log.write(
+                    f"\nx  {args.ani_method} could not optimize {cmin_data['name']} (i.e. check of atoms that are not compatible)"
                 )
-                ani_incompatible = True
-                energy = 0
-                coordinates = np.zeros((1, 3))
-
-        elif program == "xtb":
-            energy, coordinates = self.xtb_calc(elements, coordinates, args, log, charge, mult)
-        else:
-            log.write(
-                "x  Option not compatible with CMIN (check the available options)!"
-            )
-
-        cartesians = np.array(coordinates.tolist()[0])
-
-        # update coordinates of mol object
-        for j in range(mol.GetNumAtoms()):
-            [x, y, z] = cartesians[j]
-            mol.GetConformer().SetAtomPosition(j, Point3D(x, y, z))
-
-        return mol, energy, ani_incompatible
+                species_jobs.append(None)
+                cmin_data["coords"], cmin_data["names"], cmin_data["props"] = [], [], []
+            cmin_data["cenergy"] = [None] * len(cmin_data["coords"])
+            cache_keys_jobs[i] = [None] * len(cmin_data["coords"])
+            for j in range(len(cmin_data["coords"])):
+                # conformers optimized in previous runs are taken from the CMIN cache
+                if args.cache_cmin is not None:
+                    cache_keys_jobs[i][j] = cmin_cache_key(elements, cmin_data["coords"][j], args, partial=partial)
+                    cached = load_cmin_cache(args, cache_keys_jobs[i][j])
+                    if cached is not None:
+                        cmin_data["cenergy"][j], cmin_data["coords"][j] = cached
+                        continue
+                entries.append((len(species_jobs[i]), i, j))
+
+        # size buckets: a batch is closed when it is full or when the padding
+        # of its smallest molecule would exceed ANI_MAX_PADDING
+        batch_size = int(args.ani_batch_size)
+        batches = []
+        for entry in sorted(entries):
+            if (
+                len(batches) == 0
+                or len(batches[-1]) == batch_size
+                or entry[0] > batches[-1][0][0] * (1 + ANI_MAX_PADDING)
+            ):
+                batches.append([])
+            batches[-1].append(entry)
+
+        batch_species, batch_coords = [], []
+        for batch in batches:
+            n_atoms = batch[-1][0]
+            species = torch.full((len(batch), n_atoms), -1, dtype=torch.long, device=DEVICE)
+            coordinates = torch.zeros((len(batch), n_atoms, 3), dtype=torch.float64, device=DEVICE)
+            for k, (n_atoms_conf, i, j) in enumerate(batch):
+                species[k, :n_atoms_conf] = species_jobs[i]
+                coordinates[k, :n_atoms_conf] = torch.as_tensor(cmin_jobs[i]["coords"][j])
+            batch_species.append(species)
+            batch_coords.append(coordinates)
+
+        # the batches are spread across the worker processes of the run (see map_cmin)
+        n_batches = len(batches)
+        tasks = (
+            [args.ani_method] * n_batches,
+            batch_species,
+            batch_coords,
+            [float(args.opt_fmax)] * n_batches,
+            [int(args.opt_steps)] * n_batches,
+            [partial] * n_batches,
+        )
+        results = self.map_cmin(ani_batch_worker, *tasks)
+
+        for batch, (energies, coordinates, _) in zip(batches, results):
+            for k, (n_atoms_conf, i, j) in enumerate(batch):
+                # Hartree to kcal/mol
+                cmin_jobs[i]["cenergy"][j] = energies[k].item() * hartree_to_kcal
+                cmin_jobs[i]["coords"][j] = coordinates[k, :n_atoms_conf].numpy()
+                if args.cache_cmin is not None:
+                    save_cmin_cache(
+                        args, cache_keys_jobs[i][j], cmin_jobs[i]["cenergy"][j], cmin_jobs[i]["coords"][j]
+                    )
 
     # WRITE SDF FILES FOR xTB AND ANI1
     def write_confs(self, conformers, selectedcids, name, args, program, log):
         if len(conformers) > 0:
             write_confs = 0
             for cid in selectedcids:
-                self.sdwriter.write(conformers[cid])
+                self.sdwriter.write(conformers.to_mol(cid))
                 write_confs += 1
 
             if args.verbose:
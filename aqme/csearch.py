@@ -16,7 +16,7 @@ import concurrent.futures as futures
 import multiprocessing as mp
 from progress.bar import IncrementalBar
 from rdkit.Chem import AllChem as Chem
-from rdkit.Chem import rdmolfiles, rdMolTransforms, PropertyMol, rdDistGeom, Lipinski
+from rdkit.Chem import rdmolfiles, rdMolTransforms, rdDistGeom, Lipinski
 from aqme.filter import filters, ewin_filter, pre_E_filter, RMSD_and_E_filter
 from aqme.csearch_utils import (
     prepare_direct_smi,
@@ -29,7 +29,11 @@ from aqme.csearch_utils import (
     template_embed,
     creation_of_dup_csv_csearch,
     minimize_rdkit_energy,
-    com_2_xyz
+    get_ff_context,
+    com_2_xyz,
+    get_torsion_clash_pairs,
+    has_steric_clash,
+    torsion_vdw_energy,
 )
 from aqme.fullmonte import generating_conformations_fullmonte, realign_mol
 from aqme.utils import (
@@ -38,6 +42,9 @@ from aqme.utils import (
     load_variables,
     set_metal_atomic_number,
     getDihedralMatches,
+    set_conformer_coords,
+    ConformerEnsemble,
+    EnsembleWriter,
     smi_to_mol,
     mol_from_sdf_or_mol_or_mol2,
     get_info_input,
@@ -61,6 +68,8 @@ class csearch:
         start_time_overall = time.time()
         # load default and user-specified variables
         self.args = load_variables(kwargs, "csearch")
+        self.ensembles = None
+        self.metal_context = None
         if self.args.program.lower() not in ["rdkit", "summ", "fullmonte", "crest"]:
             self.args.log.write("\nx  Program not supported for CSEARCH conformer generation! Specify: program='rdkit' (or summ, fullmonte, crest)")
             self.args.log.finalize()
@@ -99,6 +108,78 @@ class csearch:
             # this is added to avoid path problems in jupyter notebooks
             os.chdir(self.args.initial_dir)
 
+    @classmethod
+    def from_args(cls, args):
+        """
+        Creates a CSEARCH object from loaded options without running the
+        conformer generation (used by the pipeline module)
+        """
+
+        obj = cls.__new__(cls)
+        obj.args = args
+        obj.ensembles = None
+        obj.metal_context = None
+        return obj
+
+    def get_sdwriter(self):
+        """
+        Returns the writer of the conformers of self.csearch_file. In
+        pipeline runs (see compute_ensembles), the conformers are kept in
+        memory and the SDF file is only written as a checkpoint.
+        """
+
+        if self.ensembles is None:
+            return Chem.SDWriter(str(self.csearch_file))
+
+        checkpoint = None
+        if "csearch" in self.args.checkpoints_pipeline:
+            checkpoint = self.csearch_file
+        writer = EnsembleWriter(checkpoint)
+        # a new writer of the same file replaces the previous one (i.e. SUMM
+        # writes the final conformers after the RDKit step)
+        self.ensembles[self.csearch_file.stem] = writer
+        return writer
+
+    def compute_ensembles(
+        self, smi, name, constraints_atoms, constraints_dist, constraints_angle, constraints_dihedral
+    ):
+        """
+        Runs compute_confs() keeping the final conformers in memory
+
+        Returns
+        -------
+        tuple
+            total_data, dictionary with the ConformerEnsemble of each
+            CSEARCH file name (None for files without conformers) and
+            messages written into the log by the job
+        """
+
+        self.ensembles = {}
+        total_data = self.compute_confs(
+            smi, name, constraints_atoms, constraints_dist, constraints_angle, constraints_dihedral
+        )
+        ensembles = {name_file: writer.ensemble() for name_file, writer in self.ensembles.items()}
+        self.ensembles = None
+        return total_data, ensembles, self.args.log.pop_buffer()
+
+    def compute_confs_job(
+        self, smi, name, constraints_atoms, constraints_dist, constraints_angle, constraints_dihedral
+    ):
+        """
+        Runs compute_confs() in a worker process
+
+        Returns
+        -------
+        tuple
+            total_data, messages written into the log by the job (see
+            Logger.pop_buffer)
+        """
+
+        total_data = self.compute_confs(
+            smi, name, constraints_atoms, constraints_dist, constraints_angle, constraints_dihedral
+        )
+        return total_data, self.args.log.pop_buffer()
+
     def load_jobs(self,csearch_file):
         """
         Load information of the different molecules for conformer generation
@@ -150,9 +231,11 @@ class csearch:
         with futures.ProcessPoolExecutor(
             max_workers=self.args.max_workers, mp_context=mp.get_context("spawn")
         ) as executor:
-            # Submit a set of asynchronous jobs
+            # Submit a set of asynchronous jobs (one per molecule). The bound
+            # method is sent to the workers so each job pickles a copy of
+            # this object, and the data and log messages of each molecule
+            # are returned instead of being stored in the copy
             jobs = []
-            # Submit the Jobs
             for job_input in job_inputs:
                 (
                     smi_,
@@ -163,30 +246,35 @@ class csearch:
                     constraints_dihedral_,
                 ) = job_input
                 job = executor.submit(
-                    self.compute_confs(
-                        smi_,
-                        name_,
-                        constraints_atoms_,
-                        constraints_dist_,
-                        constraints_angle_,
-                        constraints_dihedral_,
-                    )
+                    self.compute_confs_job,
+                    smi_,
+                    name_,
+                    constraints_atoms_,
+                    constraints_dist_,
+                    constraints_angle_,
+                    constraints_dihedral_,
                 )
                 jobs.append(job)
 
-            bar.next()
+            # gather the results as the jobs finish
+            total_data_jobs = {}
+            for job in futures.as_completed(jobs):
+                total_data_jobs[job] = job.result()
+                bar.next()
 
         bar.finish()
 
+        # the data and log messages are stored following the order of the inputs
+        for job in jobs:
+            self.args.log.write_buffer(total_data_jobs[job][1])
+        frames = [self.final_dup_data] + [total_data_jobs[job][0] for job in jobs]
+        self.final_dup_data = pd.concat(frames, ignore_index=True, sort=True)
+
         # removing temporary files
         temp_files = [
             "gfn2.out",
-            "xTB_opt.traj",
-            "ANI1_opt.traj",
             "wbo",
             "xtbrestart",
-            "ase.opt",
-            "xtb.opt",
             "gfnff_topo",
         ]
         for file in temp_files:
@@ -239,17 +327,11 @@ class csearch:
         if self.args.verbose:
             self.args.log.write(f"\n   -> Input Molecule {Chem.MolToSmiles(mol)}")
 
+        # the metal atoms of the molecule are detected once and stored in an
+        # immutable context that is used by all the steps of the molecule
+        self.metal_context = None
         if self.args.metal_complex:
-            for _ in self.args.metal_atoms:
-                self.args.metal_idx.append(None)
-                self.args.complex_coord.append(None)
-                self.args.metal_sym.append(None)
-
-            (
-                self.args.metal_idx,
-                self.args.complex_coord,
-                self.args.metal_sym,
-            ) = substituted_mol(self, mol, "I")
+            self.metal_context = substituted_mol(mol, self.args, "I")
 
             # get pre-determined geometries for metal complexes
             accepted_complex_types = [
@@ -259,14 +341,10 @@ class csearch:
                 "trigonalplanar",
             ]
             if self.args.complex_type in accepted_complex_types:
-                count_metals = 0
-                for metal_idx_ind in self.args.metal_idx:
-                    if metal_idx_ind is not None:
-                        count_metals += 1
-                if count_metals == 1:
+                if self.metal_context.n_metals() == 1:
                     template_kwargs = dict()
                     template_kwargs["complex_type"] = self.args.complex_type
-                    template_kwargs["metal_idx"] = self.args.metal_idx
+                    template_kwargs["metal_idx"] = list(self.metal_context.metal_idx)
                     template_kwargs["maxsteps"] = self.args.opt_steps_rdkit
                     template_kwargs["heavyonly"] = self.args.heavyonly
                     template_kwargs["maxmatches"] = self.args.max_matches_rmsd
@@ -299,9 +377,8 @@ class csearch:
         else:
             total_data = self.conformer_generation(mol, name, constraints_atoms, constraints_dist, constraints_angle, constraints_dihedral)
 
-        # Updates the dataframe with infromation about conformer generation
-        frames = [self.final_dup_data, total_data]
-        self.final_dup_data = pd.concat(frames, ignore_index=True, sort=True)
+        # returns the dataframe with infromation about conformer generation
+        return total_data
 
     def conformer_generation(
         self, mol, name, constraints_atoms, constraints_dist, constraints_angle, constraints_dihedral,
@@ -359,7 +436,7 @@ class csearch:
         else:
             name = name.replace('/','\\').split("\\")[-1].split('.')[0]
             self.csearch_file = self.csearch_folder.joinpath(name + "_" + self.args.program + self.args.output)
-            self.sdwriter = Chem.SDWriter(str(self.csearch_file))
+            self.sdwriter = self.get_sdwriter()
 
             valid_structure = filters(mol, self.args.log, self.args.max_mol_wt, self.args.verbose)
             if valid_structure:
@@ -446,23 +523,22 @@ class csearch:
         Filtering after dihedral scan to sdf
         """
 
-        rotated_energy = []
-
-        rdmols = Chem.SDMolSupplier(str(self.csearch_file), removeHs=False)
-
-        if rdmols is None:
-            self.args.log.write("\nCould not open " + name + self.args.output)
-            self.args.log.finalize()
-            sys.exit()
+        # the rotamers are stored in memory (self.summ_coords) using the
+        # topology of the RDKit conformers (self.summ_mol)
+        rd_mol = Chem.Mol(self.summ_mol)
+        rd_mol.RemoveAllConformers()
+        rd_mol.AddConformer(Chem.Conformer(self.summ_mol.GetNumAtoms()), assignId=True)
 
-        for i, rd_mol_i in enumerate(rdmols):
+        rotated_energy = []
+        for coords in self.summ_coords:
+            set_conformer_coords(rd_mol.GetConformer(), coords)
             if coord_Map is None and alg_Map is None and mol_template is None:
                 energy = minimize_rdkit_energy(
-                    rd_mol_i, -1, self.args.log, ff, self.args.opt_steps_rdkit
+                    rd_mol, -1, self.args.log, ff, self.args.opt_steps_rdkit
                 )
             else:
-                rd_mol_i, energy = realign_mol(
-                    rd_mol_i,
+                rd_mol, energy = realign_mol(
+                    rd_mol,
                     -1,
                     coord_Map,
                     alg_Map,
@@ -471,7 +547,7 @@ class csearch:
                 )
             rotated_energy.append(energy)
 
-        rotated_cids = list(range(len(rdmols)))
+        rotated_cids = list(range(len(self.summ_coords)))
         sorted_rotated_cids = sorted(rotated_cids, key=lambda cid: rotated_energy[cid])
 
         # filter based on energy window ewin_csearch
@@ -497,8 +573,11 @@ class csearch:
             self.args.verbose,
         )
         # filter based on energy and RMSD
+        rotated_mols = ConformerEnsemble(
+            self.summ_mol, self.summ_coords, rotated_energy, self.summ_names
+        )
         selectedcids_rotated = RMSD_and_E_filter(
-            rdmols,
+            rotated_mols,
             selectedcids_initial_rotated,
             rotated_energy,
             self.args,
@@ -508,18 +587,16 @@ class csearch:
             "summ",
         )
 
-        os.remove(self.csearch_file)
-        sdwriter_rd = Chem.SDWriter(str(self.csearch_file))
+        # only the final set of conformers is written
+        sdwriter_rd = self.get_sdwriter()
         for i, cid in enumerate(selectedcids_rotated):
-            mol_rd = Chem.RWMol(rdmols[cid])
-            mol_rd.SetProp("_Name", rdmols[cid].GetProp("_Name") + " " + str(i))
+            mol_rd = Chem.RWMol(rotated_mols.to_mol(cid))
+            mol_rd.SetProp("_Name", self.summ_names[cid] + " " + str(i))
             mol_rd.SetProp("Energy", str(rotated_energy[cid]))
-            if self.args.metal_complex:
-                set_metal_atomic_number(
-                    mol_rd, self.args.metal_idx, self.args.metal_sym
-                )
+            set_metal_atomic_number(mol_rd, self.metal_context)
             sdwriter_rd.write(mol_rd)
         sdwriter_rd.close()
+        self.summ_mol, self.summ_coords, self.summ_names = None, [], []
         status = 1
         return status
 
@@ -528,11 +605,10 @@ class csearch:
         Detects automatically the initial number of conformers for the sampling
         """
 
-        if self.args.metal_complex:
-            if len(self.args.metal_idx) > 0:
-                self.args.auto_sample = (
-                    self.args.auto_sample * 3 * len(self.args.metal_idx)
-                )  # this accounts for possible trans/cis isomers in metal complexes
+        auto_sample = self.args.auto_sample
+        if self.metal_context is not None and self.metal_context.n_metals() > 0:
+            # this accounts for possible trans/cis isomers in metal complexes
+            auto_sample = auto_sample * 3 * self.metal_context.n_metals()
         auto_samples = 0
         auto_samples += 3 * (Lipinski.NumRotatableBonds(mol))  # x3, for C3 rotations
         auto_samples += 3 * (Lipinski.NHOHCount(mol))  # x3, for OH/NH rotations
@@ -540,9 +616,9 @@ class csearch:
             Lipinski.NumSaturatedRings(mol)
         )  # x3, for boat/chair/envelope confs
         if auto_samples == 0:
-            auto_samples = self.args.auto_sample
+            auto_samples = auto_sample
         else:
-            auto_samples = self.args.auto_sample * auto_samples
+            auto_samples = auto_sample * auto_samples
         return auto_samples
 
     def genConformer_r(
@@ -557,10 +633,12 @@ class csearch:
         coord_Map,
         alg_Map,
         mol_template,
+        e_partial=0.0,
     ):
         """
         If program = RDKit, this replaces iodine back to the metal (for metal_complex = True)
-        and writes the RDKit SDF files. With program = summ, this function optimizes rotamers
+        and writes the RDKit SDF files. With program = summ, this function optimizes rotamers.
+        e_partial is the repulsive van der Waals energy of the torsions set so far (used with ebound_summ)
         """
 
         if i >= len(matches):  # base case, torsions should be set in conf
@@ -586,11 +664,16 @@ class csearch:
                         self.args.opt_steps_rdkit,
                     )
                 mol.SetProp("Energy", str(energy))
-                set_metal_atomic_number(mol, self.args.metal_idx, self.args.metal_sym)
-            try:
-                sdwriter.write(mol, conf)
-            except:
-                pass
+                set_metal_atomic_number(mol, self.metal_context)
+            if self.args.program == "summ" and not update_to_rdkit:
+                # SUMM rotamers are kept in memory until they are filtered
+                self.summ_coords.append(mol.GetConformer(conf).GetPositions())
+                self.summ_names.append(name)
+            else:
+                try:
+                    sdwriter.write(mol, conf)
+                except:
+                    pass
 
             return 1
 
@@ -601,6 +684,25 @@ class csearch:
             rdMolTransforms.SetDihedralRad(
                 mol.GetConformer(conf), *matches[i], value=rad
             )
+            # branch and bound: if the torsions set so far create a steric
+            # clash or exceed the energy bound, all the conformers of this
+            # branch are discarded
+            e_branch = e_partial
+            if self.summ_clash_pairs:
+                n_branch = int(
+                    (math.ceil(360.0 / self.args.degree)) ** (len(matches) - i - 1)
+                )
+                coords = mol.GetConformer(conf).GetPositions()
+                if has_steric_clash(coords, self.summ_clash_pairs[i]):
+                    self.summ_pruned += n_branch
+                    deg += self.args.degree
+                    continue
+                if float(self.args.ebound_summ) > 0:
+                    e_branch += torsion_vdw_energy(coords, self.summ_clash_pairs[i])
+                    if e_branch > float(self.args.ebound_summ):
+                        self.summ_pruned_energy += n_branch
+                        deg += self.args.degree
+                        continue
             mol.SetProp("_Name", name)
             total += self.genConformer_r(
                 mol,
@@ -613,6 +715,7 @@ class csearch:
                 coord_Map,
                 alg_Map,
                 mol_template,
+                e_branch,
             )
             deg += self.args.degree
         return total
@@ -660,13 +763,22 @@ class csearch:
         Minimization and E calculation with RDKit after embeding
         """
 
-        cenergy, outmols = [], []
+        cenergy = []
+
+        if coord_Map is None and alg_Map is None and mol_template is None:
+            # all the conformers are minimized in one threaded batch, sharing
+            # the cores with the other CSEARCH workers
+            num_threads = max(1, (os.cpu_count() or 1) // int(self.args.max_workers))
+            energies = get_ff_context(mol, self.args.log, ff).minimize_confs(
+                mol, self.args.opt_steps_rdkit, num_threads
+            )
+            conf_energy = dict(
+                zip([conformer.GetId() for conformer in mol.GetConformers()], energies)
+            )
 
         for _, conf in enumerate(cids):
             if coord_Map is None and alg_Map is None and mol_template is None:
-                energy = minimize_rdkit_energy(
-                    mol, conf, self.args.log, ff, self.args.opt_steps_rdkit
-                )
+                energy = conf_energy[conf]
             else:  # id template realign before doing calculations
                 mol, energy = realign_mol(
                     mol,
@@ -677,8 +789,10 @@ class csearch:
                     self.args.opt_steps_rdkit,
                 )
             cenergy.append(energy)
-            pmol = PropertyMol.PropertyMol(mol)
-            outmols.append(pmol)
+
+        # the optimized conformers share the topology of mol
+        outmols = ConformerEnsemble.from_mol(mol, list(cids))
+        outmols.energies[:] = cenergy
 
         return outmols, cenergy
 
@@ -713,10 +827,10 @@ class csearch:
         dup_data.at[dup_data_idx, "Overall charge"] = charge
 
         for i, cid in enumerate(cids):
-            outmols[cid].SetProp("_Name", name + " " + str(i + 1))
-            outmols[cid].SetProp("Energy", str(cenergy[cid]))
-            outmols[cid].SetProp("Real charge", str(charge))
-            outmols[cid].SetProp("Mult", str(mult))
+            outmols.names[cid] = name + " " + str(i + 1)
+            outmols.set_prop(cid, "Energy", cenergy[cid])
+            outmols.set_prop(cid, "Real charge", charge)
+            outmols.set_prop(cid, "Mult", mult)
 
         # sorts the energies
         cids = list(range(len(outmols)))
@@ -771,20 +885,30 @@ class csearch:
                 )
 
             total = 0
+            self.summ_mol, self.summ_coords, self.summ_names = None, [], []
+            # heavy-atom pairs used to prune rotamers with steric clashes
+            self.summ_pruned, self.summ_pruned_energy, self.summ_clash_pairs = 0, 0, []
+            if self.args.program == "summ" and len(rotmatches) != 0:
+                self.summ_clash_pairs = get_torsion_clash_pairs(
+                    mol, rotmatches, float(self.args.clash_summ), float(self.args.ebound_summ)
+                )
             for conf in selectedcids_rdkit:
+                mol_conf = outmols.to_mol(conf)
                 if self.args.program == "summ" and not update_to_rdkit:
-                    sdwriter.write(outmols[conf], conf)
+                    self.summ_mol = mol_conf
+                    self.summ_coords.append(outmols.coords[conf].copy())
+                    self.summ_names.append(outmols.names[conf])
                     for m in rotmatches:
                         rdMolTransforms.SetDihedralDeg(
-                            outmols[conf].GetConformer(conf), *m, 180.0
+                            mol_conf.GetConformer(), *m, 180.0
                         )
                 total += self.genConformer_r(
-                    outmols[conf],
-                    conf,
+                    mol_conf,
+                    -1,
                     0,
                     rotmatches,
                     sdwriter,
-                    outmols[conf].GetProp("_Name"),
+                    outmols.names[conf],
                     update_to_rdkit,
                     coord_Map,
                     alg_Map,
@@ -793,6 +917,14 @@ class csearch:
 
             if self.args.verbose and len(rotmatches) != 0:
                 self.args.log.write("\no  %d total conformations generated" % total)
+                if self.summ_pruned > 0:
+                    self.args.log.write(
+                        f"\no  {self.summ_pruned} conformations discarded due to steric clashes"
+                    )
+                if self.summ_pruned_energy > 0:
+                    self.args.log.write(
+                        f"\no  {self.summ_pruned_energy} conformations discarded by the energy bound (E > {self.args.ebound_summ} kcal/mol)"
+                    )
             status = 1
 
         if self.args.program == "summ":
@@ -812,9 +944,8 @@ class csearch:
                 alg_Map,
                 mol_template,
                 ff,
+                self.metal_context,
             )
-            # removes the rdkit file
-            os.remove(name + "_" + "rdkit" + self.args.output)
 
         return status
 
@@ -846,7 +977,7 @@ class csearch:
             if not self.args.metal_complex:
                 charge = Chem.GetFormalCharge(mol)
             else:
-                charge = rules_get_charge(mol, self.args, "csearch")
+                charge = rules_get_charge(mol, self.metal_context, "csearch")
         else:
             charge = self.args.charge
         if self.args.mult is None:
@@ -8,11 +8,14 @@ import subprocess
 from pathlib import Path
 from pkg_resources import resource_filename
 import pandas as pd
+import numpy as np
 from rdkit.Chem import AllChem as Chem
 from rdkit.Chem import rdDistGeom, rdMolAlign
 from aqme.utils import (
 	get_info_input,
-	get_conf_RMS,
+	get_rmsd_context,
+	mol_topology_key,
+	set_conformer_coords,
 	mol_from_sdf_or_mol_or_mol2)
 
 TEMPLATES_PATH = Path(resource_filename("aqme", "templates"))
@@ -184,11 +187,13 @@ def filter_template_mol(molecule_new, mol_objects, heavyonly, max_matches):
 	if not mol_objects:
 		return True
 
-	# check if molecule also exixts in the mol_objects
-	for mol in mol_objects:
-		rms = get_conf_RMS(mol, molecule_new, -1, -1, heavyonly, max_matches)
-		if rms < 0.5:
-			return False
+	# check if molecule also exixts in the mol_objects (all the RMSD
+	# calculations share the same topology)
+	rms_context = get_rmsd_context(molecule_new, heavyonly, max_matches)
+	xyz_mols = np.array([rms_context.coords(mol) for mol in mol_objects])
+	rms = rms_context.rms_batch(rms_context.coords(molecule_new), xyz_mols, inverse=True)
+	if (rms < 0.5).any():
+		return False
 	return True
 
 
@@ -710,26 +715,272 @@ def com_2_xyz(input_file):
 	return f"{filename}.xyz", charge, mult
 
 
+class ForceFieldContext:
+	"""
+	Class that stores the force field of a topology. The MMFF typing and the
+	force field setup are only done once, and the conformers are minimized by
+	copying their coordinates into the conformer used by the force field.
+
+	Parameters
+	----------
+	mol : rdkit.Chem.Mol
+			Molecule that defines the topology of the conformers
+	log : Logger
+			Logger used if the force field is not supported
+	FF : str
+			Force field used (MMFF or UFF). If MMFF fails, UFF is used
+	"""
+
+	def __init__(self, mol, log, FF):
+		# the force field keeps pointers to the coordinates of this conformer
+		self.mol = Chem.Mol(mol)
+		self.mol.RemoveAllConformers()
+		self.mol.AddConformer(Chem.Conformer(mol.GetNumAtoms()), assignId=True)
+		if mol.GetNumConformers() > 0:
+			set_conformer_coords(self.mol.GetConformer(), mol.GetConformer().GetPositions())
+
+		self.ff, self.properties, forcefield = FF, None, None
+		if FF == "MMFF":
+			self.properties = Chem.MMFFGetMoleculeProperties(self.mol)
+			if self.properties is not None:
+				forcefield = Chem.MMFFGetMoleculeForceField(self.mol, self.properties)
+
+		if FF == "UFF" or forcefield is None:
+			# if forcefield is None means that MMFF will not work. Attempt UFF.
+			self.properties = None
+			forcefield = Chem.UFFGetMoleculeForceField(self.mol)
+
+		if FF not in ["MMFF", "UFF"] or forcefield is None:
+			log.write(f" Force field {FF} not supported!")
+			log.finalize()
+			sys.exit()
+
+		forcefield.Initialize()
+		self.forcefield = forcefield
+
+	def minimize(self, mol, conf, maxsteps):
+		"""
+		Minimizes a conformer of mol (its coordinates are updated) and returns
+		the final energy
+		"""
+
+		conformer = mol.GetConformer(conf)
+		set_conformer_coords(self.mol.GetConformer(), conformer.GetPositions())
+		self.forcefield.Minimize(maxIts=maxsteps)
+		set_conformer_coords(conformer, self.mol.GetConformer().GetPositions())
+
+		return float(self.forcefield.CalcEnergy())
+
+	def minimize_confs(self, mol, maxsteps, num_threads):
+		"""
+		Minimizes all the conformers of mol in a threaded batch and returns
+		their final energies (in the order of mol.GetConformers())
+		"""
+
+		if self.properties is not None:
+			results = Chem.MMFFOptimizeMoleculeConfs(
+				mol, numThreads=num_threads, maxIters=maxsteps
+			)
+		else:
+			results = Chem.UFFOptimizeMoleculeConfs(
+				mol, numThreads=num_threads, maxIters=maxsteps
+			)
+
+		return [float(energy) for _, energy in results]
+
+
+# force field contexts stored per topology (see get_ff_context)
+FF_CONTEXTS = {}
+MAX_FF_CONTEXTS = 100
+
+
+def get_ff_context(mol, log, FF):
+	"""
+	Returns the ForceFieldContext of the topology of mol, creating it only the
+	first time that the topology is found.
+
+	Parameters
+	----------
+	mol : rdkit.Chem.Mol
+			Molecule that defines the topology of the conformers
+	log : Logger
+			Logger used if the force field is not supported
+	FF : str
+			Force field used (MMFF or UFF)
+
+	Returns
+	-------
+	ForceFieldContext
+	"""
+
+	key = (mol_topology_key(mol), FF)
+	if key not in FF_CONTEXTS:
+		if len(FF_CONTEXTS) >= MAX_FF_CONTEXTS:
+			# remove the oldest context
+			FF_CONTEXTS.pop(next(iter(FF_CONTEXTS)))
+		FF_CONTEXTS[key] = ForceFieldContext(mol, log, FF)
+	return FF_CONTEXTS[key]
+
+
 def minimize_rdkit_energy(mol, conf, log, FF, maxsteps):
 	"""
-	Minimizes a conformer of a molecule and returns the final energy.
+	Minimizes a conformer of a molecule and returns the final energy. The
+	force field is reused from get_ff_context().
 	"""
 
-	if FF == "MMFF":
-		properties = Chem.MMFFGetMoleculeProperties(mol)
-		forcefield = Chem.MMFFGetMoleculeForceField(mol, properties, confId=conf)
+	return get_ff_context(mol, log, FF).minimize(mol, conf, maxsteps)
 
-	if FF == "UFF" or forcefield is None:
-		# if forcefield is None means that MMFF will not work. Attempt UFF.
-		forcefield = Chem.UFFGetMoleculeForceField(mol, confId=conf)
 
-	if FF not in ["MMFF", "UFF"] or forcefield is None:
-		log.write(f" Force field {FF} not supported!")
-		log.finalize()
-		sys.exit()
+def get_torsion_clash_pairs(mol, matches, clash_frac, ebound=0):
+	"""
+	Prepares the heavy-atom pairs used to detect steric clashes during the
+	systematic rotation of the torsions in SUMM. The molecule is split into
+	rigid fragments connected by the rotatable bonds, and each pair of heavy
+	atoms is assigned to the last torsion (index in matches) that changes
+	their distance. Therefore, the distances of the pairs of level i are fixed
+	once torsions 0 to i are set.
 
-	forcefield.Initialize()
-	forcefield.Minimize(maxIts=maxsteps)
-	energy = float(forcefield.CalcEnergy())
+	Parameters
+	----------
+	mol : rdkit.Chem.Mol
+			Molecule used in the systematic search
+	matches : list
+			Torsions rotated, as tuples of 4 atom indices
+	clash_frac : float
+			Two heavy atoms clash when their distance is lower than this
+			fraction of the sum of their van der Waals radii
+	ebound : float
+			If higher than 0, the UFF van der Waals parameters of the pairs are
+			included for the energy bound (see torsion_vdw_energy())
+
+	Returns
+	-------
+	list
+			For each torsion, a tuple (idx_a, idx_b, min_dist2, x_ij, d_ij) with
+			the atoms of the pairs, the squared minimum distances allowed and
+			the UFF van der Waals distances and well depths
+	"""
+
+	n_atoms = mol.GetNumAtoms()
+	clash_pairs = [
+		(np.zeros(0, dtype=int), np.zeros(0, dtype=int), np.zeros(0), np.zeros(0), np.zeros(0)) for _ in matches
+	]
+	if (clash_frac <= 0 and ebound <= 0) or len(matches) == 0:
+		return clash_pairs
+	# metal complexes might not have UFF parameters, the energy bound is off for them
+	use_vdw = ebound > 0 and Chem.UFFHasAllMoleculeParams(mol)
+
+	# rigid fragments (rotatable bonds removed)
+	fragment = list(range(n_atoms))
+	def find_fragment(idx):
+		while fragment[idx] != idx:
+			fragment[idx] = fragment[fragment[idx]]
+			idx = fragment[idx]
+		return idx
+	rot_bonds = {frozenset(match[1:3]) for match in matches}
+	for bond in mol.GetBonds():
+		atoms_bond = (bond.GetBeginAtomIdx(), bond.GetEndAtomIdx())
+		if frozenset(atoms_bond) not in rot_bonds:
+			fragment[find_fragment(atoms_bond[0])] = find_fragment(atoms_bond[1])
+	fragment = [find_fragment(idx) for idx in range(n_atoms)]
+
+	# the fragments form a tree, so the highest torsion index between two
+	# fragments is obtained from a search starting at every fragment
+	tree = {}
+	for i, match in enumerate(matches):
+		frag_1, frag_2 = fragment[match[1]], fragment[match[2]]
+		tree.setdefault(frag_1, []).append((frag_2, i))
+		tree.setdefault(frag_2, []).append((frag_1, i))
+	max_torsion = {}
+	for frag_start in tree:
+		max_torsion[frag_start] = {frag_start: -1}
+		stack = [frag_start]
+		while stack:
+			frag = stack.pop()
+			for frag_next, i in tree[frag]:
+				if frag_next not in max_torsion[frag_start]:
+					max_torsion[frag_start][frag_next] = max(max_torsion[frag_start][frag], i)
+					stack.append(frag_next)
+
+	# pairs of heavy atoms separated by more than 3 bonds
+	topo_dist = Chem.GetDistanceMatrix(mol)
+	periodic_table = Chem.GetPeriodicTable()
+	heavy_atoms = [atom.GetIdx() for atom in mol.GetAtoms() if atom.GetAtomicNum() > 1]
+	pairs_level = [[] for _ in matches]
+	for n, idx_a in enumerate(heavy_atoms):
+		for idx_b in heavy_atoms[n + 1:]:
+			if topo_dist[idx_a][idx_b] < 4:
+				continue
+			level = max_torsion.get(fragment[idx_a], {}).get(fragment[idx_b], -1)
+			if level >= 0:
+				min_dist = max(clash_frac, 0) * (
+					periodic_table.GetRvdw(mol.GetAtomWithIdx(idx_a).GetAtomicNum())
+					+ periodic_table.GetRvdw(mol.GetAtomWithIdx(idx_b).GetAtomicNum())
+				)
+				vdw_params = None
+				if use_vdw:
+					vdw_params = Chem.GetUFFVdWParams(mol, idx_a, idx_b)
+				x_ij, d_ij = vdw_params if vdw_params is not None else (1.0, 0.0)
+				pairs_level[level].append((idx_a, idx_b, min_dist**2, x_ij, d_ij))
+
+	for level, pairs in enumerate(pairs_level):
+		if len(pairs) > 0:
+			pairs = np.array(pairs)
+			clash_pairs[level] = (pairs[:, 0].astype(int), pairs[:, 1].astype(int), pairs[:, 2], pairs[:, 3], pairs[:, 4])
+
+	return clash_pairs
+
+
+def has_steric_clash(coords, clash_pairs_level):
+	"""
+	Vectorized check of the heavy-atom distances of one level of the pairs
+	from get_torsion_clash_pairs().
+
+	Parameters
+	----------
+	coords : numpy.array
+			Coordinates of the conformer, shape (n_atoms, 3)
+	clash_pairs_level : tuple
+			(idx_a, idx_b, min_dist2) arrays of the level checked
+
+	Returns
+	-------
+	bool
+			True if any pair of atoms is closer than the minimum distance
+	"""
+
+	idx_a, idx_b, min_dist2 = clash_pairs_level[:3]
+	if len(idx_a) == 0:
+		return False
+	dist2 = ((coords[idx_a] - coords[idx_b]) ** 2).sum(axis=1)
+	return bool((dist2 < min_dist2).any())
+
+
+def torsion_vdw_energy(coords, clash_pairs_level):
+	"""
+	Repulsive UFF van der Waals energy (kcal/mol) of one level of the pairs
+	from get_torsion_clash_pairs(). Only the positive (repulsive) part of each
+	pair is added, so the sum over the levels set so far can only grow when
+	more torsions are set and it's a lower bound for the repulsion of all the
+	rotamers of the branch.
+
+	Parameters
+	----------
+	coords : numpy.array
+			Coordinates of the conformer, shape (n_atoms, 3)
+	clash_pairs_level : tuple
+			(idx_a, idx_b, min_dist2, x_ij, d_ij) arrays of the level checked
+
+	Returns
+	-------
+	float
+			Repulsive van der Waals energy of the pairs
+	"""
 
-	return energy
+	idx_a, idx_b, _, x_ij, d_ij = clash_pairs_level
+	if len(idx_a) == 0:
+		return 0.0
+	dist = np.sqrt(((coords[idx_a] - coords[idx_b]) ** 2).sum(axis=1))
+	ratio6 = (x_ij / dist) ** 6
+	energies = d_ij * (ratio6**2 - 2 * ratio6)
+	return float(np.clip(energies, 0, None).sum())
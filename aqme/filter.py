@@ -2,12 +2,14 @@
 #        This file stores all the functions         #
 #             used for filtering                    #
 #####################################################.
+import bisect
 from functools import partial
 
+import numpy as np
 from rdkit.Chem import AllChem as Chem
 from rdkit.Chem import rdMolTransforms, Descriptors
 
-from aqme.utils import periodic_table, get_conf_RMS
+from aqme.utils import periodic_table, get_rmsd_context
 
 # Aux functions for passes_Ir_bidentate_x3_rule
 def is_carbene_like(neighbours):
@@ -351,6 +353,152 @@ def filters(mol, log, molwt_cutoff, verbose):
     return True
 
 
+def ewin_sweep(energies, energy_window):
+    """
+    Energy window kernel used in ewin_filter(). The first energy of the array
+    is used as reference (energies sorted from lowest to highest).
+
+    Parameters
+    ----------
+    energies : numpy.array
+            Energies of the conformers (kcal/mol), sorted
+    energy_window : float
+            Maximum energy difference with respect to the lowest conformer
+
+    Returns
+    -------
+    numpy.array
+            Boolean mask with the conformers inside the energy window
+    """
+
+    energies = np.asarray(energies, dtype=float)
+    if len(energies) == 0:
+        return np.zeros(0, dtype=bool)
+    return np.abs(energies - energies[0]) < energy_window
+
+
+def pre_E_sweep(energies, threshold):
+    """
+    Energy duplicate kernel used in pre_E_filter(). A conformer is accepted
+    when its energy difference with all the previously accepted conformers is
+    higher or equal to the threshold. For sorted energies, only the nearest
+    accepted conformer needs to be checked, so the next accepted conformer is
+    located with a binary search (n log n). Unsorted energies are compared
+    against the neighbours of a sorted list of accepted energies.
+
+    Parameters
+    ----------
+    energies : numpy.array
+            Energies of the conformers (kcal/mol)
+    threshold : float
+            Minimum energy difference to consider two conformers as different.
+
+    Returns
+    -------
+    numpy.array
+            Boolean mask with the accepted conformers
+    """
+
+    energies = np.asarray(energies, dtype=float)
+    n_confs = len(energies)
+    mask = np.zeros(n_confs, dtype=bool)
+    if n_confs == 0:
+        return mask
+
+    if np.all(np.diff(energies) >= 0):
+        idx = 0
+        while idx < n_confs:
+            mask[idx] = True
+            # first conformer outside the threshold of the accepted one
+            next_idx = int(np.searchsorted(energies, energies[idx] + threshold, side="left"))
+            next_idx = max(next_idx, idx + 1)
+            while next_idx - 1 > idx and abs(energies[next_idx - 1] - energies[idx]) >= threshold:
+                next_idx -= 1
+            while next_idx < n_confs and abs(energies[next_idx] - energies[idx]) < threshold:
+                next_idx += 1
+            idx = next_idx
+    else:
+        seen_energies = []
+        for idx, energy in enumerate(energies):
+            pos = bisect.bisect_left(seen_energies, energy)
+            neighbours = seen_energies[max(pos - 1, 0):pos + 1]
+            if not any(abs(energy - seen) < threshold for seen in neighbours):
+                mask[idx] = True
+                seen_energies.insert(pos, energy)
+
+    return mask
+
+
+def ewin_filter_batch(energy_arrays, energy_window):
+    """
+    Batched version of the energy window filter for many molecules at once.
+    All the energies are sorted in a single call and the lowest energy of
+    each molecule is obtained with a segmented reduction.
+
+    Parameters
+    ----------
+    energy_arrays : list
+            List of arrays with the energies (kcal/mol) of each molecule
+    energy_window : float
+            Maximum energy difference with respect to the lowest conformer
+
+    Returns
+    -------
+    list
+            For each molecule, array with the indices of the accepted
+            conformers sorted by energy
+    """
+
+    sizes = np.array([len(energy_array) for energy_array in energy_arrays], dtype=int)
+    if sizes.sum() == 0:
+        return [np.zeros(0, dtype=int) for _ in energy_arrays]
+    energies = np.concatenate([np.asarray(energy_array, dtype=float) for energy_array in energy_arrays])
+    segments = np.repeat(np.arange(len(sizes)), sizes)
+    local_idx = np.arange(len(energies)) - np.repeat(np.cumsum(sizes) - sizes, sizes)
+
+    # sort by molecule first and by energy second
+    order = np.lexsort((energies, segments))
+    energies, segments, local_idx = energies[order], segments[order], local_idx[order]
+    starts = np.cumsum(sizes) - sizes
+    energies_min = np.zeros(len(sizes))
+    energies_min[sizes > 0] = energies[starts[sizes > 0]]
+
+    mask = np.abs(energies - energies_min[segments]) < energy_window
+    return [local_idx[mask & (segments == i)] for i in range(len(sizes))]
+
+
+def pre_E_filter_batch(energy_arrays, threshold, energy_window=None):
+    """
+    Batched version of the energy duplicate filter for many molecules at once.
+
+    Parameters
+    ----------
+    energy_arrays : list
+            List of arrays with the energies (kcal/mol) of each molecule
+    threshold : float
+            Minimum energy difference to consider two conformers as different.
+    energy_window : float
+            If specified, the energy window filter is applied first
+
+    Returns
+    -------
+    list
+            For each molecule, array with the indices of the accepted
+            conformers sorted by energy
+    """
+
+    if energy_window is not None:
+        sorted_idx = ewin_filter_batch(energy_arrays, energy_window)
+    else:
+        sorted_idx = [np.argsort(energy_array, kind="stable") for energy_array in energy_arrays]
+
+    selected_idx = []
+    for energy_array, idx_mol in zip(energy_arrays, sorted_idx):
+        energies = np.asarray(energy_array, dtype=float)[idx_mol]
+        selected_idx.append(idx_mol[pre_E_sweep(energies, threshold)])
+    return selected_idx
+
+
 def ewin_filter(
     sorted_all_cids,
     cenergy,
@@ -395,16 +543,11 @@ def ewin_filter(
     """
     verbose = args.verbose
 
-    sortedcids = []
-    count = 0
-
-    cenergy_min = cenergy[sorted_all_cids[0]]
     # Filter by Energy Window
-    for cid in sorted_all_cids:
-        if abs(cenergy[cid] - cenergy_min) < energy_window:
-            sortedcids.append(cid)
-        else:
-            count += 1
+    energies = np.array([cenergy[cid] for cid in sorted_all_cids], dtype=float)
+    mask_ewin = ewin_sweep(energies, energy_window)
+    sortedcids = [cid for cid, keep in zip(sorted_all_cids, mask_ewin) if keep]
+    count = len(sorted_all_cids) - len(sortedcids)
 
     log_msg = ""
     if calc_type == "rdkit":
@@ -460,23 +603,10 @@ def pre_E_filter(
     list
             list of accepted compound Ids
     """
-    selectedcids_initial = []
-    eng_dup = 0
-
-    # Add the first one
-    selectedcids_initial.append(sortedcids[0])
-    for conf in sortedcids[1:]:
-        is_unique = True
-        # check rmsd
-        for seenconf in selectedcids_initial:
-            E_diff = abs(cenergy[conf] - cenergy[seenconf])  # in kcal/mol
-            if E_diff < threshold:
-                eng_dup += 1
-                is_unique = False
-                break
-        if is_unique:
-            if conf not in selectedcids_initial:
-                selectedcids_initial.append(conf)
+    energies = np.array([cenergy[conf] for conf in sortedcids], dtype=float)
+    mask_unique = pre_E_sweep(energies, threshold)
+    selectedcids_initial = [conf for conf, keep in zip(sortedcids, mask_unique) if keep]
+    eng_dup = len(sortedcids) - len(selectedcids_initial)
 
     if verbose:
         log.write(
@@ -506,7 +636,8 @@ def RMSD_and_E_filter(
     """
     This filter selects the first compound that it finds with energy an energy
     difference lower than the threshold with a higher than the threshold rms
-    with respect to the nearest (in energy) accepted compound.
+    with respect to the nearest (in energy) accepted compound. outmols is the
+    ConformerEnsemble with the coordinates of the conformers.
     """
     rms_threshold = args.rms_threshold
     energy_threshold = args.energy_threshold
@@ -524,46 +655,47 @@ def RMSD_and_E_filter(
         )
     # bar = IncrementalBar('o  Filtering based on energy and RMSD', max = len(selectedcids_initial))
 
-    selectedcids = []
+    # coordinates of the conformers from the ensemble, using the same atoms
+    # and symmetry permutations as get_conf_RMS()
+    rms_context = get_rmsd_context(
+        outmols.mol, args.heavyonly, args.max_matches_rmsd
+    )
+    coords = outmols.coords[selectedcids_initial][:, rms_context.atom_idx]
+    # the accepted conformer is the probe in get_conf_RMS() for rdkit
+    inverse = calc_type == "rdkit"
+
+    # accepted conformers sorted by energy, so only the conformers inside the
+    # energy_threshold window are compared (bisect)
+    selectedcids = [selectedcids_initial[0]]
+    selectedcids_set = {selectedcids_initial[0]}
+    seen_energies = [cenergy[selectedcids_initial[0]]]
+    seen_coords_idx = [0]
     eng_rms_dup = 0
-    selectedcids.append(selectedcids_initial[0])
 
-    for _,conf in enumerate(selectedcids_initial[1:]):
-        # This keeps track of whether or not your conformer is unique
+    for i, conf in enumerate(selectedcids_initial[1:], start=1):
+        energy = cenergy[conf]
+        low = bisect.bisect_left(seen_energies, energy - energy_threshold)
+        high = bisect.bisect_right(seen_energies, energy + energy_threshold)
+        window_idx = [
+            seen_coords_idx[j]
+            for j in range(low, high)
+            if abs(energy - seen_energies[j]) < energy_threshold
+        ]
+
         excluded_conf = False
+        if len(window_idx) > 0:
+            rms = rms_context.rms_batch(coords[i], coords[window_idx], inverse)
+            if (rms < rms_threshold).any():
+                excluded_conf = True
+                eng_rms_dup += 1
 
-        # check energy and rmsd
-        for seenconf in selectedcids:
-            E_diff = abs(cenergy[conf] - cenergy[seenconf])  # in kcal/mol
-            if E_diff < args.energy_threshold:
-                if calc_type == "rdkit":
-                    rms = get_conf_RMS(
-                        outmols[seenconf],
-                        outmols[conf],
-                        seenconf,
-                        conf,
-                        args.heavyonly,
-                        args.max_matches_rmsd,
-                    )
-                # elif calc_type == 'summ' or calc_type == 'fullmonte' or calc_type =='xtb' or calc_type =='ani':
-                elif calc_type == "summ" or calc_type == "xtb" or calc_type == "ani":
-                    rms = get_conf_RMS(
-                        outmols[conf],
-                        outmols[seenconf],
-                        -1,
-                        -1,
-                        args.heavyonly,
-                        args.max_matches_rmsd,
-                    )
-                if rms < args.rms_threshold:
-                    excluded_conf = True
-                    eng_rms_dup += 1
-                    break
         if not excluded_conf:
-            if conf not in selectedcids:
+            if conf not in selectedcids_set:
                 selectedcids.append(conf)
-        # bar.next()
-    # bar.finish()
+                selectedcids_set.add(conf)
+                pos = bisect.bisect_right(seen_energies, energy)
+                seen_energies.insert(pos, energy)
+                seen_coords_idx.insert(pos, i)
 
     if verbose:
         log.write(
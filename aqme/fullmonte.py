@@ -3,14 +3,21 @@
 #     used for genrating details for fullmonte      #
 #####################################################.
 
-import sys
+import os
 import numpy as np
 import math
-import random
+import concurrent.futures as futures
+from contextlib import ExitStack
+import multiprocessing as mp
 from rdkit.Chem import AllChem as Chem
 from rdkit.Chem import rdMolTransforms, rdMolAlign
 
-from aqme.utils import set_metal_atomic_number, get_conf_RMS
+from aqme.utils import (
+    set_metal_atomic_number,
+    set_conformer_coords,
+    get_rmsd_context,
+    ConformerEnsemble,
+)
 from aqme.csearch_utils import minimize_rdkit_energy
 
 
@@ -63,7 +70,7 @@ def realign_mol(
     return mol, energy
 
 
-def rotate_dihedrals(conformer, dihedrals, seed, stepsize):
+def rotate_dihedrals(conformer, dihedrals, rng, stepsize):
     """
     Applies a random rotation to all the dihedrals
 
@@ -73,88 +80,180 @@ def rotate_dihedrals(conformer, dihedrals, seed, stepsize):
         The conformer whose angles are going to be rotated (conformer = mol.GetConformer(cid))
     dihedrals : list
         A list of tuples of all the dihedrals that are going to be rotated.
-    seed : int
-        seed for the random module
+    rng : numpy.random.Generator
+        Random number generator of the walker
     stepsize : float
         Angle in Degrees to do the steps between 0.0 and 360.0
     """
 
     rad_range = np.arange(stepsize, 360.0, stepsize)
-    for dihedral in dihedrals:
-        random.seed(seed)  # RAUL: Any good reason to keep reseting the seed?
-        rad_ang = random.choice(rad_range)
+    # each dihedral gets its own random angle
+    for dihedral, rad_ang in zip(dihedrals, rng.choice(rad_range, size=len(dihedrals))):
         rad = math.pi * rad_ang / 180.0
         rdMolTransforms.SetDihedralRad(conformer, *dihedral, value=rad)
 
 
-def generating_conformations_fullmonte(
-    name,
-    args,
+class UniqueConformerPool:
+    """
+    Class that stores the unique conformers of FullMonte sorted by energy in
+    preallocated arrays. The energy windows of the duplicate check, the
+    pruning (ewin_fullmonte) and the sampled conformers (ewin_sample_fullmonte)
+    are obtained with binary searches.
+
+    Parameters
+    ----------
+    mol : rdkit.Chem.Mol
+        Molecule that defines the topology of the conformers
+    args : argparse.args
+        Options of CSEARCH (energy and RMSD thresholds and windows)
+    """
+
+    def __init__(self, mol, args):
+        self.args = args
+        self.rms_context = get_rmsd_context(mol, args.heavyonly, args.max_matches_rmsd)
+        self.n_confs = 0
+        self.energies = np.zeros(16)
+        self.coords = np.zeros((16, mol.GetNumAtoms(), 3))
+
+    def __len__(self):
+        return self.n_confs
+
+    def is_duplicate(self, coords, energy):
+        """
+        Checks if a conformer is a duplicate (energy and RMSD filters) of any
+        of the conformers of the pool
+        """
+
+        energies = self.energies[: self.n_confs]
+        low, high = np.searchsorted(
+            energies, [energy - self.args.energy_threshold, energy + self.args.energy_threshold]
+        )
+        diff_energy = np.abs(energies[low:high] - energy)
+        if (diff_energy < self.args.initial_energy_threshold).any():
+            return True
+        window_idx = low + np.flatnonzero(diff_energy < self.args.energy_threshold)
+        if len(window_idx) == 0:
+            return False
+        xyz_refs = self.coords[window_idx][:, self.rms_context.atom_idx]
+        rms = self.rms_context.rms_batch(coords[self.rms_context.atom_idx], xyz_refs)
+        return bool((rms < self.args.rms_threshold).any())
+
+    def add(self, coords, energy):
+        """
+        Inserts a conformer keeping the energy order and removes the
+        conformers outside the ewin_fullmonte window
+        """
+
+        if self.n_confs == len(self.energies):
+            self.energies = np.concatenate([self.energies, np.zeros_like(self.energies)])
+            self.coords = np.concatenate([self.coords, np.zeros_like(self.coords)])
+        pos = int(np.searchsorted(self.energies[: self.n_confs], energy, side="right"))
+        self.energies[pos + 1 : self.n_confs + 1] = self.energies[pos : self.n_confs]
+        self.coords[pos + 1 : self.n_confs + 1] = self.coords[pos : self.n_confs]
+        self.energies[pos] = energy
+        self.coords[pos] = coords
+        self.n_confs += 1
+        self.prune()
+
+    def add_unique(self, coords, energy):
+        """
+        Adds a conformer if it is not a duplicate. Returns True if it was added
+        """
+
+        if self.is_duplicate(coords, energy):
+            return False
+        self.add(coords, energy)
+        return True
+
+    def prune(self):
+        # the conformers are sorted, so only the tail is removed
+        self.n_confs = int(
+            np.searchsorted(
+                self.energies[: self.n_confs],
+                self.energies[0] + self.args.ewin_fullmonte,
+                side="right",
+            )
+        )
+
+    def sample(self, rng):
+        """
+        Coordinates of a random conformer inside the ewin_sample_fullmonte
+        window
+        """
+
+        n_sample = int(
+            np.searchsorted(
+                self.energies[: self.n_confs],
+                self.energies[0] + self.args.ewin_sample_fullmonte,
+                side="left",
+            )
+        )
+        # the most stable conformer is always sampled (even with ewin_sample_fullmonte = 0)
+        return self.coords[rng.integers(max(1, n_sample))]
+
+    def conformers(self):
+        """
+        Coordinates and energies of the conformers sorted by energy
+        """
+
+        return self.coords[: self.n_confs], self.energies[: self.n_confs]
+
+    def copy(self):
+        """
+        Copy of the pool (the conformers are copied, the options and the RMSD
+        context are shared)
+        """
+
+        pool_copy = UniqueConformerPool.__new__(UniqueConformerPool)
+        pool_copy.args = self.args
+        pool_copy.rms_context = self.rms_context
+        pool_copy.n_confs = self.n_confs
+        pool_copy.energies = self.energies.copy()
+        pool_copy.coords = self.coords.copy()
+        return pool_copy
+
+
+def fullmonte_walker(
+    mol,
+    pool,
     rotmatches,
-    selectedcids_rdkit,
-    outmols,
-    sdwriter,
-    dup_data,
-    dup_data_idx,
+    rng,
+    nsteps,
+    args,
     coord_Map,
     alg_Map,
     mol_template,
     ff,
 ):
+    """
+    Runs nsteps of one FullMonte walker. The walker starts from a copy of the
+    global UniqueConformerPool and uses its own random number generator.
 
-    ##working with fullmonte
-    n_unique_conformers = len(selectedcids_rdkit)
-    args.log.write(
-        f"\no  Generation of confomers using FULLMONTE using "
-        f"{n_unique_conformers} unique conformer(s) as starting point(s)"
-    )
-
-    # Writing the conformers as mol objects to sdf
-    sdtemp = Chem.SDWriter(name + "_" + "rdkit" + args.output)
-    for conf in selectedcids_rdkit:
-        sdtemp.write(outmols[conf], conf)
-    sdtemp.close()
-
-    fmmols = Chem.SDMolSupplier(name + "_" + "rdkit" + args.output, removeHs=False)
-    if fmmols is None:
-        args.log.write("Could not open " + name + args.output)
-        args.log.finalize()
-        sys.exit()
-
-    # array for each each unique from rdkit
-    unique_mol, c_energy, unique_mol_sample = [], [], []
-
-    # STEP 1: Use start conformation for and append to unique list
-    nsteps = 1
-    for mol_fm in fmmols:
-        unique_mol.append(mol_fm)
-        c_energy.append(float(mol_fm.GetProp("Energy")))
-
-    # defining unique mol sample for choosing
-    globmin = min(c_energy)
-    for ene in reversed(c_energy):
-        if abs(globmin - ene) < args.ewin_sample_fullmonte:
-            unique_mol_sample.append(unique_mol[c_energy.index(ene)])
+    Returns
+    -------
+    new_coords, new_energies, rng
+        Unique conformers found by the walker and the generator (with its
+        updated state, so the next round continues the same stream)
+    """
 
-    while nsteps < args.nsteps_fullmonte + 1:
-        seed = nsteps
+    new_coords, new_energies = [], []
 
-        # STEP 2: Choose mol object form unique_mol:
-        random.seed(seed)
-        mol_rot = random.choices(unique_mol_sample, k=1)[0]
+    rot_mol = Chem.Mol(mol)
+    rot_mol.AddConformer(Chem.Conformer(mol.GetNumAtoms()), assignId=True)
+    conformer = rot_mol.GetConformer()
+    k = min(len(rotmatches), args.nrot_fullmonte)
 
-        # updating the location of mol object i.e., the hexadecimal locaiton to a new one so the older one isnt affected
-        mol = Chem.RWMol(mol_rot)
-        rot_mol = mol.GetMol()
+    for _ in range(nsteps):
+        # STEP 2: Choose a conformer from the sampled window of the pool
+        set_conformer_coords(conformer, pool.sample(rng))
 
         # STEP 3: Choose random subset of dihedral from rotmatches
-        random.seed(seed)  # RAUL: Any good reason to keep reseting the seed ?
-        k = min(len(rotmatches), args.nrot_fullmonte)
-        mutable_dihedrals = random.choices(rotmatches, k=k)
+        mutable_dihedrals = []
+        if k > 0:
+            mutable_dihedrals = [rotmatches[i] for i in rng.integers(len(rotmatches), size=k)]
 
         # STEP 4: for the given conformation, then apply a random rotation to each torsion in the subset
-        conformer = rot_mol.GetConformer()
-        rotate_dihedrals(conformer, mutable_dihedrals, seed, args.ang_fullmonte)
+        rotate_dihedrals(conformer, mutable_dihedrals, rng, args.ang_fullmonte)
 
         # STEP 5: Optimize geometry rot_mol
         if (coord_Map, alg_Map, mol_template) == (None, None, None):
@@ -162,69 +261,187 @@ def generating_conformations_fullmonte(
                 rot_mol, -1, args.log, ff, args.opt_steps_rdkit
             )
         else:
-            mol, energy = realign_mol(
+            rot_mol, energy = realign_mol(
                 rot_mol, -1, coord_Map, alg_Map, mol_template, args.opt_steps_rdkit
             )
+        coords = rot_mol.GetConformer().GetPositions()
 
         # STEP 6 : Check for DUPLICATES - energy and rms filter (reuse)
         #  if the conformer is unique then save it the list
-        exclude_conf = False
-        # compare against allprevious conformers located
-        for j, seenmol in enumerate(unique_mol):
-            if abs(energy - c_energy[j]) < args.initial_energy_threshold:
-                exclude_conf = True
-                break
-            if abs(energy - c_energy[j]) < args.energy_threshold:
-                rms = get_conf_RMS(
-                    rot_mol, seenmol, -1, -1, args.heavyonly, args.max_matches_rmsd
+        #  (STEP 7, removing the conformers outside the window, is done by the pool)
+        if pool.add_unique(coords, energy):
+            new_coords.append(coords)
+            new_energies.append(energy)
+
+    return new_coords, new_energies, rng
+
+
+# state of the walker processes, set once per process by init_fullmonte_walker()
+FULLMONTE_WALKER = {}
+
+
+def init_fullmonte_walker(mol, rotmatches, args, coord_Map, alg_Map, mol_template, ff):
+    """
+    Initializer of the walker processes. The molecule, the options and the
+    template are sent only once, and the process keeps its own copy of the
+    global UniqueConformerPool (updated with the conformers added in each round)
+    """
+
+    FULLMONTE_WALKER["mol"] = mol
+    FULLMONTE_WALKER["rotmatches"] = rotmatches
+    FULLMONTE_WALKER["template_args"] = (args, coord_Map, alg_Map, mol_template, ff)
+    FULLMONTE_WALKER["pool"] = UniqueConformerPool(mol, args)
+
+
+def run_fullmonte_walker(pool_delta, rng, nsteps):
+    """
+    Adds the conformers merged into the global pool since the previous round
+    (pool_delta, coordinates and energies) to the pool of the process and runs
+    one walker from a copy of that pool
+    """
+
+    pool = FULLMONTE_WALKER["pool"]
+    for coords, energy in zip(*pool_delta):
+        pool.add(coords, energy)
+    return fullmonte_walker(
+        FULLMONTE_WALKER["mol"],
+        pool.copy(),
+        FULLMONTE_WALKER["rotmatches"],
+        rng,
+        nsteps,
+        *FULLMONTE_WALKER["template_args"],
+    )
+
+
+def generating_conformations_fullmonte(
+    name,
+    args,
+    rotmatches,
+    selectedcids_rdkit,
+    outmols,
+    sdwriter,
+    dup_data,
+    dup_data_idx,
+    coord_Map,
+    alg_Map,
+    mol_template,
+    ff,
+    metal_context=None,
+):
+
+    ##working with fullmonte
+    n_unique_conformers = len(selectedcids_rdkit)
+    args.log.write(
+        f"\no  Generation of confomers using FULLMONTE using "
+        f"{n_unique_conformers} unique conformer(s) as starting point(s)"
+    )
+
+    # STEP 1: Use start conformations from RDKit as the global pool of uniques
+    mol = outmols.to_mol(selectedcids_rdkit[0])
+    mol.RemoveAllConformers()
+    pool = UniqueConformerPool(mol, args)
+    # conformers added to the global pool since the last round (the pools of
+    # the walker processes are updated with them)
+    pool_delta = ([], [])
+    for conf in selectedcids_rdkit:
+        pool.add(outmols.coords[conf], float(outmols.energies[conf]))
+        pool_delta[0].append(outmols.coords[conf])
+        pool_delta[1].append(float(outmols.energies[conf]))
+
+    # each walker has an independent random stream from the same seed, and
+    # the walkers are merged in the same order so the results are reproducible
+    n_walkers = max(1, int(args.nwalkers_fullmonte))
+    rngs = [np.random.default_rng(seq) for seq in np.random.SeedSequence(int(args.seed)).spawn(n_walkers)]
+    merge_steps = max(1, int(args.merge_fullmonte))
+    template_args = (args, coord_Map, alg_Map, mol_template, ff)
+
+    # the CSEARCH jobs already run in max_workers processes, so each job only
+    # uses its share of the cores for the walkers
+    n_procs = 1
+    if n_walkers > 1:
+        n_procs = max(1, min(n_walkers, (os.cpu_count() or 1) // max(1, int(args.max_workers))))
+
+    with ExitStack() as stack:
+        # one single-process executor per walker process, so every process
+        # receives the updates of the pool of all the rounds in order
+        executors = [
+            stack.enter_context(
+                futures.ProcessPoolExecutor(
+                    max_workers=1,
+                    mp_context=mp.get_context("spawn"),
+                    initializer=init_fullmonte_walker,
+                    initargs=(mol, rotmatches, *template_args),
+                )
+            )
+            for _ in range(n_procs if n_procs > 1 else 0)
+        ]
+
+        nsteps, total_steps = 0, int(args.nsteps_fullmonte)
+        while nsteps < total_steps:
+            round_steps = min(merge_steps, total_steps - nsteps)
+            if n_walkers == 1:
+                # a single walker updates the global pool directly
+                _, _, rngs[0] = fullmonte_walker(
+                    mol, pool, rotmatches, rngs[0], round_steps, *template_args
                 )
-                if rms < args.rms_threshold:
-                    exclude_conf = True
-                    break
-        if not exclude_conf:
-            unique_mol.append(rot_mol)
-            c_energy.append(energy)
-            unique_mol[c_energy.index(energy)].SetProp("Energy", str(energy))
-
-        unique_mol_sample = []
-        # STEP 7: ANALYSE THE UNIQUE list for lowest energy, reorder the uniques if greater the given thershold remove
-        globmin = min(c_energy)
-        for ene in reversed(c_energy):
-            indx = c_energy.index(ene)
-            if abs(globmin - ene) > args.ewin_fullmonte:
-                unique_mol.pop(indx)
-                c_energy.pop(indx)
-            if abs(globmin - ene) < args.ewin_sample_fullmonte:
-                unique_mol_sample.append(unique_mol[indx])
-
-        nsteps += 1
-
-    dup_data.at[dup_data_idx, "FullMonte-Unique-conformers"] = len(unique_mol)
+            else:
+                if executors:
+                    # only the first walker of each process sends the update
+                    jobs = [
+                        executors[i % n_procs].submit(
+                            run_fullmonte_walker,
+                            pool_delta if i < n_procs else ([], []),
+                            rng,
+                            round_steps,
+                        )
+                        for i, rng in enumerate(rngs)
+                    ]
+                    walker_results = [job.result() for job in jobs]
+                else:
+                    walker_results = [
+                        fullmonte_walker(
+                            mol, pool.copy(), rotmatches, rng, round_steps, *template_args
+                        )
+                        for rng in rngs
+                    ]
+
+                # merge the conformers found by the walkers into the global pool
+                pool_delta = ([], [])
+                for i, (new_coords, new_energies, rng) in enumerate(walker_results):
+                    rngs[i] = rng
+                    for coords, energy in zip(new_coords, new_energies):
+                        if pool.add_unique(coords, energy):
+                            pool_delta[0].append(coords)
+                            pool_delta[1].append(energy)
+            nsteps += round_steps
+
+    dup_data.at[dup_data_idx, "FullMonte-Unique-conformers"] = len(pool)
 
     if args.verbose:
-        args.log.write("o  " + str(len(unique_mol)) + " unique conformers remain")
+        args.log.write("o  " + str(len(pool)) + " unique conformers remain")
 
-    cids = list(range(len(unique_mol)))
-    sorted_all_cids = sorted(cids, key=lambda cid: c_energy[cid])
+    # the conformers of the pool are already sorted by energy
+    pool_coords, pool_energies = pool.conformers()
+    unique_mol = ConformerEnsemble(mol, pool_coords, pool_energies)
 
     # STEP 9: WRITE FINAL uniques to sdf for xtb or ani
-    for i, cid in enumerate(sorted_all_cids):
-        unique_mol[cid].SetProp("_Name", name + " " + str(i))
+    for cid in range(len(unique_mol)):
+        unique_mol.names[cid] = name + " " + str(cid)
+        unique_mol.set_prop(cid, "Energy", pool_energies[cid])
+        mol_unique = unique_mol.to_mol(cid)
         if coord_Map is None and alg_Map is None and mol_template is None:
-            if args.metal_complex:
-                set_metal_atomic_number(unique_mol[cid], args.metal_idx, args.metal_sym)
-            sdwriter.write(unique_mol[cid])
+            set_metal_atomic_number(mol_unique, metal_context)
+            sdwriter.write(mol_unique)
         else:
             mol_realigned, _ = realign_mol(
-                unique_mol[cid],
+                mol_unique,
                 -1,
                 coord_Map,
                 alg_Map,
                 mol_template,
                 args.opt_steps_rdkit,
             )
-            if args.metal_complex:
-                set_metal_atomic_number(mol_realigned, args.metal_idx, args.metal_sym)
+            set_metal_atomic_number(mol_realigned, metal_context)
             sdwriter.write(mol_realigned)
 
     status = 1
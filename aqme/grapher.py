@@ -12,6 +12,7 @@ import matplotlib.path as mpath
 import matplotlib.patches as mpatches
 import matplotlib.pyplot as plt
 import cclib
+from aqme.utils import QMMetadataParser
 
 ev_2_kcal_mol = 23.061 #ev to kcal/mol
 hartree_to_kcal = 627.509
@@ -217,11 +218,9 @@ def get_qm_energy_plot(program,plot_files,energy_dft):
             data_sp = cclib.io.ccread(file)
             energy_qm = data_sp.scfenergies[0]*ev_2_kcal_mol
         elif program == 'orca':
-            sp_lines = open(file,"r").readlines()
-            for i,_ in reversed(range(sp_lines)):
-                if sp_lines[i].find('FINAL SINGLE POINT ENERGY') > -1:
-                    energy_qm = float(sp_lines[i].split()[-1])*hartree_to_kcal
-                    break
+            qm_data = QMMetadataParser.from_file(file)
+            energy_qm = qm_data['properties']['energy']['final single point energy']
+            energy_qm = cclib.parser.utils.convertor(energy_qm, "eV", "hartree")*hartree_to_kcal
         if len(file.split('_ani.sdf')) == 2 or len(file.split('_xtb.sdf')) == 2:
             name = file.replace('_ani.sdf','_xtb.sdf').split('_xtb.sdf')[0]
             if len(file.split('_ani.sdf')) == 2:
@@ -0,0 +1,242 @@
+#####################################################.
+#         This file stores the pipeline class       #
+#      used to run CSEARCH, CMIN and QPREP in a     #
+#          single process without SDF files         #
+#####################################################.
+
+import os
+import sys
+import copy
+import glob
+import time
+import pandas as pd
+import concurrent.futures as futures
+import multiprocessing as mp
+from progress.bar import IncrementalBar
+from rdkit.Chem import AllChem as Chem
+from aqme.csearch import csearch
+from aqme.cmin import cmin, evict_cmin_cache
+from aqme.qprep import qprep
+from aqme.csearch_utils import prepare_direct_smi, creation_of_dup_csv_csearch
+from aqme.utils import load_variables, creation_of_dup_csv_cmin, move_file
+from pathlib import Path
+
+
+class pipeline:
+    """
+    Class containing the in-process pipeline of AQME. The filtered conformers
+    of each molecule are streamed from CSEARCH into one or more CMIN levels
+    (i.e. ANI and then xTB) and into the generation of QPREP input files.
+    SDF files are only written for the steps included in checkpoints_pipeline.
+
+    Parameters
+    ----------
+    kwargs : argument class
+                    Specify any arguments from the CSEARCH, CMIN and QPREP modules (for a complete list of variables, visit the AQME documentation).
+                    program sets the CSEARCH program, cmin_pipeline the list of CMIN programs and qprep_pipeline the QM program of QPREP
+    """
+
+    def __init__(self, **kwargs):
+
+        start_time_overall = time.time()
+        # load default and user-specified variables
+        self.args = load_variables(kwargs, "pipeline")
+        for option in ["cmin_pipeline", "checkpoints_pipeline"]:
+            # options from command lines are comma-separated strings
+            if isinstance(getattr(self.args, option), str):
+                setattr(self.args, option, [level.strip() for level in getattr(self.args, option).split(",") if level.strip() != ""])
+
+        if self.args.program is None or self.args.program.lower() not in ["rdkit", "summ", "fullmonte"]:
+            self.args.log.write("\nx  Program not supported for the CSEARCH step of the pipeline! Specify: program='rdkit' (or summ, fullmonte)")
+            self.args.log.finalize()
+            sys.exit()
+        for level in self.args.cmin_pipeline:
+            if level not in ["xtb", "ani"]:
+                self.args.log.write("\nx  Program not supported for the CMIN steps of the pipeline! Specify: cmin_pipeline=['ani'] (or xtb, or both in the order used)")
+                self.args.log.finalize()
+                sys.exit()
+        if self.args.qprep_pipeline is not None:
+            if self.args.qprep_pipeline.lower() not in ["gaussian", "orca"]:
+                self.args.log.write("\nx  Program not supported for the QPREP step of the pipeline! Specify: qprep_pipeline='gaussian' (or orca)")
+                self.args.log.finalize()
+                sys.exit()
+            if self.args.qm_input == "":
+                self.args.log.write("x  No keywords line was specified! (i.e. qm_input=KEYWORDS_LINE).")
+                self.args.log.finalize()
+                sys.exit()
+
+        # each step uses a copy of the options with its own program
+        self.args_csearch = copy.copy(self.args)
+        self.args_csearch.destination = None
+        self.args_cmin = {}
+        for level in self.args.cmin_pipeline:
+            self.args_cmin[level] = copy.copy(self.args)
+            self.args_cmin[level].program = level
+            # the CMIN cores are shared with the CSEARCH workers
+            self.args_cmin[level].pipeline = True
+        self.args_qprep = copy.copy(self.args)
+        self.args_qprep.program = self.args.qprep_pipeline
+
+        os.chdir(self.args.w_dir_main)
+
+        # load files from AQME input
+        if self.args.smi is not None:
+            pipeline_files = [self.args.name]
+        else:
+            pipeline_files = glob.glob(self.args.input)
+
+        for pipeline_file in pipeline_files:
+            csearch_obj = csearch.from_args(self.args_csearch)
+            # load jobs for conformer generation
+            if self.args.smi is not None:
+                job_inputs = prepare_direct_smi(self.args_csearch)
+            else:
+                job_inputs = csearch_obj.load_jobs(pipeline_file)
+
+            self.args.log.write(f"\nStarting the pipeline with {len(job_inputs)} job(s) (SDF, XYZ, CSV, etc. files might contain multiple jobs/structures inside)\n")
+
+            self.run_pipeline(csearch_obj, job_inputs)
+
+            # store all the information into CSV files
+            pipeline_file_no_path = pipeline_file.replace('/','\\').split("\\")[-1].split('.')[0]
+            self.final_dup_data.to_csv(
+                self.args.w_dir_main.joinpath(f"CSEARCH-Data-{pipeline_file_no_path}.csv"), index=False
+            )
+            for level in self.args.cmin_pipeline:
+                self.cmin_dup_data[level].to_csv(
+                    self.args.w_dir_main.joinpath(f"CMIN-Data-{level}-{pipeline_file_no_path}.csv"), index=False
+                )
+
+        elapsed_time = round(time.time() - start_time_overall, 2)
+        self.args.log.write(f"\nTime pipeline: {elapsed_time} seconds\n")
+        self.args.log.finalize()
+
+        # this is added to avoid path problems in jupyter notebooks
+        os.chdir(self.args.initial_dir)
+
+    def run_pipeline(self, csearch_obj, job_inputs):
+        """
+        Runs the conformer generation of the molecules with multiprocessors
+        and refines the conformers of each molecule as soon as they are
+        generated
+        """
+
+        # create the dataframes to store the data
+        self.final_dup_data = creation_of_dup_csv_csearch(self.args.program)
+        self.cmin_dup_data = {
+            level: creation_of_dup_csv_cmin(level) for level in self.args.cmin_pipeline
+        }
+
+        # one CMIN object per level, so the process pool of each level (and the
+        # calculators of its workers) is reused for all the molecules
+        self.cmin_objs = {
+            level: cmin.from_args(self.args_cmin[level]) for level in self.args.cmin_pipeline
+        }
+
+        bar = IncrementalBar("o  Number of finished jobs from the pipeline", max=len(job_inputs))
+        try:
+            with futures.ProcessPoolExecutor(
+                max_workers=self.args.max_workers, mp_context=mp.get_context("spawn")
+            ) as executor:
+                # all the CSEARCH jobs are submitted at once, so the workers keep
+                # generating the conformers of the next molecules while the CMIN
+                # and QPREP steps of the current molecule run in this process
+                jobs = [
+                    executor.submit(csearch_obj.compute_ensembles, *job_input)
+                    for job_input in job_inputs
+                ]
+
+                # the molecules are refined following the order of the inputs
+                for job in jobs:
+                    total_data, ensembles, log_text = job.result()
+                    csearch_obj.args.log.write_buffer(log_text)
+                    frames = [self.final_dup_data, total_data]
+                    self.final_dup_data = pd.concat(frames, ignore_index=True, sort=True)
+                    for name, ensemble in ensembles.items():
+                        if ensemble is not None:
+                            self.refine_ensemble(name, ensemble)
+                    bar.next()
+        finally:
+            for cmin_obj in self.cmin_objs.values():
+                cmin_obj.shutdown_cmin_executor()
+
+        # the size of the CMIN cache is only checked once per run
+        if self.args.cache_cmin is not None and len(self.args.cmin_pipeline) > 0:
+            evict_cmin_cache(self.args)
+
+        bar.finish()
+
+    def refine_ensemble(self, name, ensemble):
+        """
+        Optimizes the conformers of a CSEARCH file with the CMIN levels of
+        the pipeline (each level starts from the filtered conformers of the
+        previous one) and writes the QPREP input files of the final
+        conformers
+
+        Parameters
+        ----------
+        name : str
+            Name of the CSEARCH file (without extension)
+        ensemble : ConformerEnsemble
+            Filtered conformers from CSEARCH
+        """
+
+        # charge and multiplicity assigned during CSEARCH
+        charge, mult = self.get_charge_mult(ensemble)
+
+        for level in self.args.cmin_pipeline:
+            if self.args.verbose:
+                self.args.log.write(f"\no  Multiple minimization of {name} with {level} (pipeline)")
+            cmin_obj = self.cmin_objs[level]
+            cmin_obj.name = name
+            cmin_obj.mols = [ensemble.to_mol(cid) for cid in range(len(ensemble))]
+            cmin_obj.set_cmin_writers(in_memory=True)
+            total_data = cmin_obj.compute_cmin()
+
+            frames = [self.cmin_dup_data[level], total_data]
+            self.cmin_dup_data[level] = pd.concat(frames, ignore_index=True, sort=True)
+
+            ensemble = cmin_obj.sdwriter.ensemble()
+            if ensemble is None:
+                return
+            # same names used when CMIN reads the SDF files of the previous step
+            name = f"{name}_{level}"
+
+        if self.args.qprep_pipeline is not None:
+            self.write_qprep(name, ensemble, charge, mult)
+
+    def get_charge_mult(self, ensemble):
+        """
+        Charge and multiplicity of the conformers, as written by CSEARCH (the
+        charge and mult options have preference)
+        """
+
+        charge, mult = self.args.charge, self.args.mult
+        if charge is None:
+            charge = int(ensemble.props[0].get("Real charge", Chem.GetFormalCharge(ensemble.mol)))
+        if mult is None:
+            mult = int(ensemble.props[0].get("Mult", 1))
+        return charge, mult
+
+    def write_qprep(self, name, ensemble, charge, mult):
+        """
+        Writes the QM input files of the conformers of the ensemble, using
+        the same names as QPREP when reading SDF files
+        """
+
+        if self.args.destination is None:
+            destination = self.args.w_dir_main.joinpath("QCALC")
+        else:
+            destination = Path(self.args.destination)
+
+        qprep_obj = qprep.from_args(self.args_qprep)
+        atom_types = [atom.GetSymbol() for atom in ensemble.mol.GetAtoms()]
+        for cid in range(len(ensemble)):
+            if len(ensemble) > 1:
+                name_conf = f"{name}_conf_{cid+1}"
+            else:
+                name_conf = name
+            qprep_data = {'atom_types': atom_types, 'cartesians': ensemble.coords[cid],
+                    'charge': charge, 'mult': mult, 'name': name_conf}
+            comfile = qprep_obj.write(qprep_data)
+            move_file(destination, self.args.w_dir_main, comfile)
@@ -8,7 +8,8 @@ import glob
 import time
 import pandas as pd
 import json
-import subprocess
+import concurrent.futures as futures
+import multiprocessing as mp
 import cclib
 from pathlib import Path
 from aqme.utils import (
@@ -16,13 +17,16 @@ from aqme.utils import (
 	QM_coords,
 	get_info_input,
 	load_variables,
-	read_file,
+	tail_lines,
 	cclib_atoms_coords)
 from aqme.qcorr_utils import (
 	detect_linear,
 	check_isomerization,
 	full_check,
-	get_json_data)
+	get_json_data,
+	cclib_json_data,
+	CCLIB_PARSE_ERRORS,
+	DuplicateIndex)
 from aqme.qprep import qprep
 
 
@@ -64,54 +68,45 @@ class qcorr():
 			'spin_contaminated': 0, 'duplicate_calc': 0, 'atom_error': 0, 'scf_error': 0, 'no_data': 0,
 			'linear_mol_wrong': 0, 'not_specified': 0, 'geom_rules_qcorr': 0, 'isomerized': 0}
 
-		duplicate_data = {'Energies' : [], 'Enthalpies' : [], 'Gibbs': []}
+		# calculations accepted in previous rounds of the same QCORR analysis (resumed
+		# from unsuccessful_QM_outputs/run_X) are also used to detect duplicates, as long
+		# as their output files are still in successful_QM_outputs. New analyses start
+		# with an empty index
+		if self.args.resume_qcorr:
+			destination_data = self.args.w_dir_main.joinpath('../../../')
+			dup_file = destination_data.joinpath('QCORR-duplicates.json')
+			duplicate_data = DuplicateIndex.load(dup_file, self.args.dup_threshold,
+				destination_data.joinpath('successful_QM_outputs'))
+		else:
+			destination_data = self.args.w_dir_main
+			dup_file = destination_data.joinpath('QCORR-duplicates.json')
+			duplicate_data = DuplicateIndex(self.args.dup_threshold)
 
 		self.args.log.write(f"o  Analyzing output files in {self.args.w_dir_main}\n")
 
-		# analyze files
-		for file in self.args.files:
-			# get initial cclib data and termination/error types and discard calcs with no data
-			file_name = file.split('.')[0]
-			termination,errortype,cclib_data,outlines = self.cclib_init(file,file_name)
-			if errortype in ['no_data','atomicbasiserror']:
-				file_terms,_ = self.organize_outputs(file,termination,errortype,file_terms)
-				if errortype == 'atomicbasiserror':
-					os.remove(file_name+'.json')
-					self.args.log.write(f'{file}: Termination = {termination}, Error type = {errortype}')
-				continue
-
-			# check for duplicates and fix wrong number of freqs in normally terminated calculations and
-			elif termination == 'normal':
-				atom_types,cartesians,duplicate_data,errortype,cclib_data = self.analyze_normal(duplicate_data,errortype,cclib_data)
-
-			# fix calcs that did not terminated normally
-			elif termination != 'normal':
-				atom_types,cartesians,cclib_data = self.analyze_abnormal(errortype,cclib_data,outlines)
-
-			# check for isomerization
-			if self.args.isom_type is not None:
-				errortype = self.analyze_isom(file,cartesians,atom_types,errortype)
-
-			# move initial QM input files (if the files are placed in the same folder as the output files)
-			if os.path.exists(f'{self.args.w_dir_main}/{file_name}.com') and self.args.round_num == 1:
-				move_file(self.args.w_dir_main.joinpath('initial_QM_inputs/'), self.args.w_dir_main,f'{file_name}.com')
-
-			# create input files through QPREP to fix the errors (some errors require user intervention)
-			if errortype not in ['ts_no_imag_freq','isomerization','duplicate_calc','spin_contaminated','none','sp_calc']:
-				self.qcorr_fixing(cclib_data,file,atom_types,cartesians)
-
-			# This part places the calculations and json files in different folders depending on the type of termination
-			self.args.log.write(f'{file}: Termination = {termination}, Error type = {errortype}')
-
-			file_terms,destination = self.organize_outputs(file,termination,errortype,file_terms)
-			if errortype in ['none','sp_calc']:
-				destination_json = destination.joinpath('json_files/')
-				move_file(destination_json, self.args.w_dir_main, file_name+'.json')
-			else:
-				os.remove(file_name+'.json')
-
-			# write information about the QCORR analysis in a csv
-			csv_qcorr = self.write_qcorr_csv(file_terms)
+		# analyze files. The files are parsed and classified independently (in
+		# parallel if workers_qcorr > 1), while the duplicates and the file moves
+		# are resolved in this process following the order of the files, so the
+		# results don't depend on the order in which the workers finish
+		destination_json = None
+		n_workers = max(1, int(self.args.workers_qcorr))
+		if n_workers == 1:
+			for qcorr_data in map(self.qcorr_analysis, self.args.files):
+				file_terms,duplicate_data,destination_file = self.qcorr_reduce(qcorr_data,file_terms,duplicate_data)
+				if destination_file is not None:
+					destination_json = destination_file
+		else:
+			with futures.ProcessPoolExecutor(
+				max_workers=n_workers, mp_context=mp.get_context("spawn")
+			) as executor:
+				for qcorr_data in executor.map(self.qcorr_analysis, self.args.files):
+					file_terms,duplicate_data,destination_file = self.qcorr_reduce(qcorr_data,file_terms,duplicate_data)
+					if destination_file is not None:
+						destination_json = destination_file
+
+		# write information about the QCORR analysis in a csv
+		csv_qcorr = self.write_qcorr_csv(file_terms)
+		duplicate_data.save(dup_file)
 
 		# performs a full analysis to ensure that the calcs were run with the same parameters
 		if self.args.fullcheck == 'False':
@@ -132,7 +127,6 @@ class qcorr():
 
 		# move dat and csv file containing the QCORR information if this is a sequential QCORR analysis
 		if self.args.resume_qcorr:
-			destination_data = self.args.w_dir_main.joinpath('../../../')
 			move_file(destination_data, self.args.w_dir_main, f'QCORR-run_{self.args.round_num}.dat')
 			move_file(destination_data, self.args.w_dir_main, f'QCORR-run_{self.args.round_num}-stats.csv')
 
@@ -157,18 +151,104 @@ class qcorr():
 	# 					self.args.log.write("The file could not be converted into a mol object, geom_rules filter(s) will be disabled\n")
 
 
-	def cclib_init(self,file,file_name):
+	def qcorr_analysis(self,file):
+		'''
+		Parses and classifies an output file. This part doesn't depend on the other
+		files, so it can run in worker processes. The duplicates are detected later
+		in qcorr_reduce() since they depend on the files analyzed before.
+		'''
+
+		file_name = file.split('.')[0]
+		qcorr_data = {'file': file, 'file_name': file_name, 'atom_types': None, 'cartesians': None,
+					'dup_data': None, 'isomerized': False}
+
+		# get initial cclib data and termination/error types and discard calcs with no data
+		termination,errortype,cclib_data = self.cclib_init(file)
+		if errortype not in ['no_data','atomicbasiserror']:
+			# check for duplicates and fix wrong number of freqs in normally terminated calculations and
+			if termination == 'normal':
+				atom_types,cartesians,qcorr_data['dup_data'],errortype,cclib_data = self.analyze_normal(errortype,cclib_data)
+
+			# fix calcs that did not terminated normally
+			elif termination != 'normal':
+				atom_types,cartesians,cclib_data = self.analyze_abnormal(file,errortype,cclib_data)
+
+			# check for isomerization
+			if self.args.isom_type is not None:
+				qcorr_data['isomerized'] = self.analyze_isom(file,cartesians,atom_types,errortype) == 'isomerization'
+
+			qcorr_data['atom_types'],qcorr_data['cartesians'] = atom_types,cartesians
+
+		qcorr_data['termination'],qcorr_data['errortype'],qcorr_data['cclib_data'] = termination,errortype,cclib_data
+		# messages buffered in worker processes are written in qcorr_reduce()
+		qcorr_data['log'] = self.args.log.pop_buffer()
+
+		return qcorr_data
+
+
+	def qcorr_reduce(self,qcorr_data,file_terms,duplicate_data):
+		'''
+		Detects duplicates, creates input files to fix errors and moves the files of a
+		calculation analyzed with qcorr_analysis(). The files must be reduced in the same
+		order for every run.
+		'''
+
+		self.args.log.write_buffer(qcorr_data['log'])
+		file,file_name = qcorr_data['file'],qcorr_data['file_name']
+		termination,errortype,cclib_data = qcorr_data['termination'],qcorr_data['errortype'],qcorr_data['cclib_data']
+		atom_types,cartesians = qcorr_data['atom_types'],qcorr_data['cartesians']
+
+		if errortype in ['no_data','atomicbasiserror']:
+			file_terms,_ = self.organize_outputs(file,termination,errortype,file_terms)
+			if errortype == 'atomicbasiserror':
+				self.args.log.write(f'{file}: Termination = {termination}, Error type = {errortype}')
+			return file_terms,duplicate_data,None
+
+		# detects if this calculation is a duplicate of a previous calculation
+		# (only the calculations kept after this check are used to detect later duplicates)
+		if qcorr_data['dup_data'] is not None:
+			if duplicate_data.is_duplicate(qcorr_data['dup_data']['energies']):
+				errortype = 'duplicate_calc'
+			elif qcorr_data['dup_data']['reference']:
+				duplicate_data.add(qcorr_data['dup_data']['energies'])
+
+		if qcorr_data['isomerized']:
+			errortype = 'isomerization'
+
+		# move initial QM input files (if the files are placed in the same folder as the output files)
+		if os.path.exists(f'{self.args.w_dir_main}/{file_name}.com') and self.args.round_num == 1:
+			move_file(self.args.w_dir_main.joinpath('initial_QM_inputs/'), self.args.w_dir_main,f'{file_name}.com')
+
+		# create input files through QPREP to fix the errors (some errors require user intervention)
+		if errortype not in ['ts_no_imag_freq','isomerization','duplicate_calc','spin_contaminated','none','sp_calc']:
+			self.qcorr_fixing(cclib_data,file,atom_types,cartesians)
+
+		# This part places the calculations and json files in different folders depending on the type of termination
+		self.args.log.write(f'{file}: Termination = {termination}, Error type = {errortype}')
+
+		file_terms,destination = self.organize_outputs(file,termination,errortype,file_terms)
+		# json files are only written for the calculations that are kept
+		destination_json = None
+		if errortype in ['none','sp_calc']:
+			destination_json = destination.joinpath('json_files/')
+			self.write_json(cclib_data,destination_json,file_name)
+			if errortype == 'none' and qcorr_data['dup_data'] is not None:
+				duplicate_data.accept(file_name,qcorr_data['dup_data']['energies'])
+
+		return file_terms,duplicate_data,destination_json
+
+
+	def cclib_init(self,file):
 		'''
-		Determine termination and error types (initial determination), create json files
-		with cclib and load the data in the cclib json files
+		Determine termination and error types (initial determination) and load the
+		data parsed with cclib
 		'''
 		
-		# cclib generation of json files with ccwrite
-		termination,errortype,cclib_data = self.json_gen(file,file_name)
-		outlines = []
+		# cclib parsing of the output file
+		termination,errortype,cclib_data = self.cclib_parse(file)
 
 		if errortype == 'no_data':
-			return termination,errortype,None,None
+			return termination,errortype,None
 
 		# calculations with 1 atom
 		if cclib_data['properties']['number of atoms'] == 1:
@@ -212,8 +292,9 @@ class qcorr():
 					errortype = 'no_freq'
 					
 			# use very short reversed loop to find basis set incompatibilities and SCF errors
-			outlines = read_file(os.getcwd(),self.args.w_dir_main,file)
-			for i in reversed(range(len(outlines)-15,len(outlines))):
+			# (only the end of the file is read)
+			outlines = tail_lines(Path(self.args.w_dir_main).joinpath(file),16)
+			for i in reversed(range(1,len(outlines))):
 				if outlines[i].find('Normal termination') > -1 and errortype != 'no_freq':
 					termination = 'normal'
 					errortype = 'sp_calc'
@@ -226,15 +307,17 @@ class qcorr():
 					errortype = 'SCFerror'
 					break
 
-		return termination,errortype,cclib_data,outlines
+		return termination,errortype,cclib_data
 
 
-	def analyze_normal(self,duplicate_data,errortype,cclib_data):
+	def analyze_normal(self,errortype,cclib_data):
 		'''
-		Analyze errors from normally terminated calculations
+		Analyze errors from normally terminated calculations. The energies used to
+		detect duplicates are returned and compared in qcorr_reduce() through a DuplicateIndex
 		'''
 
 		atom_types,cartesians = cclib_atoms_coords(cclib_data)
+		dup_data = None
 
 		if errortype == 'none':
 			# in eV, converted to hartree using the conversion factor from cclib
@@ -251,19 +334,10 @@ class qcorr():
 						cclib_data['metadata']['ground or transition state'] = 'SP calculation'
 					H_dup = E_dup
 					G_dup = E_dup
-			# detects if this calculation is a duplicate
-			for i,_ in enumerate(duplicate_data['Energies']):
-				E_diff = abs(E_dup - duplicate_data['Energies'][i])
-				H_diff = abs(H_dup - duplicate_data['Enthalpies'][i])
-				G_diff = abs(G_dup - duplicate_data['Gibbs'][i])
-				if max([E_diff,H_diff,G_diff]) < abs(float(self.args.dup_threshold)):
-					errortype = 'duplicate_calc'
+			# single-point calcs are compared but not used as references for later duplicates
+			dup_data = {'energies': [E_dup,H_dup,G_dup], 'reference': errortype == 'none'}
 
 		if errortype == 'none':
-			duplicate_data['Energies'].append(E_dup)
-			duplicate_data['Enthalpies'].append(H_dup)
-			duplicate_data['Gibbs'].append(G_dup)
-
 			initial_ifreqs = 0
 			for freq in cclib_data['vibrations']['frequencies']:
 				if float(freq) < 0 and abs(float(freq)) > abs(float(self.args.ifreq_cutoff)):
@@ -310,10 +384,10 @@ class qcorr():
 					new_keywords_line += ' '
 				cclib_data['metadata']['keywords line'] = new_keywords_line
 
-		return atom_types,cartesians,duplicate_data,errortype,cclib_data
+		return atom_types,cartesians,dup_data,errortype,cclib_data
 
 
-	def analyze_abnormal(self,errortype,cclib_data,outlines):
+	def analyze_abnormal(self,file,errortype,cclib_data):
 		'''
 		Analyze errors from calculations that did not finish normally
 		'''
@@ -353,7 +427,8 @@ class qcorr():
 					# for optimizations that fail in the first step
 					min_RMS = 0
 				
-				atom_types,cartesians = QM_coords(outlines,min_RMS,cclib_data['properties']['number of atoms'],'gaussian')
+				# the geometry is read directly from its position in the file
+				atom_types,cartesians = QM_coords(Path(self.args.w_dir_main).joinpath(file),min_RMS,cclib_data['properties']['number of atoms'],'gaussian')
 
 		return atom_types,cartesians,cclib_data
 
@@ -444,23 +519,26 @@ class qcorr():
 			self.args.log.write(f"x  Couldn't create an input file to fix {file} (compatible progras: Gaussian and ORCA)\n")
 
 
-	def json_gen(self,file,file_name):
+	def cclib_parse(self,file):
 		'''
-		Create a json file with cclib and load a dictionary
+		Parse an output file with cclib (in the same process) and load its data
+		as a dictionary with the same format as the json files from ccwrite
 		'''
 
 		termination,errortype = 'normal','none'
-		
-		command_run_1 = ['ccwrite', 'json', file]
-		subprocess.run(command_run_1)
 
 		cclib_data = {}
 		try:
-			with open(file_name+'.json') as json_file:
-				cclib_data = json.load(json_file)
-		except FileNotFoundError:
+			json_data = cclib_json_data(Path(self.args.w_dir_main).joinpath(file))
+		except CCLIB_PARSE_ERRORS as parse_error:
+			# the file is treated as a file with no data (as when ccwrite fails)
+			self.args.log.write(f'x  cclib could not parse {file} ({type(parse_error).__name__}: {parse_error})')
+			json_data = None
+		if json_data is None:
 			termination = 'other'
 			errortype = 'no_data'
+		else:
+			cclib_data = json_data
 		
 		# add parameters that might be missing from cclib (depends on the version)
 		if not hasattr(cclib_data, 'metadata') and errortype != 'no_data':
@@ -478,6 +556,16 @@ class qcorr():
 		return termination,errortype,cclib_data
 
 
+	def write_json(self,cclib_data,destination,file_name):
+		'''
+		Write the cclib data of a calculation into a json file
+		'''
+
+		destination.mkdir(exist_ok=True, parents=True)
+		with open(destination.joinpath(f'{file_name}.json'), 'w') as outfile:
+			json.dump(cclib_data, outfile, indent=1)
+
+
 	def fix_imag_freqs(self,cclib_data,cartesians):
 		"""
 		Fixes undersired (extra) imaginary frequencies from QM calculations. This function multiplies the imaginary normal mode vectors by the selected amplitude (0.2 is the default amplitude in the pyQRC script from GitHub, user: bobbypaton).	By default, all the extra imaginary modes are used (i.e. in calculations with three	extra imaginary frequencies, all the three modes will be used to displace the atoms). This can be tuned with the --ifreq_cutoff option (i.e. only use freqs lower than -50 cm-1).
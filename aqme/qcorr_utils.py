@@ -5,13 +5,14 @@
 
 import os
 import glob
+import math
 import pandas as pd
 import json
 import cclib
 from pathlib import Path
 from aqme.utils import (
 	move_file,
-	read_file)
+	QMMetadataParser)
 import numpy as np
 
 # Bondi VDW radii in Angstrom
@@ -30,6 +31,25 @@ rcov = {"H": 0.32,"He": 0.46,"Li": 1.33,"Be": 1.02,"B": 0.85,"C": 0.75,"N": 0.71
 "Nb": 1.47,"Mo": 1.38,"Tc": 1.28,"Ru": 1.25,"Rh": 1.25,"Pd": 1.20,"Ag": 1.28,"Cd": 1.36,"In": 1.42,"Sn": 1.40,
 "Sb": 1.40,"Te": 1.36,"I": 1.33,"Xe": 1.31}
 
+# errors raised by the cclib parsers with incomplete or unexpected output files
+CCLIB_PARSE_ERRORS = (StopIteration, IndexError, KeyError, ValueError, AssertionError)
+
+
+def cclib_json_data(file):
+	'''
+	Parses an output file with cclib and returns its data as a dictionary, using the
+	public cclib.io.ccwrite() function (the same json obtained with "ccwrite json FILE").
+	Returns None if cclib doesn't recognize the file
+	'''
+
+	parsed_data = cclib.io.ccread(str(file))
+	if parsed_data is None:
+		return None
+	json_data = cclib.io.ccwrite(parsed_data, outputtype='json', returnstr=True)
+	if json_data is None:
+		return None
+	return json.loads(json_data)
+
 
 def detect_linear(errortype,atom_types,cclib_data):
 	'''
@@ -208,165 +228,107 @@ def gen_connectivity(isom_data,atom_types_conn,COORDINATES_conn):
 
 def get_json_data(self,file,cclib_data):
 	'''
-	Get metadata and GoodVibes data for the json file (for older versions of cclib)
+	Get metadata and GoodVibes data missing from the cclib data (for older versions of cclib)
 	'''
-	
-	outlines = read_file(os.getcwd(),self.args.w_dir_main,file)
-
-	# initial loop just to detect the QM program
-	for i,line in enumerate(outlines):
-		# get program
-		if line.strip() == "Cite this work as:":
-			cclib_data['metadata'] = {}
-			qm_program = outlines[i+1]
-
-			cclib_data['metadata']['QM program'] = qm_program[1:-2]
-			for j in range(i,i+60):
-				if '**********' in outlines[j]:
-					run_date = outlines[j+2].strip()
-					cclib_data['metadata']['run date'] = run_date
-					break
-			break
-
-		elif '* O   R   C   A *' in line:
-			for j in range(i,i+100):
-				if 'Program Version' in line.strip():
-					cclib_data['metadata'] = {}
-					version_program = "ORCA version " + line.split()[2]
-					cclib_data['metadata']['QM program'] = version_program
-					break
-				
-	if cclib_data['metadata']['QM program'].lower().find('gaussian') > -1:
-
-		cclib_data['properties']['rotational'] = {}
-		for i,line in enumerate(outlines):
-			# Extract memory
-			if '%mem' in line:
-				mem = line.strip().split('=')[-1]
-				cclib_data['metadata']['memory'] = mem
-
-			# Extract number of processors
-			elif '%nprocs' in line:
-				nprocs = int(line.strip().split('=')[-1])
-				cclib_data['metadata']['processors'] = nprocs
-
-			# Extract keywords line, solvation, dispersion and calculation type
-			elif '#' in line and not hasattr(cclib_data, 'keywords_line'):
-				keywords_line = ''
-				for j in range(i,i+10):
-					if '----------' in outlines[j]:
-						break
-					else:
-						keywords_line += outlines[j].rstrip("\n")[1:]
-				cclib_data['metadata']['keywords line'] = keywords_line[2:]
-				qm_solv,qm_disp = 'gas_phase','none'
-				calc_type = 'ground_state'
-				calcfc_found, ts_found = False, False
-				for keyword in keywords_line.split():
-					if keyword.lower().find('opt') > -1:
-						if keyword.lower().find('calcfc') > -1:
-							calcfc_found = True
-						if keyword.lower().find('ts') > -1:
-							ts_found = True
-					elif keyword.lower().startswith('scrf'):
-						qm_solv = keyword
-					elif keyword.lower().startswith('emp'):
-						qm_disp = keyword
-				if calcfc_found and ts_found:
-					calc_type = 'transition_state'
-				cclib_data['metadata']['solvation'] = qm_solv
-				cclib_data['metadata']['dispersion model'] = qm_disp
-				cclib_data['metadata']['ground or transition state'] = calc_type
-
-			# Basis set name
-			elif line[1:15] == "Standard basis":
-				cclib_data['metadata']['basis set'] = line.split()[2]
-
-			# functional
-			if not hasattr(cclib_data, 'BOMD') and line[1:9] == 'SCF Done':
-				t1 = line.split()[2]
-				if t1 == 'E(RHF)':
-					cclib_data['metadata']['functional'] = 'HF'
-				else:
-					cclib_data['metadata']['functional'] = t1[t1.index("(") + 2:t1.rindex(")")]
-				break
 
-			# Extract grid type
-			elif line[1:8] == 'ExpMin=':
-				grid_lookup = {1: 'sg1', 2: 'coarse', 4: 'fine', 5: 'ultrafine', 7: 'superfine'}
-				IRadAn = int(line.strip().split()[-3])
-				grid = grid_lookup[IRadAn]
-				cclib_data['metadata']['grid type'] = grid
-
-		# Extract <S**2> before and after spin annihilation
-		for i in reversed(range(0,len(outlines)-50)):
-			# For time dependent (TD) calculations
-			if 'E(TD-HF/TD-DFT)' in outlines[i]:
-				td_e = float(line.strip().split()[-1])
-				cclib_data['properties']['energy']['TD energy'] = cclib.parser.utils.convertor(td_e, "hartree", "eV")
-
-			# For G4 calculations look for G4 energies (Gaussian16a bug prints G4(0 K) as DE(HF)) --Brian modified to work for G16c-where bug is fixed.
-			elif line.strip().startswith('E(ZPE)='): #Overwrite DFT ZPE with G4 ZPE
-				zero_point_corr = float(line.strip().split()[1])
-			elif line.strip().startswith('G4(0 K)'):
-				G4_energy = float(line.strip().split()[2])
-				G4_energy -= zero_point_corr #Remove G4 ZPE
-				cclib_data['properties']['energy']['G4 energy'] = cclib.parser.utils.convertor(G4_energy, "hartree", "eV")
-
-			# For ONIOM calculations use the extrapolated value rather than SCF value
-			elif "ONIOM: extrapolated energy" in line.strip():
-				oniom_e = float(line.strip().split()[4])
-				cclib_data['properties']['energy']['ONIOM energy'] = cclib.parser.utils.convertor(oniom_e, "hartree", "eV")
-
-			elif 'S**2 before annihilation' in outlines[i]:
-				cclib_data['properties']['S2 after annihilation'] = float(outlines[i].strip().split()[-1])
-				cclib_data['properties']['S2 before annihilation'] = float(outlines[i].strip().split()[-3][:-1])
-
-			# Extract symmetry point group
-			elif 'Full point group' in outlines[i]:
-				point_group = outlines[i].strip().split()[3]
-				cclib_data['properties']['rotational']['symmetry point group'] = point_group
-				break
+	qm_data = QMMetadataParser.from_file(Path(self.args.w_dir_main).joinpath(file))
 
-			# Extract symmetry number, rotational constants and rotational temperatures
-			elif 'Rotational symmetry number' in outlines[i]:
-				symmno = int(outlines[i].strip().split()[3].split(".")[0])
-				cclib_data['properties']['rotational']['symmetry number'] = symmno
-
-			elif outlines[i].find('Rotational constants (GHZ):') > -1:
-				try:
-					roconst = [float(outlines[i].strip().replace(':', ' ').split()[3]),
-									float(outlines[i].strip().replace(':', ' ').split()[4]),
-									float(outlines[i].strip().replace(':', ' ').split()[5])]
-				except ValueError:
-					if outlines[i].find('********') > -1:
-						roconst = [float(outlines[i].strip().replace(':', ' ').split()[4]),
-										float(outlines[i].strip().replace(':', ' ').split()[5])]
-				cclib_data['properties']['rotational']['rotational constants'] = roconst
-
-			elif outlines[i].find('Rotational temperature ') > -1:
-				rotemp = [float(outlines[i].strip().split()[3])]
-				cclib_data['properties']['rotational']['rotational temperatures'] = rotemp
-
-			elif outlines[i].find('Rotational temperatures') > -1:
-				try:
-					rotemp = [float(outlines[i].strip().split()[3]), float(outlines[i].strip().split()[4]),
-								float(outlines[i].strip().split()[5])]
-				except ValueError:
-					if outlines[i].find('********') > -1:
-						rotemp = [float(outlines[i].strip().split()[4]), float(outlines[i].strip().split()[5])]
-				cclib_data['properties']['rotational']['rotational temperatures'] = rotemp
-
-	elif cclib_data['metadata']['QM program'].lower().find('orca') > -1:
-		for i in reversed(range(0,outlines)):
-			if outlines[i][:25] == 'FINAL SINGLE POINT ENERGY':
-				# in eV to match the format from cclib
-				orca_e = float(outlines[i].split()[-1])
-				cclib_data['properties']['energy']['final single point energy'] = cclib.parser.utils.convertor(orca_e, "hartree", "eV")
-				break
-	
-	if cclib_data != {}:
-		with open(f'{file.split(".")[0]}.json', 'w') as outfile:
-			json.dump(cclib_data, outfile, indent=1)
+	if qm_data['program'] is not None:
+		cclib_data['metadata'] = qm_data['metadata']
+	for prop,value in qm_data['properties'].items():
+		if prop == 'energy':
+			if 'energy' not in cclib_data['properties']:
+				cclib_data['properties']['energy'] = {}
+			cclib_data['properties']['energy'].update(value)
+		elif prop == 'rotational':
+			cclib_data['properties']['rotational'] = value
+		# the values parsed by cclib have priority
+		elif prop not in cclib_data['properties']:
+			cclib_data['properties'][prop] = value
+
+	return cclib_data
+
+
+class DuplicateIndex:
+	'''
+	Index of the E, H and G (in hartree) of the calculations analyzed by QCORR, used
+	to detect duplicates. The calculations are stored in a grid hash on E with cells
+	of dup_threshold, so only the calculations from the same and the two neighbouring
+	cells are compared. The calculations accepted in each QCORR round are saved to
+	a json file, so the next rounds of the same analysis (run_2, ...) are also
+	checked against them.
+	'''
 
-	return cclib_data
\ No newline at end of file
+	def __init__(self, dup_threshold):
+		self.dup_threshold = abs(float(dup_threshold))
+		self.cells = {}
+		self.accepted = {}
+
+	def get_cell(self, E_dup):
+		# with dup_threshold = 0 there are no duplicates, cells are only used for storage
+		if self.dup_threshold == 0:
+			return 0
+		return math.floor(E_dup / self.dup_threshold)
+
+	def add(self, energies):
+		'''
+		Adds the E, H and G of a calculation to the index. Only calculations kept after
+		the duplicate check are added, so near-duplicates don't chain
+		'''
+
+		self.cells.setdefault(self.get_cell(energies[0]), []).append(tuple(energies))
+
+	def is_duplicate(self, energies):
+		'''
+		Detects whether the E, H and G of a calculation match those of a calculation
+		from the index (using dup_threshold)
+		'''
+
+		if self.dup_threshold == 0:
+			return False
+		cell = self.get_cell(energies[0])
+		for neighbour in [cell-1, cell, cell+1]:
+			for energies_index in self.cells.get(neighbour, []):
+				if max([abs(energies[i] - energies_index[i]) for i in range(3)]) < self.dup_threshold:
+					return True
+		return False
+
+	def accept(self, name, energies):
+		'''
+		Keeps the energies of a calculation that passed the QCORR analysis for the next rounds
+		'''
+
+		self.accepted[name] = list(energies)
+
+	def save(self, file):
+		'''
+		Saves the accepted calculations of all the QCORR rounds into a json file
+		'''
+
+		dup_index = {'dup_threshold': self.dup_threshold, 'calculations': self.accepted}
+		with open(file, 'w') as outfile:
+			json.dump(dup_index, outfile, indent=1)
+
+	@classmethod
+	def load(cls, file, dup_threshold, folder=None):
+		'''
+		Creates an index containing the accepted calculations of previous QCORR rounds
+		(if the json file from previous rounds exists). If folder is used, only the
+		calculations whose output files are still in that folder are included
+		'''
+
+		dup_index = cls(dup_threshold)
+		if os.path.exists(file):
+			with open(file, 'r') as infile:
+				saved_index = json.load(infile)
+			if folder is not None:
+				folder_files = []
+				if os.path.exists(folder):
+					folder_files = [entry.name.split('.')[0] for entry in os.scandir(folder) if entry.is_file()]
+				folder_files = set(folder_files)
+			for name,energies in saved_index['calculations'].items():
+				if folder is not None and name not in folder_files:
+					continue
+				dup_index.add(energies)
+				dup_index.accept(name, energies)
+		return dup_index
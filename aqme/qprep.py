@@ -12,11 +12,11 @@ import shutil
 from aqme.utils import (
 	cclib_atoms_coords,
 	QM_coords,
-	read_file,
 	move_file,
 	load_variables,
 	read_xyz_charge_mult,
-	mol_from_sdf_or_mol_or_mol2)
+	mol_from_sdf_or_mol_or_mol2,
+	QMMetadataParser)
 from aqme.crest import xyzall_2_xyz
 from pathlib import Path
 
@@ -161,6 +161,17 @@ class qprep:
 		if not self.args.verbose:
 			os.remove(self.args.w_dir_main / 'QPREP_data.dat')
 
+	@classmethod
+	def from_args(cls, args):
+		'''
+		Creates a QPREP object from loaded options without writing input files
+		from args.files (used by the pipeline module)
+		'''
+
+		obj = cls.__new__(cls)
+		obj.args = args
+		return obj
+
 
 	def get_header(self,qprep_data):
 		'''
@@ -308,44 +319,19 @@ class qprep:
 					pass
 
 			elif file.split('.')[1] in ['log','out']:
-				# detect QM program and number of atoms
+				# detect QM program, number of atoms, charge and mult
 				if not self.args.command_line:
-					outlines = read_file(os.getcwd(),self.args.w_dir_main,file)
+					w_dir_file = self.args.w_dir_main
 				else:
 					# if command lines are used, the program is already in that folder
-					outlines = read_file(os.getcwd(),os.getcwd(),file)
-				n_atoms = 0
-				resume_line = 0
-				found_n_atoms = False
-
-				for i,line in enumerate(outlines):
-					if line.find('Gaussian, Inc.'):
-						program = 'gaussian'
-						resume_line = i
-						break
-					elif line[i].find('O   R   C   A'):
-						program = 'orca'
-						resume_line = i
-						break
-
-				for i in range(resume_line,len(outlines)):
-					if program == 'gaussian':
-						# get charge and mult
-						if outlines[i].find("Charge = ") > -1:
-							charge = int(outlines[i].split()[2])
-							mult = int(outlines[i].split()[5].rstrip('\n'))
-						# get number of atoms
-						elif outlines[i].find('Symbolic Z-matrix:') > -1:
-							for j in range(i+2,len(outlines)):
-								if len(outlines[j].split()) > 0:
-									n_atoms += 1
-								else:
-									found_n_atoms = True
-									break
-						elif found_n_atoms:
-							break
-
-				atom_types,cartesians = QM_coords(outlines,-1,n_atoms,program)
+					w_dir_file = os.getcwd()
+				qm_data = QMMetadataParser.from_file(Path(w_dir_file).joinpath(file))
+				program = qm_data['program']
+				n_atoms = qm_data['properties'].get('number of atoms',0)
+				charge = qm_data['properties'].get('charge')
+				mult = qm_data['properties'].get('multiplicity')
+
+				atom_types,cartesians = QM_coords(Path(w_dir_file).joinpath(file),-1,n_atoms,program)
 
 			elif file.split('.')[1] == 'json':
 				with open(file) as json_file:
@@ -4,14 +4,19 @@
 ######################################################.
 
 import os
+import io
 import sys
 import getopt
 import numpy as np
 import glob
 import yaml
+import cclib
 import pandas as pd
+import gzip
+import bz2
+import lzma
+from collections import namedtuple, deque
 from pathlib import Path
-from rdkit.Chem.rdMolAlign import GetBestRMS
 from rdkit.Chem.rdmolops import RemoveHs
 from rdkit import Geometry
 from rdkit.Chem import Mol
@@ -76,7 +81,48 @@ class Logger:
 
 	# Class Logger to writargs.input.split('.')[0] output to a file
 	def __init__(self, filein, append, suffix="dat"):
-		self.log = open(f"{filein}_{append}.{suffix}", "w")
+		self.filename = os.path.abspath(f"{filein}_{append}.{suffix}")
+		self.log = open(self.filename, "w")
+
+	def __getstate__(self):
+		# file objects can't be pickled, so only the path is sent to workers
+		return {"filename": self.filename}
+
+	def __setstate__(self, state):
+		# worker processes keep their messages in memory. They are returned
+		# with the results of each job (see pop_buffer) and the parent writes
+		# them following the order of the jobs (see write_buffer)
+		self.filename = state["filename"]
+		self.log = io.StringIO()
+
+	def pop_buffer(self):
+		"""
+		Returns the messages buffered in a worker process and empties the
+		buffer (an empty string if the messages are written into the file).
+
+		Returns
+		-------
+		str
+		   Text buffered since the last call.
+		"""
+		if not isinstance(self.log, io.StringIO):
+			return ""
+		text = self.log.getvalue()
+		self.log.seek(0)
+		self.log.truncate(0)
+		return text
+
+	def write_buffer(self, text):
+		"""
+		Writes the messages returned by pop_buffer() in a worker process into
+		the file (they were already printed by the worker).
+
+		Parameters
+		----------
+		text : str
+		   Text buffered in the worker.
+		"""
+		self.log.write(text)
 
 	def write(self, message):
 		"""
@@ -322,9 +368,44 @@ def nci_ts_mol(smi):
 	return mol
 
 
-def rules_get_charge(mol, args, type):
+class MetalContext(
+	namedtuple("MetalContext", ["metal_idx", "complex_coord", "metal_sym", "metal_oxi"])
+):
+	"""
+	Immutable information of the metal atoms of a molecule, created once per
+	molecule with substituted_mol(). Each tuple follows the order of the
+	metal_atoms option (None for metals that are not in the molecule).
+
+	Attributes
+	----------
+	metal_idx : tuple
+		Indices of the metal atoms
+	complex_coord : tuple
+		Number of neighbours of the metal atoms
+	metal_sym : tuple
+		Symbols of the metal atoms
+	metal_oxi : tuple
+		Oxidation states of the metal atoms (from the metal_oxi option)
+	"""
+
+	__slots__ = ()
+
+	def n_metals(self):
+		return len([idx for idx in self.metal_idx if idx is not None])
+
+
+def rules_get_charge(mol, metal_context, type):
 	"""
 	Automatically sets the charge for metal complexes
+
+	Parameters
+	----------
+	mol : rdkit.Chem.Mol
+		Molecule
+	metal_context : MetalContext
+		Metal atoms of the molecule (None for organic molecules)
+	type : str
+		'csearch' returns the total charge, 'cmin' the charges of the atoms
 	"""
 
 	C_group = ["C", "Se", "Ge"]
@@ -335,13 +416,17 @@ def rules_get_charge(mol, args, type):
 	M_ligands, N_carbenes, bridge_atoms, neighbours = [], [], [], []
 	charge_rules = np.zeros(len(mol.GetAtoms()), dtype=int)
 	neighbours, metal_found = [], False
+	metal_charges = {}
+	if metal_context is not None:
+		for metal_idx, metal_oxi in zip(metal_context.metal_idx, metal_context.metal_oxi):
+			if metal_idx is not None:
+				metal_charges[metal_idx] = metal_oxi
 	for i, atom in enumerate(mol.GetAtoms()):
 		# get the neighbours of metal atom and calculate the charge of metal center + ligands
-		if atom.GetIdx() in args.metal_idx:
+		if atom.GetIdx() in metal_charges:
 			metal_found = True
-			charge_idx = args.metal_idx.index(atom.GetIdx())
 			neighbours = atom.GetNeighbors()
-			charge_rules[i] = args.metal_oxi[charge_idx]
+			charge_rules[i] = metal_charges[atom.GetIdx()]
 			for neighbour in neighbours:
 				M_ligands.append(neighbour.GetIdx())
 				if neighbour.GetTotalValence() == 4:
@@ -394,26 +479,19 @@ def rules_get_charge(mol, args, type):
 					if atom.GetTotalValence() == 1:
 						charge_rules[0] = charge_rules[0] - 1
 
-	if metal_found:
-		if type == "csearch":
-			return np.sum(charge_rules)
-		if type == "cmin":
-			return charge_rules
-
-	# for organic molecules when using a list containing organic and organometallics molecules mixed
-	else:
-		charge = Chem.GetFormalCharge(mol)
-		if type == "csearch":
-			return charge, metal_found
-		if type == "cmin":
-			return [charge], metal_found
+	# for organic molecules (or organometallics without the metals of metal_atoms)
+	# the charges are the formal charges of the atoms
+	if type == "csearch":
+		return int(np.sum(charge_rules))
+	if type == "cmin":
+		return charge_rules
 
 
-def substituted_mol(self, mol, checkI):
+def substituted_mol(mol, args, checkI):
 	"""
-	Returns a molecule object in which all metal atoms specified in args.metal_atoms
-	are replaced by Iodine and the charge is set depending on the number of
-	neighbors.
+	Returns the MetalContext of a molecule with the metal atoms specified in
+	args.metal_atoms. If checkI is "I", the metal atoms of mol are replaced by
+	Iodine and the charge is set depending on the number of neighbors.
 
 	"""
 
@@ -421,14 +499,15 @@ def substituted_mol(self, mol, checkI):
 	for i, j in zip(range(2, 9), range(-3, 4)):
 		Neighbors2FormalCharge[i] = j
 
+	n_metals = len(args.metal_atoms)
+	metal_pos = {symbol: i for i, symbol in enumerate(args.metal_atoms)}
+	metal_idx, complex_coord, metal_sym = [None] * n_metals, [None] * n_metals, [None] * n_metals
 	for atom in mol.GetAtoms():
 		symbol = atom.GetSymbol()
-		if symbol in self.args.metal_atoms:
-			self.args.metal_sym[self.args.metal_atoms.index(symbol)] = symbol
-			self.args.metal_idx[self.args.metal_atoms.index(symbol)] = atom.GetIdx()
-			self.args.complex_coord[self.args.metal_atoms.index(symbol)] = len(
-				atom.GetNeighbors()
-			)
+		if symbol in metal_pos:
+			metal_sym[metal_pos[symbol]] = symbol
+			metal_idx[metal_pos[symbol]] = atom.GetIdx()
+			complex_coord[metal_pos[symbol]] = len(atom.GetNeighbors())
 			if checkI == "I":
 				atom.SetAtomicNum(53)
 				n_neighbors = len(atom.GetNeighbors())
@@ -436,7 +515,10 @@ def substituted_mol(self, mol, checkI):
 					formal_charge = Neighbors2FormalCharge[n_neighbors]
 					atom.SetFormalCharge(formal_charge)
 
-	return self.args.metal_idx, self.args.complex_coord, self.args.metal_sym
+	metal_oxi = list(args.metal_oxi) + [None] * (n_metals - len(args.metal_oxi))
+	return MetalContext(
+		tuple(metal_idx), tuple(complex_coord), tuple(metal_sym), tuple(metal_oxi[:n_metals])
+	)
 
 
 def getDihedralMatches(mol, heavy):
@@ -469,7 +551,7 @@ def getDihedralMatches(mol, heavy):
 	return uniqmatches
 
 
-def set_metal_atomic_number(mol, metal_idx, metal_sym):
+def set_metal_atomic_number(mol, metal_context):
 	"""
 	Changes the atomic number of the metal atoms using their indices.
 
@@ -477,24 +559,39 @@ def set_metal_atomic_number(mol, metal_idx, metal_sym):
 	----------
 	mol : rdkit.Chem.Mol
 		RDKit molecule object
-	metal_idx : list
-		sorted list that contains the indices of the metal atoms in the molecule
-	metal_sym : list
-		sorted list (same order as metal_idx) that contains the symbols of the metals in the molecule
+	metal_context : MetalContext
+		Metal atoms of the molecule (nothing is changed if it is None)
 	"""
 
-	for atom in mol.GetAtoms():
-		if atom.GetIdx() in metal_idx:
-			re_symbol = metal_sym[metal_idx.index(atom.GetIdx())]
-			atomic_number = periodic_table().index(re_symbol)
-			atom.SetAtomicNum(atomic_number)
+	if metal_context is None:
+		return
+	for metal_idx, metal_sym in zip(metal_context.metal_idx, metal_context.metal_sym):
+		if metal_idx is not None:
+			atomic_number = periodic_table().index(metal_sym)
+			mol.GetAtomWithIdx(metal_idx).SetAtomicNum(atomic_number)
+
+
+def set_conformer_coords(conformer, coords):
+	"""
+	Replaces the coordinates of an RDKit conformer.
+
+	Parameters
+	----------
+	conformer : rdkit.Chem.Conformer
+		Conformer to update
+	coords : numpy.array
+		Array of shape (n_atoms, 3) with the new coordinates
+	"""
+
+	for i, coord in enumerate(coords):
+		conformer.SetAtomPosition(i, Geometry.Point3D(float(coord[0]), float(coord[1]), float(coord[2])))
 
 
 def get_conf_RMS(mol1, mol2, c1, c2, heavy, max_matches_rmsd):
 	"""
 	Takes in two rdkit.Chem.Mol objects and calculates the RMSD between them.
-	(As side efect mol1 is left in the aligned state, if heavy is specified
-	the side efect will not happen)
+	The heavy-atom map and the symmetry permutations of the topology are
+	reused from get_rmsd_context() (the molecules are not aligned)
 
 	Parameters
 	----------
@@ -517,10 +614,341 @@ def get_conf_RMS(mol1, mol2, c1, c2, heavy, max_matches_rmsd):
 		Returns the best RMSD found
 	"""
 
+	rms_context = get_rmsd_context(mol1, heavy, max_matches_rmsd)
+	return rms_context.rms(mol1, mol2, c1, c2)
+
+
+def mol_topology_key(mol):
+	"""
+	Returns a hashable key that identifies the topology of a molecule (atoms
+	and bonds in the same order), independently of its conformers
+	"""
+
+	atoms = tuple((atom.GetAtomicNum(),atom.GetFormalCharge(),atom.GetTotalNumHs()) for atom in mol.GetAtoms())
+	bonds = tuple((bond.GetBeginAtomIdx(),bond.GetEndAtomIdx(),str(bond.GetBondType())) for bond in mol.GetBonds())
+	return (atoms,bonds)
+
+
+class RMSDContext:
+	"""
+	Class that stores the atoms and the symmetry-equivalent atom permutations
+	of a topology, so they are only calculated once for all the RMSD
+	calculations of its conformers.
+
+	Parameters
+	----------
+	mol : rdkit.Chem.Mol
+		Molecule that defines the topology of the conformers
+	heavy : bool
+		If True it will ignore the H atoms when computing the RMSD
+	max_matches_rmsd : int
+		the max number of matches found in a SubstructMatch()
+	"""
+
+	def __init__(self, mol, heavy, max_matches_rmsd):
+		self.atom_idx, self.perms = get_rmsd_atom_maps(mol, heavy, max_matches_rmsd)
+		# used when the target conformer of GetBestRMS() is passed as probe
+		self.inv_perms = np.argsort(self.perms, axis=1)
+
+	def coords(self, mol, conf=-1):
+		"""
+		Returns the coordinates of the atoms used in the RMSD (numpy.array)
+		"""
+
+		return mol.GetConformer(conf).GetPositions()[self.atom_idx]
+
+	def rms_batch(self, xyz_prb, xyz_refs, inverse=False):
+		"""
+		Best RMSD between one probe and a set of target conformers (coordinates
+		from coords()). If inverse is True, the targets are treated as the
+		probes of GetBestRMS() and vice versa.
+		"""
+
+		perms = self.inv_perms if inverse else self.perms
+		return get_best_rms_batch(xyz_prb, xyz_refs, perms)
+
+	def rms(self, mol1, mol2, c1=-1, c2=-1):
+		"""
+		Same as GetBestRMS(mol1, mol2, c1, c2)
+		"""
+
+		xyz_refs = self.coords(mol2, c2)[np.newaxis]
+		return float(self.rms_batch(self.coords(mol1, c1), xyz_refs)[0])
+
+
+# RMSD contexts stored per topology (see get_rmsd_context)
+RMSD_CONTEXTS = {}
+MAX_RMSD_CONTEXTS = 100
+
+
+def get_rmsd_context(mol, heavy, max_matches_rmsd):
+	"""
+	Returns the RMSDContext of the topology of mol, creating it only the first
+	time that the topology is found.
+
+	Parameters
+	----------
+	mol : rdkit.Chem.Mol
+		Molecule that defines the topology of the conformers
+	heavy : bool
+		If True it will ignore the H atoms when computing the RMSD
+	max_matches_rmsd : int
+		the max number of matches found in a SubstructMatch()
+
+	Returns
+	-------
+	RMSDContext
+	"""
+
+	key = (mol_topology_key(mol), heavy, max_matches_rmsd)
+	if key not in RMSD_CONTEXTS:
+		if len(RMSD_CONTEXTS) >= MAX_RMSD_CONTEXTS:
+			# remove the oldest context
+			RMSD_CONTEXTS.pop(next(iter(RMSD_CONTEXTS)))
+		RMSD_CONTEXTS[key] = RMSDContext(mol, heavy, max_matches_rmsd)
+	return RMSD_CONTEXTS[key]
+
+
+class ConformerEnsemble:
+	"""
+	Class that stores a set of conformers with the same topology. The
+	coordinates of all the conformers are kept in a single array instead of
+	one rdkit.Chem.Mol copy per conformer.
+
+	Parameters
+	----------
+	mol : rdkit.Chem.Mol
+		Molecule that defines the topology of the conformers
+	coords : numpy.array
+		Array of shape (n_confs, n_atoms, 3) with the coordinates
+	energies : list
+		Energies of the conformers (None if they are not calculated yet)
+	names : list
+		Names of the conformers (by default, the name of mol)
+	props : list
+		Dictionaries with the properties of the conformers written in the SDF
+		files (by default, the properties of mol)
+	"""
+
+	def __init__(self, mol, coords, energies=None, names=None, props=None):
+		self.coords = np.ascontiguousarray(coords, dtype=np.float64).reshape(
+			-1, mol.GetNumAtoms(), 3
+		)
+		n_confs = len(self.coords)
+		if energies is None:
+			energies = np.zeros(n_confs)
+		self.energies = np.array(energies, dtype=np.float64)
+		if names is None:
+			name = mol.GetProp("_Name") if mol.HasProp("_Name") else ""
+			names = [name] * n_confs
+		self.names = list(names)
+		if props is None:
+			mol_props = {prop: mol.GetProp(prop) for prop in mol.GetPropNames()}
+			props = [dict(mol_props) for _ in range(n_confs)]
+		self.props = [dict(conf_props) for conf_props in props]
+
+		# the topology is stored without conformers and properties
+		self.mol = Chem.Mol(mol)
+		self.mol.RemoveAllConformers()
+		for prop in list(self.mol.GetPropNames()):
+			self.mol.ClearProp(prop)
+
+	@classmethod
+	def from_mol(cls, mol, conf_ids=None):
+		"""
+		Creates the ensemble from the conformers of a molecule (by default,
+		all of them)
+		"""
+
+		if conf_ids is None:
+			conf_ids = [conformer.GetId() for conformer in mol.GetConformers()]
+		coords = np.array([mol.GetConformer(conf).GetPositions() for conf in conf_ids])
+		return cls(mol, coords)
+
+	def __len__(self):
+		return len(self.coords)
+
+	def set_prop(self, idx, prop, value):
+		self.props[idx][prop] = str(value)
+
+	def to_mol(self, idx):
+		"""
+		Returns an rdkit.Chem.Mol object with conformer idx of the ensemble
+		and its name and properties
+		"""
+
+		mol = Chem.Mol(self.mol)
+		conformer = Chem.Conformer(mol.GetNumAtoms())
+		set_conformer_coords(conformer, self.coords[idx])
+		mol.AddConformer(conformer, assignId=True)
+		mol.SetProp("_Name", self.names[idx])
+		for prop, value in self.props[idx].items():
+			mol.SetProp(prop, value)
+		return mol
+
+
+class EnsembleWriter:
+	"""
+	Replacement of rdkit.Chem.SDWriter that keeps the written conformers in
+	memory, so they can be passed to the next step of a pipeline without
+	reading SDF files. The conformers are also written to an SDF file if a
+	checkpoint file is used.
+
+	Parameters
+	----------
+	checkpoint : str
+		SDF file written with the conformers (None to keep them only in memory)
+	"""
+
+	def __init__(self, checkpoint=None):
+		self.mol = None
+		self.coords, self.names, self.props = [], [], []
+		self.sdwriter = None
+		if checkpoint is not None:
+			Path(checkpoint).parent.mkdir(exist_ok=True, parents=True)
+			self.sdwriter = Chem.SDWriter(str(checkpoint))
+
+	def write(self, mol, confId=-1):
+		if self.mol is None:
+			self.mol = Chem.Mol(mol)
+		self.coords.append(mol.GetConformer(confId).GetPositions())
+		self.names.append(mol.GetProp("_Name") if mol.HasProp("_Name") else "")
+		self.props.append({prop: mol.GetProp(prop) for prop in mol.GetPropNames()})
+		if self.sdwriter is not None:
+			self.sdwriter.write(mol, confId)
+
+	def close(self):
+		if self.sdwriter is not None:
+			self.sdwriter.close()
+			self.sdwriter = None
+
+	def ensemble(self):
+		"""
+		Returns the written conformers as a ConformerEnsemble (None if no
+		conformers were written)
+		"""
+
+		if self.mol is None:
+			return None
+		return ConformerEnsemble(self.mol, self.coords, names=self.names, props=self.props)
+
+
+def get_rmsd_atom_maps(mol, heavy, max_matches_rmsd):
+	"""
+	Obtains the atoms and the symmetry-equivalent atom permutations used by
+	GetBestRMS() to compare two conformers with the topology of mol.
+
+	Parameters
+	----------
+	mol : rdkit.Chem.Mol
+		Molecule that defines the topology of the conformers
+	heavy : bool
+		If True it will ignore the H atoms (same atoms kept by RemoveHs())
+	max_matches_rmsd : int
+		the max number of matches found in a SubstructMatch()
+
+	Returns
+	-------
+	atom_idx : numpy.array
+		Indices of the atoms (in mol) used in the RMSD
+	perms : numpy.array
+		Array of shape (n_matches, len(atom_idx)). Atom i of the probe is
+		compared to atom perms[k][i] of the target
+	"""
+
+	mol_rms = Chem.Mol(mol)
+	for atom in mol_rms.GetAtoms():
+		atom.SetIntProp("aqme_idx", atom.GetIdx())
 	if heavy:
-		mol1 = RemoveHs(mol1)
-		mol2 = RemoveHs(mol2)
-	return GetBestRMS(mol1, mol2, c1, c2, maxMatches=max_matches_rmsd)
+		mol_rms = RemoveHs(mol_rms)
+	atom_idx = np.array([atom.GetIntProp("aqme_idx") for atom in mol_rms.GetAtoms()])
+
+	# same clean-up of conjugated terminal groups (i.e. COO-, NO2) used by GetBestRMS()
+	mol_rms = Chem.RWMol(mol_rms)
+	pattern = Chem.MolFromSmarts("[#7,#8;D1]=,:[*]-,:[#7,#8;D1]")
+	for match in mol_rms.GetSubstructMatches(pattern):
+		if mol_rms.GetAtomWithIdx(match[0]).GetAtomicNum() == mol_rms.GetAtomWithIdx(match[2]).GetAtomicNum():
+			for atom_term in [match[0],match[2]]:
+				mol_rms.GetAtomWithIdx(atom_term).SetFormalCharge(0)
+				mol_rms.GetBondBetweenAtoms(atom_term,match[1]).SetBondType(Chem.BondType.SINGLE)
+
+	matches = mol_rms.GetSubstructMatches(mol_rms, uniquify=False, maxMatches=max_matches_rmsd)
+	if len(matches) == 0:
+		matches = [tuple(range(mol_rms.GetNumAtoms()))]
+	perms = np.array(matches, dtype=int)
+
+	return atom_idx,perms
+
+
+def kabsch_rmsd(xyz_prb, xyz_ref):
+	"""
+	Calculates the RMSD after the optimal superposition (no reflections) of
+	pairs of conformers in a vectorized way.
+
+	Parameters
+	----------
+	xyz_prb : numpy.array
+		Coordinates of the probe conformers, shape (..., n_atoms, 3)
+	xyz_ref : numpy.array
+		Coordinates of the target conformers, shape (..., n_atoms, 3)
+
+	Returns
+	-------
+	numpy.array
+		RMSD of each pair, shape (...)
+	"""
+
+	xyz_prb = xyz_prb - xyz_prb.mean(axis=-2, keepdims=True)
+	xyz_ref = xyz_ref - xyz_ref.mean(axis=-2, keepdims=True)
+	n_atoms = xyz_prb.shape[-2]
+
+	cov = np.matmul(np.swapaxes(xyz_prb, -1, -2), xyz_ref)
+	u, sing_val, vt = np.linalg.svd(cov)
+	# sign correction to avoid reflections
+	sign = np.sign(np.linalg.det(np.matmul(u, vt)))
+	sign = np.where(sign == 0, 1.0, sign)
+	sing_val[..., -1] *= sign
+
+	sq_dev = (xyz_prb**2).sum(axis=(-1, -2)) + (xyz_ref**2).sum(axis=(-1, -2)) - 2*sing_val.sum(axis=-1)
+
+	return np.sqrt(np.maximum(sq_dev, 0.0) / n_atoms)
+
+
+def get_best_rms_batch(xyz_prb, xyz_refs, perms, max_elements=5000000):
+	"""
+	Vectorized version of GetBestRMS(). Calculates the best RMSD between one
+	probe conformer and a set of target conformers, considering all the
+	symmetry-equivalent atom permutations.
+
+	Parameters
+	----------
+	xyz_prb : numpy.array
+		Coordinates of the probe conformer, shape (n_atoms, 3)
+	xyz_refs : numpy.array
+		Coordinates of the target conformers, shape (n_confs, n_atoms, 3)
+	perms : numpy.array
+		Atom permutations from get_rmsd_atom_maps()
+	max_elements : int
+		Maximum number of coordinates handled at once (controls memory use)
+
+	Returns
+	-------
+	numpy.array
+		Best RMSD of the probe against each target conformer, shape (n_confs,)
+	"""
+
+	n_confs = len(xyz_refs)
+	best_rms = np.full(n_confs, np.inf)
+	if n_confs == 0:
+		return best_rms
+	chunk = max(1, int(max_elements // (3 * perms.shape[0] * perms.shape[1])))
+	for start in range(0, n_confs, chunk):
+		# targets reordered with every permutation, shape (n_chunk, n_perms, n_atoms, 3)
+		xyz_perm = xyz_refs[start:start+chunk][:, perms]
+		rms = kabsch_rmsd(xyz_prb[np.newaxis, np.newaxis], xyz_perm)
+		best_rms[start:start+chunk] = rms.min(axis=1)
+
+	return best_rms
 
 
 def command_line_args():
@@ -551,7 +979,9 @@ def command_line_args():
 		"rot_dihedral",
 		"nmr_online",
 		"qsub",
-		"qsub_ana"]
+		"qsub_ana",
+		"funnel_cmin",
+		"pipeline"]
 
 	for arg in var_dict:
 		if arg in bool_args:
@@ -635,6 +1065,9 @@ def load_variables(kwargs,aqme_module):
 
 		elif aqme_module == 'qprep':
 			logger_1 = 'QPREP'
+
+		elif aqme_module == 'pipeline':
+			logger_1 = 'PIPELINE'
 		
 		if txt_yaml not in ['', f'\no  Importing AQME parameters from {self.varfile}', "\nx  The specified yaml file containing parameters was not found! Make sure that the valid params file is in the folder where you are running the code.\n"]:
 			self.log = Logger(self.w_dir_main / logger_1,logger_2)
@@ -680,39 +1113,449 @@ def read_file(initial_dir, w_dir, file):
 	return outlines
 
 
-def QM_coords(outlines,min_RMS,n_atoms,program):
+# openers used to stream compressed QM output files
+COMPRESSED_OPENERS = {'.gz': gzip.open, '.bz2': bz2.open, '.xz': lzma.open}
+
+
+def reverse_readlines(file, block_size=65536):
+	"""
+	Yields the lines of a file starting from the end, reading blocks of block_size
+	bytes backwards so only the end of the file is loaded (the file is not read
+	until the lines are requested). Compressed files (gz, bz2, xz) can't be read
+	backwards, use tail_lines() to stream them from the start instead.
+	"""
+
+	if Path(file).suffix.lower() in COMPRESSED_OPENERS:
+		raise ValueError(f"{file} is compressed and can't be read backwards, use tail_lines()")
+
+	with open(file, "rb") as infile:
+		infile.seek(0, os.SEEK_END)
+		position = infile.tell()
+		remainder = b""
+		end_of_file = True
+		while position > 0:
+			read_size = min(block_size, position)
+			position -= read_size
+			infile.seek(position)
+			lines = (infile.read(read_size) + remainder).split(b"\n")
+			# the first line might be incomplete, it's completed with the next block
+			remainder = lines[0]
+			for line in reversed(lines[1:]):
+				if end_of_file:
+					end_of_file = False
+					# files usually end with a line break
+					if line != b"":
+						yield decode_line(line, "")
+				else:
+					yield decode_line(line, "\n")
+		if not end_of_file:
+			yield decode_line(remainder, "\n")
+		elif remainder != b"":
+			yield decode_line(remainder, "")
+
+
+def decode_line(line, line_break):
+	"""
+	Converts a line read in binary mode into text (using the same line breaks as
+	open() in text mode)
+	"""
+
+	if line.endswith(b"\r"):
+		line = line[:-1]
+	return line.decode("utf-8", errors="replace") + line_break
+
+
+def tail_lines(file, n_lines):
+	"""
+	Retrieves a list with the last n_lines lines of a file (in the original order)
+	without reading the whole file into memory.
+	"""
+
+	opener = COMPRESSED_OPENERS.get(Path(file).suffix.lower())
+	if opener is not None:
+		with opener(file, "rt", errors="replace") as infile:
+			return list(deque(infile, maxlen=n_lines))
+
+	outlines = []
+	for line in reverse_readlines(file):
+		if len(outlines) == n_lines:
+			break
+		outlines.append(line)
+	return outlines[::-1]
+
+
+class QMMetadataParser:
+	"""
+	Single-pass parser of the metadata and properties of Gaussian and ORCA output
+	files that are missing from cclib (keywords line, functional, S**2, rotational
+	data, etc.). The lines are fed one by one from the start of the file and the
+	values are stored as soon as they are found, so only a few lines are kept in
+	memory. For properties printed multiple times (i.e. <S**2> or rotational data
+	during optimizations), the last value of the file is kept.
+	"""
+
+	def __init__(self):
+		self.program = None
+		self.metadata = {}
+		self.properties = {'energy': {}}
+		# state used for data printed over multiple lines
+		self.state = None
+		self.state_lines = 0
+		self.asterisks_line = None
+		self.keywords_line = ''
+		self.scf_found = False
+		self.zero_point_corr = 0.0
+
+	@classmethod
+	def from_file(cls, file):
+		"""
+		Parses an output file (or a compressed output file) and returns the metadata
+		and properties found
+		"""
+
+		parser = cls()
+		opener = COMPRESSED_OPENERS.get(Path(file).suffix.lower(), open)
+		with opener(file, "rt", errors="replace") as infile:
+			for line in infile:
+				parser.feed(line)
+		return parser.record()
+
+	def record(self):
+		return {'program': self.program, 'metadata': self.metadata, 'properties': self.properties}
+
+	def set_state(self, state):
+		self.state = state
+		self.state_lines = 0
+
+	def feed(self, line):
+		"""
+		Updates the metadata and properties with the next line of the output file
+		"""
+
+		if self.state is not None:
+			self.state_lines += 1
+			getattr(self, f'feed_{self.state}')(line)
+		elif self.program is None:
+			if line.strip() == "Cite this work as:":
+				self.program = 'gaussian'
+				self.properties['rotational'] = {}
+				self.set_state('gaussian_version')
+			elif '* O   R   C   A *' in line:
+				self.program = 'orca'
+				self.set_state('orca_version')
+		elif self.program == 'gaussian':
+			self.feed_gaussian(line)
+		elif self.program == 'orca':
+			self.feed_orca(line)
+
+	def feed_gaussian_version(self, line):
+		self.metadata['QM program'] = line[1:-2]
+		self.set_state('run_date')
+
+	def feed_run_date(self, line):
+		# the run date is printed two lines below the first line of asterisks
+		if self.asterisks_line is None:
+			if '**********' in line:
+				self.asterisks_line = self.state_lines
+			elif self.state_lines > 60:
+				self.set_state(None)
+		elif self.state_lines == self.asterisks_line + 2:
+			self.metadata['run date'] = line.strip()
+			self.set_state(None)
+
+	def feed_orca_version(self, line):
+		if 'Program Version' in line:
+			self.metadata['QM program'] = "ORCA version " + line.split()[2]
+			self.set_state(None)
+		elif self.state_lines > 100:
+			self.set_state(None)
+
+	def feed_keywords(self, line):
+		# the keywords line might be split over several lines
+		if '----------' in line or self.state_lines >= 10:
+			self.set_keywords(self.keywords_line[2:])
+			self.set_state(None)
+		else:
+			self.keywords_line += line.rstrip("\n")[1:]
+
+	def feed_zmatrix(self, line):
+		# the line with charge and multiplicity is followed by one line per atom
+		if self.state_lines == 1:
+			self.feed_gaussian(line)
+		elif len(line.split()) > 0:
+			self.properties['number of atoms'] = self.state_lines - 1
+		else:
+			self.set_state(None)
+
+	def set_keywords(self, keywords_line):
+		"""
+		Stores the keywords line, solvation, dispersion and calculation type
+		"""
+
+		self.metadata['keywords line'] = keywords_line
+		qm_solv,qm_disp = 'gas_phase','none'
+		calc_type = 'ground_state'
+		calcfc_found, ts_found = False, False
+		for keyword in keywords_line.split():
+			if keyword.lower().find('opt') > -1:
+				if keyword.lower().find('calcfc') > -1:
+					calcfc_found = True
+				if keyword.lower().find('ts') > -1:
+					ts_found = True
+			elif keyword.lower().startswith('scrf'):
+				qm_solv = keyword
+			elif keyword.lower().startswith('emp'):
+				qm_disp = keyword
+		if calcfc_found and ts_found:
+			calc_type = 'transition_state'
+		self.metadata['solvation'] = qm_solv
+		self.metadata['dispersion model'] = qm_disp
+		self.metadata['ground or transition state'] = calc_type
+
+	def feed_gaussian(self, line):
+		# metadata from the input section (until the first SCF energy)
+		if not self.scf_found:
+			if '%mem' in line:
+				self.metadata['memory'] = line.strip().split('=')[-1]
+
+			elif '%nprocs' in line:
+				self.metadata['processors'] = int(line.strip().split('=')[-1])
+
+			elif line.strip().startswith('#') and 'keywords line' not in self.metadata:
+				self.keywords_line = line.rstrip("\n")[1:]
+				self.set_state('keywords')
+
+			elif line[1:15] == "Standard basis":
+				self.metadata['basis set'] = line.split()[2]
+
+			elif line[1:9] == 'SCF Done':
+				t1 = line.split()[2]
+				if t1 == 'E(RHF)':
+					self.metadata['functional'] = 'HF'
+				else:
+					self.metadata['functional'] = t1[t1.index("(") + 2:t1.rindex(")")]
+				self.scf_found = True
+
+			elif line[1:8] == 'ExpMin=':
+				grid_lookup = {1: 'sg1', 2: 'coarse', 4: 'fine', 5: 'ultrafine', 7: 'superfine'}
+				IRadAn = int(line.strip().split()[-3])
+				if IRadAn in grid_lookup:
+					self.metadata['grid type'] = grid_lookup[IRadAn]
+
+		# charge, mult and number of atoms from the input geometry
+		if 'charge' not in self.properties and line.find("Charge = ") > -1:
+			self.properties['charge'] = int(line.split()[2])
+			self.properties['multiplicity'] = int(line.split()[5])
+
+		elif 'number of atoms' not in self.properties and line.find('Symbolic Z-matrix:') > -1:
+			self.set_state('zmatrix')
+
+		# For time dependent (TD) calculations
+		elif 'E(TD-HF/TD-DFT)' in line:
+			td_e = float(line.strip().split()[-1])
+			self.properties['energy']['TD energy'] = cclib.parser.utils.convertor(td_e, "hartree", "eV")
+
+		# For G4 calculations look for G4 energies (Gaussian16a bug prints G4(0 K) as DE(HF)) --Brian modified to work for G16c-where bug is fixed.
+		elif line.strip().startswith('E(ZPE)='): #Overwrite DFT ZPE with G4 ZPE
+			self.zero_point_corr = float(line.strip().split()[1])
+		elif line.strip().startswith('G4(0 K)'):
+			G4_energy = float(line.strip().split()[2])
+			G4_energy -= self.zero_point_corr #Remove G4 ZPE
+			self.properties['energy']['G4 energy'] = cclib.parser.utils.convertor(G4_energy, "hartree", "eV")
+
+		# For ONIOM calculations use the extrapolated value rather than SCF value
+		elif "ONIOM: extrapolated energy" in line:
+			oniom_e = float(line.strip().split()[4])
+			self.properties['energy']['ONIOM energy'] = cclib.parser.utils.convertor(oniom_e, "hartree", "eV")
+
+		# Extract <S**2> before and after spin annihilation
+		elif 'S**2 before annihilation' in line:
+			self.properties['S2 after annihilation'] = float(line.strip().split()[-1])
+			self.properties['S2 before annihilation'] = float(line.strip().split()[-3][:-1])
+
+		# Extract symmetry point group
+		elif 'Full point group' in line:
+			self.properties['rotational']['symmetry point group'] = line.strip().split()[3]
+
+		# Extract symmetry number, rotational constants and rotational temperatures
+		elif 'Rotational symmetry number' in line:
+			symmno = int(line.strip().split()[3].split(".")[0])
+			self.properties['rotational']['symmetry number'] = symmno
+
+		elif line.find('Rotational constants (GHZ):') > -1:
+			roconst = line.strip().replace(':', ' ').split()
+			try:
+				roconst = [float(roconst[3]), float(roconst[4]), float(roconst[5])]
+			except ValueError:
+				# linear molecules print asterisks in the first constant
+				roconst = [float(roconst[4]), float(roconst[5])]
+			self.properties['rotational']['rotational constants'] = roconst
+
+		elif line.find('Rotational temperature ') > -1:
+			self.properties['rotational']['rotational temperatures'] = [float(line.strip().split()[3])]
+
+		elif line.find('Rotational temperatures') > -1:
+			rotemp = line.strip().split()
+			try:
+				rotemp = [float(rotemp[3]), float(rotemp[4]), float(rotemp[5])]
+			except ValueError:
+				rotemp = [float(rotemp[4]), float(rotemp[5])]
+			self.properties['rotational']['rotational temperatures'] = rotemp
+
+	def feed_orca(self, line):
+		if line[:25] == 'FINAL SINGLE POINT ENERGY':
+			# in eV to match the format from cclib
+			orca_e = float(line.split()[-1])
+			self.properties['energy']['final single point energy'] = cclib.parser.utils.convertor(orca_e, "hartree", "eV")
+
+		# keywords lines from the input file printed by ORCA (i.e. |  1> ! B3LYP def2-SVP)
+		elif line.strip().startswith('|') and '> !' in line:
+			keywords = line.split('> !',1)[1].strip()
+			if 'keywords line' in self.metadata:
+				keywords = f"{self.metadata['keywords line']} {keywords}"
+			self.metadata['keywords line'] = keywords
+
+		elif 'charge' not in self.properties and line.strip().startswith('Total Charge'):
+			self.properties['charge'] = int(line.split()[-1])
+
+		elif 'multiplicity' not in self.properties and line.strip().startswith('Multiplicity') and '...' in line:
+			self.properties['multiplicity'] = int(line.split()[-1])
+
+		elif 'number of atoms' not in self.properties and line.strip().startswith('Number of atoms') and '...' in line:
+			self.properties['number of atoms'] = int(line.split()[-1])
+
+
+# indexes of the QM output files already scanned (updated if the files change)
+QM_OUTPUT_INDEXES = {}
+
+
+class QMOutputIndex:
+	"""
+	Byte offsets of the geometry blocks, SCF energies and convergence tables of a
+	Gaussian or ORCA output file, recorded in a single scan. Any of these entries
+	can then be read by seeking to its offset instead of loading the whole file
+	(i.e. the geometry with the lowest RMS force of a long failed optimization).
+	Use get_qm_index() to reuse the indexes of files that were already scanned.
+	The direct seeks only apply to uncompressed files, since seeking in compressed
+	files (gz, bz2, xz) decompresses the stream from the start up to the offset.
+	"""
+
+	def __init__(self, file):
+		self.file = file
+		self.geometry_format = None
+		self.geometries = []
+		self.scf_energies = []
+		self.convergence = []
+
+		offset = 0
+		with self.open_file() as infile:
+			for line in infile:
+				if b'Standard orientation:' in line:
+					self.geometries.append(offset)
+					self.geometry_format = 'gaussian'
+				elif b'CARTESIAN COORDINATES (ANGSTROEM)' in line:
+					self.geometries.append(offset)
+					self.geometry_format = 'orca'
+				elif line[1:9] == b'SCF Done' or line[:25] == b'FINAL SINGLE POINT ENERGY':
+					self.scf_energies.append(offset)
+				elif b'Converged?' in line:
+					self.convergence.append(offset)
+				offset += len(line)
+
+	def open_file(self):
+		opener = COMPRESSED_OPENERS.get(Path(self.file).suffix.lower(), open)
+		return opener(self.file, "rb")
+
+	def read_lines(self, offset, n_lines):
+		"""
+		Reads n_lines lines starting from a byte offset of the file (for compressed
+		files, the offset is in the decompressed data and seek() decompresses the
+		stream until that offset, so the reading time grows with the offset)
+		"""
+
+		with self.open_file() as infile:
+			infile.seek(offset)
+			return [decode_line(infile.readline().rstrip(b"\n"), "\n") for _ in range(n_lines)]
+
+	def geometry(self, block, n_atoms):
+		"""
+		Retrieves atom types and coordinates from a geometry block (block = -1 for the
+		last geometry)
+		"""
+
+		atom_types,cartesians = [],[]
+		if len(self.geometries) == 0:
+			return atom_types,cartesians
+		block = min(block, len(self.geometries)-1)
+
+		if self.geometry_format == 'gaussian':
+			per_tab = periodic_table()
+			outlines = self.read_lines(self.geometries[block], 5+n_atoms)
+			for line in outlines[5:]:
+				massno = int(line.split()[1])
+				if massno < len(per_tab):
+					atom_symbol = per_tab[massno]
+				else:
+					atom_symbol = "XX"
+				atom_types.append(atom_symbol)
+				cartesians.append([float(line.split()[3]), float(line.split()[4]), float(line.split()[5])])
+
+		elif self.geometry_format == 'orca':
+			outlines = self.read_lines(self.geometries[block], 2+n_atoms)
+			for line in outlines[2:]:
+				atom_types.append(line.split()[0])
+				cartesians.append([float(line.split()[1]), float(line.split()[2]), float(line.split()[3])])
+
+		return atom_types,cartesians
+
+	def scf_energy(self, block):
+		"""
+		Retrieves an SCF energy (in hartree) from the file (block = -1 for the last energy)
+		"""
+
+		line = self.read_lines(self.scf_energies[block], 1)[0]
+		if line[1:9] == 'SCF Done':
+			return float(line.split()[4])
+		return float(line.split()[-1])
+
+	def rms_force(self, block):
+		"""
+		Retrieves the RMS force of an optimization step from its convergence table
+		(None if the value is corrupted in the output file)
+		"""
+
+		outlines = self.read_lines(self.convergence[block], 3)
+		try:
+			return float(outlines[2].split()[2])
+		except (IndexError,ValueError):
+			return None
+
+
+def get_qm_index(file):
+	"""
+	Returns the QMOutputIndex of a file, scanning the file only if it wasn't indexed
+	before or if it changed since then
+	"""
+
+	file = Path(file).resolve()
+	stat = os.stat(file)
+	file_stamp = (stat.st_size, stat.st_mtime_ns)
+	if str(file) not in QM_OUTPUT_INDEXES or QM_OUTPUT_INDEXES[str(file)][0] != file_stamp:
+		QM_OUTPUT_INDEXES[str(file)] = (file_stamp, QMOutputIndex(file))
+
+	return QM_OUTPUT_INDEXES[str(file)][1]
+
+
+def QM_coords(file,min_RMS,n_atoms,program):
 	'''
-	Retrieves atom types and coordinates from QM output files
+	Retrieves atom types and coordinates from QM output files (geometry number
+	min_RMS of the optimization, or the last geometry if min_RMS = -1)
 	'''
 
-	atom_types,cartesians = [],[]
-	per_tab = periodic_table()
-	count_RMS = -1
-
-	if program == 'gaussian':
-		if min_RMS > -1:
-			for i,line in enumerate(outlines):
-				if line.find('Standard orientation:') > -1:
-					count_RMS += 1
-				if count_RMS == min_RMS:
-					range_lines = [i+5,i+5+n_atoms]
-					break
-		else:
-			for i in reversed(range(len(outlines))):
-				if outlines[i].find('Standard orientation:') > -1:
-					range_lines = [i+5,i+5+n_atoms]
-					break
-
-		for i in range(range_lines[0],range_lines[1]):
-			massno = int(outlines[i].split()[1])
-			if massno < len(per_tab):
-				atom_symbol = per_tab[massno]
-			else:
-				atom_symbol = "XX"
-			atom_types.append(atom_symbol)
-			cartesians.append([float(outlines[i].split()[3]), float(outlines[i].split()[4]), float(outlines[i].split()[5])])
+	if program not in ['gaussian','orca']:
+		return [],[]
 
-	return atom_types,cartesians
+	return get_qm_index(file).geometry(min_RMS,n_atoms)
 
 
 def cclib_atoms_coords(cclib_data):
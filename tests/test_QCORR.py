@@ -397,3 +397,175 @@ def test_QCORR_analysis(init_folder, file, command_line, target_folder, restore_
         shutil.rmtree(f'{path_main}/Example_workflows')
         filepath = Path(f'{path_main}/Example_workflows_original')
         filepath.rename(f'{path_main}/Example_workflows')
+
+
+# the results of the parallel analysis must match those of the serial analysis
+def test_QCORR_parallel(tmp_path):
+    stats = {}
+    for workers in ['1', '3']:
+        w_dir_main = tmp_path.joinpath(f'QCORR_workers_{workers}')
+        shutil.copytree(f'{path_qcorr}/QCORR_1', w_dir_main)
+        cmd_aqme = ['python', '-m', 'aqme', '--qcorr', '--w_dir_main', str(w_dir_main), '--files', '*.log',
+                    '--freq_conv', 'opt=(calcfc,maxstep=5)', '--workers_qcorr', workers]
+        subprocess.run(cmd_aqme)
+
+        stats[workers] = pd.read_csv(f'{w_dir_main}/QCORR-run_1-stats.csv')
+        files = sorted(str(file.relative_to(w_dir_main)) for file in w_dir_main.rglob('*.*'))
+        stats[f'files_{workers}'] = [file for file in files if not file.endswith('.dat')]
+
+    assert stats['1'].equals(stats['3'])
+    assert stats['files_1'] == stats['files_3']
+
+
+# near-duplicates don't chain: C is compared against A (kept), not against B (duplicate of A)
+def test_QCORR_duplicate_chain(tmp_path):
+    from types import SimpleNamespace
+    from aqme.qcorr import qcorr
+    from aqme.qcorr_utils import DuplicateIndex
+
+    qcorr_obj = qcorr.__new__(qcorr)
+    qcorr_obj.args = SimpleNamespace(w_dir_main=tmp_path, round_num=1, log=SimpleNamespace(write=lambda text: None))
+    errortypes = {}
+    def organize_outputs(file, termination, errortype, file_terms):
+        errortypes[file] = errortype
+        return file_terms, tmp_path
+    qcorr_obj.organize_outputs = organize_outputs
+    qcorr_obj.write_json = lambda cclib_data, destination, file_name: None
+
+    duplicate_data = DuplicateIndex(0.0001)
+    for file, E_dup in [('A.log', -40.51860), ('B.log', -40.51853), ('C.log', -40.51846)]:
+        qcorr_data = {'file': file, 'file_name': file.split('.')[0], 'termination': 'normal',
+                      'errortype': 'none', 'cclib_data': {}, 'atom_types': [], 'cartesians': [],
+                      'dup_data': {'energies': [E_dup, E_dup, E_dup], 'reference': True}, 'isomerized': False}
+        _, duplicate_data, _ = qcorr_obj.qcorr_reduce(qcorr_data, {}, duplicate_data)
+
+    assert errortypes == {'A.log': 'none', 'B.log': 'duplicate_calc', 'C.log': 'none'}
+    assert sorted(duplicate_data.accepted) == ['A', 'C']
+
+
+# duplicates are detected from neighbouring cells of the index and from previous QCORR runs
+def test_QCORR_duplicate_index(tmp_path):
+    from aqme.qcorr_utils import DuplicateIndex
+
+    dup_index = DuplicateIndex(0.0001)
+    dup_index.add([-40.51860, -40.47330, -40.49450])
+    dup_index.accept('CH4', [-40.51860, -40.47330, -40.49450])
+    assert dup_index.is_duplicate([-40.51865, -40.47335, -40.49455])
+    assert not dup_index.is_duplicate([-40.51880, -40.47330, -40.49450])
+    assert not dup_index.is_duplicate([-40.51860, -40.47330, -40.49470])
+
+    # B is a duplicate of CH4 and isn't added, so C (duplicate of B but not of CH4) is kept
+    assert dup_index.is_duplicate([-40.51853, -40.47323, -40.49443])
+    assert not dup_index.is_duplicate([-40.51846, -40.47316, -40.49436])
+
+    dup_file = tmp_path.joinpath('QCORR-duplicates.json')
+    dup_index.save(dup_file)
+    dup_index_run_2 = DuplicateIndex.load(dup_file, 0.0001)
+    assert dup_index_run_2.is_duplicate([-40.51855, -40.47330, -40.49450])
+    assert not DuplicateIndex.load(tmp_path.joinpath('missing.json'), 0.0001).is_duplicate([-40.51860, -40.47330, -40.49450])
+
+
+# the end of the output files is read backwards (or streamed for compressed files)
+def test_QCORR_tail_lines(tmp_path):
+    import gzip
+    from aqme.utils import reverse_readlines, tail_lines
+
+    outlines = [f'line {i}\n' for i in range(5000)] + [' Normal termination of Gaussian 16\n']
+    log_file = tmp_path.joinpath('tail.log')
+    with open(log_file, 'w') as outfile:
+        outfile.writelines(outlines)
+    with gzip.open(tmp_path.joinpath('tail.log.gz'), 'wt') as outfile:
+        outfile.writelines(outlines)
+
+    assert tail_lines(log_file, 16) == outlines[-16:]
+    assert tail_lines(tmp_path.joinpath('tail.log.gz'), 16) == outlines[-16:]
+    assert list(reverse_readlines(log_file, block_size=100)) == outlines[::-1]
+    with pytest.raises(ValueError):
+        next(reverse_readlines(tmp_path.joinpath('tail.log.gz')))
+
+
+# metadata and properties from the single-pass parser of QM output files
+def test_QCORR_metadata_parser():
+    from aqme.utils import QMMetadataParser
+
+    qm_data = QMMetadataParser.from_file(f'{path_qcorr}/QCORR_1/CH4.log')
+    assert qm_data['program'] == 'gaussian'
+    assert qm_data['metadata']['QM program'] == 'Gaussian 09, Revision A.02'
+    assert qm_data['metadata']['keywords line'] == 'opt freq 3-21g m062x'
+    assert qm_data['metadata']['functional'] == 'M062X'
+    assert qm_data['metadata']['basis set'] == '3-21G'
+    assert qm_data['metadata']['grid type'] == 'sg1'
+    assert qm_data['metadata']['ground or transition state'] == 'ground_state'
+    assert qm_data['properties']['charge'] == 0
+    assert qm_data['properties']['multiplicity'] == 1
+    assert qm_data['properties']['number of atoms'] == 5
+    assert qm_data['properties']['rotational']['symmetry point group'] == 'C1'
+
+
+# geometries are read from their byte offsets in the output files
+def test_QCORR_output_index():
+    from aqme.utils import get_qm_index, QM_coords
+
+    file = f'{path_qcorr}/QCORR_1/CH4.log'
+    qm_index = get_qm_index(file)
+    assert len(qm_index.geometries) == 5
+    assert get_qm_index(file) is qm_index
+
+    atom_types,cartesians = QM_coords(file,-1,5,'gaussian')
+    assert atom_types == ['C', 'H', 'H', 'H', 'H']
+    assert len(cartesians) == 5
+    assert QM_coords(file,0,5,'gaussian')[1] != cartesians
+    assert round(qm_index.scf_energy(-1),6) == -40.264963
+
+
+# only the resumed rounds use the calculations of previous runs, and only if their files still exist
+def test_QCORR_duplicate_index_files(tmp_path):
+    from aqme.qcorr_utils import DuplicateIndex
+
+    dup_index = DuplicateIndex(0.0001)
+    for name, E_dup in [('CH4', -40.51860), ('CH4_moved', -40.60000)]:
+        dup_index.add([E_dup, E_dup, E_dup])
+        dup_index.accept(name, [E_dup, E_dup, E_dup])
+    dup_file = tmp_path.joinpath('QCORR-duplicates.json')
+    dup_index.save(dup_file)
+
+    successful_folder = tmp_path.joinpath('successful_QM_outputs')
+    successful_folder.mkdir()
+    successful_folder.joinpath('CH4.log').write_text('')
+    dup_index_run_2 = DuplicateIndex.load(dup_file, 0.0001, successful_folder)
+    assert sorted(dup_index_run_2.accepted) == ['CH4']
+    assert dup_index_run_2.is_duplicate([-40.51860, -40.51860, -40.51860])
+    assert not dup_index_run_2.is_duplicate([-40.60000, -40.60000, -40.60000])
+
+
+# a new QCORR analysis on fresh outputs in the same folder doesn't use the previous calculations
+def test_QCORR_duplicates_new_analysis(tmp_path):
+    w_dir_main = tmp_path.joinpath('QCORR_rerun')
+    shutil.copytree(f'{path_qcorr}/QCORR_1', w_dir_main)
+    cmd_aqme = ['python', '-m', 'aqme', '--qcorr', '--w_dir_main', str(w_dir_main), '--files', '*.log',
+                '--freq_conv', 'opt=(calcfc,maxstep=5)']
+    subprocess.run(cmd_aqme)
+    stats_run_1 = pd.read_csv(f'{w_dir_main}/QCORR-run_1-stats.csv')
+
+    # clean copy of the output files in the same folder
+    for file in glob.glob(f'{path_qcorr}/QCORR_1/*.log'):
+        shutil.copy(file, w_dir_main)
+    subprocess.run(cmd_aqme)
+    stats_run_2 = pd.read_csv(f'{w_dir_main}/QCORR-run_2-stats.csv')
+
+    assert stats_run_1['Duplicates'][0] == stats_run_2['Duplicates'][0] == 1
+    assert stats_run_1['Normal termination'][0] == stats_run_2['Normal termination'][0]
+
+
+# the in-process cclib parsing gives the same json data as the ccwrite command
+@pytest.mark.parametrize("file", ['CH4.log', 'MeOH_G09.log', 'TS_CH3HCH3.log', 'CO2_linear_4freqs.log', 'CH4_SP.log'])
+def test_QCORR_cclib_json(tmp_path, file):
+    import json
+    from aqme.qcorr_utils import cclib_json_data
+
+    shutil.copy(f'{path_qcorr}/QCORR_1/{file}', tmp_path)
+    subprocess.run(['ccwrite', 'json', file], cwd=tmp_path)
+    with open(tmp_path.joinpath(f'{file.split(".")[0]}.json')) as json_file:
+        json_ccwrite = json.load(json_file)
+
+    assert cclib_json_data(tmp_path.joinpath(file)) == json_ccwrite
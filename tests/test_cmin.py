@@ -82,3 +82,179 @@ def test_cmin_xtb_parameters(program, sdf, metal_complex,metal,metal_oxi,complex
 	assert int(mols[0].GetProp('Mult')) == mult
 
 	os.chdir(w_dir_main)
+
+# the batched FIRE optimization of ANI follows ase.optimize.FIRE
+@pytest.mark.parametrize(
+	"fmax, steps, converged",
+	[
+		(0.0001, 10, False),
+		(0.5, 200, True),
+	],
+)
+def test_cmin_ani_batch_fire(fmax, steps, converged):
+	import ase
+	import ase.optimize
+	import numpy as np
+	import torch
+	from rdkit.Chem import AllChem as Chem
+	from aqme.cmin import get_ani_model, ani_species_to_tensor, ani_batch_optimization
+
+	mol = Chem.AddHs(Chem.MolFromSmiles("CCO"))
+	Chem.EmbedMolecule(mol, randomSeed=42)
+	elements = "".join(atom.GetSymbol() for atom in mol.GetAtoms())
+	coords = mol.GetConformer().GetPositions()
+	model = get_ani_model("ANI2x")
+	species = ani_species_to_tensor("ANI2x", [atom.GetSymbol() for atom in mol.GetAtoms()]).unsqueeze(0)
+	assert torch.equal(species[0], model.species_to_tensor(elements))
+
+	ase_molecule = ase.Atoms(elements, positions=coords, calculator=model.ase())
+	ase.optimize.FIRE(ase_molecule, logfile=None).run(fmax=fmax, steps=steps)
+
+	_, positions, converged_confs = ani_batch_optimization(
+		model, species, torch.as_tensor(coords).unsqueeze(0), fmax, steps, partial=True
+	)
+	assert bool(converged_confs[0]) == converged
+	np.testing.assert_allclose(positions[0].numpy(), ase_molecule.get_positions(), atol=1e-3)
+
+	# conformers that don't converge keep their initial geometry (as in xtb_opt)
+	_, positions, _ = ani_batch_optimization(
+		model, species, torch.as_tensor(coords).unsqueeze(0), fmax, steps
+	)
+	if converged:
+		np.testing.assert_allclose(positions[0].numpy(), ase_molecule.get_positions(), atol=1e-3)
+	else:
+		np.testing.assert_allclose(positions[0].numpy(), coords)
+
+
+def write_cmin_input(folder, smi="CCCCC", name="pentane", n_confs=6):
+	# SDF file with RDKit conformers, as written by CSEARCH
+	from rdkit.Chem import AllChem as Chem
+
+	mol = Chem.AddHs(Chem.MolFromSmiles(smi))
+	cids = Chem.EmbedMultipleConfs(mol, n_confs, randomSeed=42)
+	sdf = str(folder.joinpath(f"{name}_rdkit.sdf"))
+	writer = Chem.SDWriter(sdf)
+	for cid in cids:
+		mol.SetProp("_Name", f"{name}_{cid+1}")
+		writer.write(mol, confId=cid)
+	writer.close()
+	return sdf
+
+
+def read_cmin_energies(folder, name="pentane", program="ani"):
+	file = str(folder.joinpath(f"CMIN/{program}/{name}_rdkit_{program}_all_confs.sdf"))
+	mols = rdkit.Chem.SDMolSupplier(file, removeHs=False)
+	return sorted((mol.GetProp("_Name"), float(mol.GetProp("Energy"))) for mol in mols)
+
+
+# a second run with the same cache_cmin reads the optimizations from the cache
+def test_cmin_cache(tmp_path, monkeypatch):
+	import aqme.cmin
+
+	cache_dir = tmp_path.joinpath("cmin_cache")
+	energies = []
+	for run in range(2):
+		w_dir_run = tmp_path.joinpath(f"run_{run}")
+		w_dir_run.mkdir()
+		sdf = write_cmin_input(w_dir_run)
+		if run == 1:
+			# no optimizations are run if all the conformers are in the cache
+			def no_optimizations(*args):
+				raise AssertionError("the conformers should be read from the cache")
+			monkeypatch.setattr(aqme.cmin, "ani_batch_worker", no_optimizations)
+		cmin(w_dir_main=w_dir_run, program="ani", files=sdf, cache_cmin=str(cache_dir), max_workers=1)
+		energies.append(read_cmin_energies(w_dir_run))
+		os.chdir(w_dir_main)
+
+	assert len(list(cache_dir.glob("*/*.npz"))) == 6
+	assert energies[0] == energies[1]
+
+
+# the CMIN funnel discards conformers before the full optimization
+@pytest.mark.parametrize(
+	"ewin_funnel_cmin, steps_funnel_cmin, survivors",
+	[
+		(0.0001, 5, 1),
+		(1000.0, 5, 6),
+	],
+)
+def test_cmin_funnel(tmp_path, ewin_funnel_cmin, steps_funnel_cmin, survivors):
+	sdf = write_cmin_input(tmp_path)
+	cmin(w_dir_main=tmp_path, program="ani", files=sdf, funnel_cmin=True, ewin_funnel_cmin=ewin_funnel_cmin,
+		steps_funnel_cmin=steps_funnel_cmin, opt_steps=20, verbose=True, max_workers=1)
+	os.chdir(w_dir_main)
+
+	# all the conformers that reach the full optimization are in the _all_confs file
+	assert len(read_cmin_energies(tmp_path)) == survivors
+
+	with open(tmp_path.joinpath("AQME_data.dat"), "r") as log_file:
+		log = log_file.read()
+	assert f"o  {6 - survivors} conformers of pentane_rdkit rejected after the single-point funnel stage (E > {ewin_funnel_cmin} kcal/mol)" in log
+	assert "o  0 conformers of pentane_rdkit rejected after the short optimization funnel stage" in log
+
+
+# the species indices are obtained without loading the ANI networks
+@pytest.mark.parametrize("ani_method", ["ANI1x", "ANI2x"])
+def test_cmin_ani_species(ani_method):
+	from aqme.cmin import ANI_SPECIES, get_ani_model
+
+	assert ANI_SPECIES[ani_method] == list(get_ani_model(ani_method).species)
+
+
+# by default (cores_cmin=0), CMIN runs in this process without a process pool
+def test_cmin_serial_default(tmp_path, monkeypatch):
+	import aqme.cmin
+
+	def no_executor(*args, **kwargs):
+		raise AssertionError("CMIN created a process pool")
+
+	monkeypatch.setattr(aqme.cmin, "get_cmin_executor", no_executor)
+	sdf = write_cmin_input(tmp_path)
+	cmin(w_dir_main=tmp_path, program="ani", files=sdf, opt_steps=20)
+	os.chdir(w_dir_main)
+
+	assert len(read_cmin_energies(tmp_path)) == 6
+
+
+# conformers of several files with different sizes are packed in padded ANI
+# batches, and each result must reach the file of its molecule
+def test_cmin_ani_padded_batches(tmp_path, monkeypatch):
+	import numpy as np
+	import pandas as pd
+	import torch
+	import aqme.cmin
+	from aqme.cmin import get_ani_model, ani_species_to_tensor, ani_batch_optimization, hartree_to_kcal
+
+	# 21, 15 and 18 atoms: butanol and pentanol fit in one batch (ANI_MAX_PADDING = 0.25)
+	inputs = [("CCCCCCO", "hexanol"), ("CCCCO", "butanol"), ("CCCCCO", "pentanol")]
+	sdfs = [write_cmin_input(tmp_path, smi=smi, name=name, n_confs=3) for smi, name in inputs]
+
+	batch_shapes = []
+	ani_batch_worker = aqme.cmin.ani_batch_worker
+	def record_batch_worker(ani_method, species, coordinates, *args):
+		batch_shapes.append(tuple(species.shape))
+		return ani_batch_worker(ani_method, species, coordinates, *args)
+	monkeypatch.setattr(aqme.cmin, "ani_batch_worker", record_batch_worker)
+
+	cmin(w_dir_main=tmp_path, program="ani", files=sdfs, ani_method="ANI2x", ani_batch_size=100, opt_steps=200)
+	os.chdir(w_dir_main)
+
+	assert sorted(batch_shapes) == [(3, 21), (6, 18)]
+	# the molecules are written in the order of the input files
+	cmin_data = pd.read_csv(tmp_path.joinpath("CMIN-Data.csv"))
+	assert list(cmin_data["Molecule"]) == [f"{name}_rdkit" for _, name in inputs]
+
+	# each conformer gets the results of its own (unpadded) optimization
+	model = get_ani_model("ANI2x")
+	for _, name in inputs:
+		mols_in = rdkit.Chem.SDMolSupplier(str(tmp_path.joinpath(f"{name}_rdkit.sdf")), removeHs=False)
+		file = str(tmp_path.joinpath(f"CMIN/ani/{name}_rdkit_ani_all_confs.sdf"))
+		mols_out = {mol.GetProp("_Name"): mol for mol in rdkit.Chem.SDMolSupplier(file, removeHs=False)}
+		assert len(mols_out) == len(mols_in)
+		for mol_in in mols_in:
+			species = ani_species_to_tensor("ANI2x", [atom.GetSymbol() for atom in mol_in.GetAtoms()])
+			coords = torch.as_tensor(mol_in.GetConformer().GetPositions())
+			energies, positions, _ = ani_batch_optimization(model, species[None], coords[None], 0.05, 200)
+			mol_out = mols_out[f"{mol_in.GetProp('_Name')} ani"]
+			assert abs(float(mol_out.GetProp("Energy")) - energies[0].item() * hartree_to_kcal) < 0.05
+			np.testing.assert_allclose(mol_out.GetConformer().GetPositions(), positions[0].numpy(), atol=0.02)
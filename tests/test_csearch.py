@@ -7,7 +7,9 @@
 
 import os
 import pytest
+import numpy as np
 from aqme.csearch import csearch
+from aqme.filter import ewin_sweep, pre_E_sweep, ewin_filter_batch, pre_E_filter_batch
 import rdkit
 
 # saves the working directory
@@ -352,3 +354,304 @@ def test_csearch_methods(
 	mols = rdkit.Chem.SDMolSupplier(file,removeHs=False)
 	assert len(mols) == output_nummols
 	os.chdir(w_dir_main)
+
+
+# tests for the steric clash filter and the energy bound of SUMM
+@pytest.mark.parametrize(
+	"program, smi, name, clash_summ, ebound_summ, pruned, pruned_energy",
+	[
+		# with clash_summ=0 and ebound_summ=0 the filters are off
+		("summ", "CCCCCCC", "heptane_noclash_summ", 0, 0, False, False),
+		("summ", "CCCCCCC", "heptane_clash_summ", 0.8, 0, True, False),
+		("summ", "CCCCCCC", "heptane_ebound_summ", 0, 0.5, False, True),
+	],
+)
+def test_csearch_clash_summ(program, smi, name, clash_summ, ebound_summ, pruned, pruned_energy):
+	os.chdir(csearch_rdkit_summ_dir)
+	# runs the program with the different tests
+	csearch(w_dir_main=csearch_rdkit_summ_dir, program=program, smi=smi, name=name, clash_summ=clash_summ,
+	ebound_summ=ebound_summ, verbose=True)
+
+	#tests here
+	file = str("CSEARCH/" + program + "/" + name + "_" + program + ".sdf")
+	mols = rdkit.Chem.SDMolSupplier(file,removeHs=False)
+	assert len(mols) > 0
+	with open("CSEARCH_data.dat", "r") as log_file:
+		log = log_file.read()
+	assert ("conformations discarded due to steric clashes" in log) == pruned
+	assert ("conformations discarded by the energy bound" in log) == pruned_energy
+	os.chdir(w_dir_main)
+
+
+# the repulsion of a branch only grows as more torsions are set, and the syn-pentane branch is pruned
+def test_csearch_summ_energy_bound():
+	from rdkit.Chem import AllChem as Chem
+	from aqme.csearch_utils import get_torsion_clash_pairs, torsion_vdw_energy
+
+	mol = Chem.AddHs(Chem.MolFromSmiles("CCCCC"))
+	Chem.EmbedMolecule(mol, randomSeed=42)
+	matches = [(0, 1, 2, 3), (1, 2, 3, 4)]
+	clash_pairs = get_torsion_clash_pairs(mol, matches, 0, 0.5)
+	# C0-C4 is the only pair of heavy atoms separated by more than 3 bonds, set by the second torsion
+	assert len(clash_pairs[0][0]) == 0
+	assert list(zip(clash_pairs[1][0], clash_pairs[1][1])) == [(0, 4)]
+
+	conformer = mol.GetConformer()
+	energies = {}
+	for dihedrals in [(180, 180), (60, -60)]:
+		for torsion, angle in zip(matches, dihedrals):
+			Chem.rdMolTransforms.SetDihedralDeg(conformer, *torsion, angle)
+		coords = conformer.GetPositions()
+		energies[dihedrals] = [torsion_vdw_energy(coords, level) for level in clash_pairs]
+	assert energies[(180, 180)] == [0.0, 0.0]
+	assert energies[(60, -60)][0] == 0.0
+	assert energies[(60, -60)][1] > 0.5
+	# the energy bound is off for ebound_summ=0
+	assert all(len(level[0]) == 0 for level in get_torsion_clash_pairs(mol, matches, 0, 0))
+
+
+# tests for the parallel walkers of fullmonte
+@pytest.mark.parametrize(
+	"program, smi, name, charge, mult, nwalkers_fullmonte, merge_fullmonte, nsteps_fullmonte",
+	[
+		("fullmonte", "CCCCC", "pentane_1walker", 0, 1, 1, 10, 20),
+		("fullmonte", "CCCCC", "pentane_2walkers", 0, 1, 2, 5, 20),
+	],
+)
+def test_csearch_fullmonte_walkers(program, smi, name, charge, mult, nwalkers_fullmonte, merge_fullmonte, nsteps_fullmonte):
+	os.chdir(csearch_fullmonte_dir)
+	file = str("CSEARCH/" + program + "/" + name + "_" + program + ".sdf")
+	energies = []
+	# with the same seed, two runs with the same walkers give the same conformers
+	for _ in range(2):
+		csearch(w_dir_main=csearch_fullmonte_dir, program=program, smi=smi, name=name, charge=charge, mult=mult, seed=62609,
+		nwalkers_fullmonte=nwalkers_fullmonte, merge_fullmonte=merge_fullmonte, nsteps_fullmonte=nsteps_fullmonte)
+		mols = rdkit.Chem.SDMolSupplier(file,removeHs=False)
+		assert len(mols) > 0
+		assert charge == int(mols[0].GetProp('Real charge'))
+		assert mult == int(mols[0].GetProp('Mult'))
+		energies.append([mol.GetProp('Energy') for mol in mols])
+
+	assert energies[0] == energies[1]
+	os.chdir(w_dir_main)
+
+
+# the results and log messages of parallel jobs follow the order of the inputs
+def test_csearch_parallel_order():
+	program = "rdkit"
+	# the first molecule takes longer, so the second job finishes first in parallel
+	names = ["decane_order", "butane_order"]
+	outputs = {}
+	for max_workers in [1, 2]:
+		run_dir = f"{csearch_others_dir}/parallel_{max_workers}"
+		if not os.path.exists(run_dir):
+			os.mkdir(run_dir)
+		os.chdir(run_dir)
+		with open("molecules_order.csv", "w") as csv_file:
+			csv_file.write("SMILES,code_name\nCCCCCCCCCC,decane_order\nCCCC,butane_order\n")
+		csearch(w_dir_main=run_dir, program=program, input="molecules_order.csv", seed=62609, max_workers=max_workers)
+
+		sdf_files = []
+		for name in names:
+			with open(f"CSEARCH/{program}/{name}_{program}.sdf", "r") as sdf_file:
+				sdf_files.append(sdf_file.read())
+		with open("CSEARCH_data.dat", "r") as log_file:
+			log = log_file.read()
+		# the timings change between runs
+		log_lines = [line for line in log.splitlines() if "seconds" not in line]
+		outputs[max_workers] = (sdf_files, log_lines)
+
+		# the messages of each molecule are written as one block, in input order
+		start_decane, start_butane = log.index(f"----- {names[0]} -----"), log.index(f"----- {names[1]} -----")
+		assert start_decane < start_butane
+		assert names[1] not in log[start_decane:start_butane]
+		assert names[0] not in log[start_butane:]
+		os.chdir(w_dir_main)
+
+	assert outputs[1] == outputs[2]
+
+
+# loops of the original energy filters, used as reference for the kernels
+def ewin_loop(energies, energy_window):
+	return [abs(energy - energies[0]) < energy_window for energy in energies]
+
+
+def pre_E_loop(energies, threshold):
+	selected = [0]
+	for idx in range(1, len(energies)):
+		if all(abs(energies[idx] - energies[seen]) >= threshold for seen in selected):
+			selected.append(idx)
+	return [idx in selected for idx in range(len(energies))]
+
+
+# tests for the energy filter kernels (random energies rounded to get ties)
+@pytest.mark.parametrize(
+	"seed, sort, threshold",
+	[
+		(0, True, 0.25),
+		(1, False, 0.25),
+		(2, True, 0.0001),
+		(3, False, 1.0),
+	],
+)
+def test_csearch_energy_filters(seed, sort, threshold):
+	rng = np.random.default_rng(seed)
+	for n_confs in [1, 2, 10, 200]:
+		energies = np.round(rng.uniform(-5, 5, n_confs), 1)
+		if sort:
+			energies = np.sort(energies)
+		assert list(pre_E_sweep(energies, threshold)) == pre_E_loop(energies, threshold)
+		assert list(ewin_sweep(energies, 2.5)) == ewin_loop(energies, 2.5)
+
+
+# the batched filters must give the same conformers as the kernels applied to each molecule
+@pytest.mark.parametrize(
+	"seed, energy_window, threshold",
+	[
+		(0, 2.5, 0.25),
+		(1, 0.5, 0.0001),
+		(2, 1000, 1.0),
+	],
+)
+def test_csearch_energy_filters_batch(seed, energy_window, threshold):
+	rng = np.random.default_rng(seed)
+	# unsorted energies rounded to get ties, including molecules without conformers
+	energy_arrays = [np.round(rng.uniform(-5, 5, n_confs), 1) for n_confs in [0, 1, 7, 0, 50, 3]]
+	ewin_idx = ewin_filter_batch(energy_arrays, energy_window)
+	pre_E_idx = pre_E_filter_batch(energy_arrays, threshold)
+	pre_E_ewin_idx = pre_E_filter_batch(energy_arrays, threshold, energy_window=energy_window)
+
+	assert len(ewin_idx) == len(pre_E_idx) == len(pre_E_ewin_idx) == len(energy_arrays)
+	for i, energies in enumerate(energy_arrays):
+		order = np.argsort(energies, kind="stable")
+		ewin_ref = order[ewin_sweep(energies[order], energy_window)]
+		assert list(ewin_idx[i]) == list(ewin_ref)
+		assert list(pre_E_idx[i]) == list(order[pre_E_sweep(energies[order], threshold)])
+		assert list(pre_E_ewin_idx[i]) == list(ewin_ref[pre_E_sweep(energies[ewin_ref], threshold)])
+
+
+def symmetric_conformers(smi, n_confs=20):
+	# MMFF conformers, so some of them are duplicates
+	from rdkit.Chem import AllChem as Chem
+
+	mol = Chem.AddHs(Chem.MolFromSmiles(smi))
+	Chem.EmbedMultipleConfs(mol, n_confs, randomSeed=42)
+	energies = [energy for _, energy in Chem.MMFFOptimizeMoleculeConfs(mol, maxIters=2000)]
+	return mol, np.array(energies)
+
+
+def best_rms_rdkit(mol, prb_cid, ref_cid, heavyonly, max_matches_rmsd):
+	# previous RMSD calculation (get_conf_RMS with GetBestRMS)
+	from rdkit.Chem import AllChem as Chem
+	from rdkit.Chem.rdMolAlign import GetBestRMS
+
+	mol_prb, mol_ref = Chem.Mol(mol), Chem.Mol(mol)
+	if heavyonly:
+		mol_prb, mol_ref = Chem.RemoveHs(mol_prb), Chem.RemoveHs(mol_ref)
+	return GetBestRMS(mol_prb, mol_ref, prb_cid, ref_cid, maxMatches=max_matches_rmsd)
+
+
+# the vectorized RMSD must match GetBestRMS() for molecules with symmetric groups (tBu, CF3)
+@pytest.mark.parametrize(
+	"smi, heavyonly",
+	[
+		("CC(C)(C)CCO", True),
+		("CC(C)(C)CCO", False),
+		("OCc1ccccc1C(F)(F)F", True),
+		("OCc1ccccc1C(F)(F)F", False),
+	],
+)
+def test_csearch_rms_batch(smi, heavyonly):
+	from aqme.utils import get_rmsd_context
+
+	max_matches_rmsd = 10000
+	mol, _ = symmetric_conformers(smi, n_confs=8)
+	rms_context = get_rmsd_context(mol, heavyonly, max_matches_rmsd)
+	coords = np.array([rms_context.coords(mol, cid) for cid in range(mol.GetNumConformers())])
+	for prb_cid in range(mol.GetNumConformers()):
+		rms_ref = [best_rms_rdkit(mol, prb_cid, ref_cid, heavyonly, max_matches_rmsd) for ref_cid in range(mol.GetNumConformers())]
+		assert np.allclose(rms_context.rms_batch(coords[prb_cid], coords), rms_ref, atol=1e-4)
+		# with inverse=True, the conformers passed as targets are the probes of GetBestRMS()
+		rms_inv = [rms_context.rms_batch(coords[ref_cid], coords[[prb_cid]], inverse=True)[0] for ref_cid in range(mol.GetNumConformers())]
+		assert np.allclose(rms_inv, rms_ref, atol=1e-4)
+
+
+def rmsd_and_e_filter_loop(mol, selectedcids_initial, cenergy, args, calc_type):
+	# previous RMSD_and_E_filter(), comparing each conformer with all the accepted ones
+	selectedcids = [selectedcids_initial[0]]
+	for conf in selectedcids_initial[1:]:
+		excluded_conf = False
+		for seenconf in selectedcids:
+			if abs(cenergy[conf] - cenergy[seenconf]) < args.energy_threshold:
+				if calc_type == "rdkit":
+					rms = best_rms_rdkit(mol, seenconf, conf, args.heavyonly, args.max_matches_rmsd)
+				else:
+					rms = best_rms_rdkit(mol, conf, seenconf, args.heavyonly, args.max_matches_rmsd)
+				if rms < args.rms_threshold:
+					excluded_conf = True
+					break
+		if not excluded_conf:
+			selectedcids.append(conf)
+	return selectedcids
+
+
+# RMSD_and_E_filter must accept the same conformers as the previous loop
+@pytest.mark.parametrize(
+	"smi, heavyonly, calc_type",
+	[
+		("CC(C)(C)CCO", True, "rdkit"),
+		("CC(C)(C)CCO", False, "summ"),
+		("OCc1ccccc1C(F)(F)F", True, "summ"),
+		("OCc1ccccc1C(F)(F)F", False, "rdkit"),
+	],
+)
+def test_csearch_rmsd_and_e_filter(smi, heavyonly, calc_type):
+	from types import SimpleNamespace
+	import pandas as pd
+	from aqme.filter import RMSD_and_E_filter
+	from aqme.utils import ConformerEnsemble
+
+	mol, cenergy = symmetric_conformers(smi)
+	coords = np.array([conf.GetPositions() for conf in mol.GetConformers()])
+	outmols = ConformerEnsemble(mol, coords, cenergy)
+	selectedcids_initial = [int(cid) for cid in np.argsort(cenergy, kind="stable")]
+	for rms_threshold in [0.05, 0.25, 1.0]:
+		args = SimpleNamespace(rms_threshold=rms_threshold, energy_threshold=0.5, verbose=False,
+		heavyonly=heavyonly, max_matches_rmsd=10000)
+		dup_data = pd.DataFrame()
+		selectedcids = RMSD_and_E_filter(outmols, selectedcids_initial, cenergy, args, dup_data, 0, None, calc_type)
+		assert selectedcids == rmsd_and_e_filter_loop(mol, selectedcids_initial, cenergy, args, calc_type)
+
+
+# filter_template_mol must reject the same templates as the previous GetBestRMS loop
+@pytest.mark.parametrize(
+	"smi, heavyonly",
+	[
+		("CC(C)(C)CCO", True),
+		("OCc1ccccc1C(F)(F)F", False),
+	],
+)
+def test_csearch_filter_template_mol(smi, heavyonly):
+	from rdkit.Chem import AllChem as Chem
+	from rdkit.Chem.rdMolAlign import GetBestRMS
+	from aqme.csearch_utils import filter_template_mol
+
+	max_matches_rmsd = 10000
+	mol, _ = symmetric_conformers(smi)
+	mol_objects = []
+	for cid in range(mol.GetNumConformers()):
+		molecule_new = Chem.Mol(mol, confId=cid)
+		# previous loop: the kept templates are the probes and the new one is the target
+		keep_ref = True
+		for mol_kept in mol_objects:
+			mol_prb, mol_ref = Chem.Mol(mol_kept), Chem.Mol(molecule_new)
+			if heavyonly:
+				mol_prb, mol_ref = Chem.RemoveHs(mol_prb), Chem.RemoveHs(mol_ref)
+			if GetBestRMS(mol_prb, mol_ref, -1, -1, maxMatches=max_matches_rmsd) < 0.5:
+				keep_ref = False
+				break
+		assert filter_template_mol(molecule_new, mol_objects, heavyonly, max_matches_rmsd) == keep_ref
+		if keep_ref:
+			mol_objects.append(molecule_new)
+	# some conformers are duplicates, so both results are tested
+	assert 0 < len(mol_objects) < mol.GetNumConformers()
@@ -0,0 +1,54 @@
+#!/usr/bin/env python
+
+######################################################.
+# 		        Testing with pytest: 	             #
+#                  PIPELINE module                   #
+######################################################.
+
+import os
+import glob
+import pytest
+from aqme.pipeline import pipeline
+import rdkit
+
+# saves the working directory
+w_dir_main = os.getcwd()
+pipeline_dir = w_dir_main + "/tests/pipeline"
+if not os.path.exists(pipeline_dir):
+	os.mkdir(pipeline_dir)
+
+# tests for the CSEARCH + CMIN + QPREP pipeline
+@pytest.mark.parametrize(
+	"program, smi, name, cmin_pipeline, checkpoints_pipeline, output_nummols",
+	[
+		# tests with and without SDF checkpoints
+		("rdkit", "CCCCC", "pentane", ["ani"], [], 4),
+		("rdkit", "CCCCC", "pentane", ["ani"], ["csearch", "ani"], 4),
+	],
+)
+def test_pipeline(program, smi, name, cmin_pipeline, checkpoints_pipeline, output_nummols):
+	os.chdir(pipeline_dir)
+	# runs the program with the different tests
+	pipeline(w_dir_main=pipeline_dir, program=program, smi=smi, name=name, cmin_pipeline=cmin_pipeline,
+		checkpoints_pipeline=checkpoints_pipeline, qprep_pipeline="gaussian", qm_input="wb97xd/def2svp opt freq")
+
+	#tests here
+	csearch_file = f"CSEARCH/{program}/{name}_{program}.sdf"
+	cmin_file = f"CMIN/ani/{name}_{program}_ani.sdf"
+	if "csearch" in checkpoints_pipeline:
+		assert os.path.exists(csearch_file)
+		assert os.path.exists(cmin_file)
+		mols = rdkit.Chem.SDMolSupplier(cmin_file, removeHs=False)
+		assert len(mols) == output_nummols
+		os.remove(csearch_file)
+		os.remove(cmin_file)
+	else:
+		assert not os.path.exists(csearch_file)
+		assert not os.path.exists(cmin_file)
+
+	com_files = glob.glob(f"QCALC/{name}_{program}_ani_conf_*.com")
+	assert len(com_files) == output_nummols
+	for com_file in com_files:
+		os.remove(com_file)
+
+	os.chdir(w_dir_main)